@@ -0,0 +1,345 @@
+#! /usr/bin/env python
+
+"""
+Benchmarks for the thermo_daemon.py daemon.
+
+Runs read_temp(), connect() and main() against a simulated ADC and an
+in-process stub thermostat, so the loop's cost can be measured (and
+regressions caught) anywhere, not just on a BeagleBone.  Thermostat latency
+can be injected to see how the loop copes with a slow device.
+
+    ./benchmarks.py --duration 60 --latency 0.5
+
+Exits non-zero if any of the --max-* budgets are exceeded.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+from threading import Event, Thread, Timer
+from time import monotonic, sleep, thread_time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import thermo_daemon
+import thermo_discovery
+import thermo_http
+import thermo_sensors
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedBackend(thermo_sensors.SensorBackend):
+    """
+    A simulated TMP36: a slow sine wave around 70F with gaussian ADC noise.
+    Deterministic for a given seed.
+    """
+
+    name = 'simulated'
+
+    def __init__(self, noise=0.002, period=3600.0, seed=0):
+        self.noise = noise
+        self.period = period
+        self.random = random.Random(seed)
+        self.reads = 0
+
+    def read(self, channel):
+        self.reads += 1
+        # 70F is 0.9V from a TMP36, half the 1.8V reference
+        wave = 0.02 * math.sin(2 * math.pi * self.reads / self.period)
+        return 0.5 + wave + self.random.gauss(0, self.noise)
+
+
+class StubThermostatHandler(BaseHTTPRequestHandler):
+    """Answers tstat/remote_temp and tstat/model, after the stub's latency"""
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Serves the model, which is all connect() asks for"""
+        sleep(self.server.latency)
+        if self.path == '/tstat/model':
+            self._reply(200, b'{"model": "CT50 V1.94"}')
+        else:
+            self._reply(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        """Accepts remote temperatures"""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        sleep(self.server.latency)
+        self.server.posts += 1
+        if self.path == '/tstat/remote_temp':
+            self._reply(200, b'{ "success": 0 }')
+        else:
+            self._reply(404, b'{"error": "not found"}')
+
+    def log_message(self, *args):
+        """Keeps the benchmark output clean"""
+        pass
+
+
+class StubThermostat(ThreadingMixIn, HTTPServer):
+    """An in-process stand-in for a thermostat, with injected latency"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubThermostatHandler)
+        self.latency = latency
+        self.posts = 0
+        self.host = "127.0.0.1:%d" % self.server_port
+
+    def start(self):
+        """Serves from a daemon thread"""
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class TimingClient(object):
+    """Wraps a PooledClient, recording every request's round trip time"""
+
+    def __init__(self, client):
+        self.client = client
+        self.latencies = []
+
+    def _timed(self, method, *args, **kwargs):
+        start = monotonic()
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        finally:
+            self.latencies.append(monotonic() - start)
+
+    def get(self, *args, **kwargs):
+        return self._timed('get', *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self._timed('post', *args, **kwargs)
+
+    def attach(self, tstat):
+        return self.client.attach(tstat)
+
+    def stats(self):
+        return self.client.stats()
+
+
+class MemorySampler(Thread):
+    """Samples resident memory every interval seconds in the background"""
+
+    def __init__(self, interval=1.0):
+        Thread.__init__(self, name="bench-memory")
+        self.daemon = True
+        self.interval = interval
+        self.samples = []
+        self._done = Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.samples.append(rss_kb())
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.samples.append(rss_kb())
+
+
+def rss_kb():
+    """Returns current resident memory in kB (peak, where /proc is absent)"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError):  # pragma: no cover
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Returns a dict of nearest-rank percentiles of values"""
+    if not values:
+        return dict(("p%d" % p, None) for p in points)
+    ordered = sorted(values)
+    result = {}
+    for p in points:
+        rank = max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)
+        result["p%d" % p] = ordered[rank]
+    result['max'] = ordered[-1]
+    return result
+
+
+def use_simulated_adc():
+    """Points thermo_daemon at a fresh simulated ADC"""
+    backend = SimulatedBackend()
+    thermo_daemon._backend = backend
+    return backend
+
+
+def bench_read_temp(iterations=10000):
+    """Times read_temp() back to back"""
+    use_simulated_adc()
+    latencies = []
+    cpu_start = thread_time()
+    start = monotonic()
+    for _ in range(iterations):
+        t = monotonic()
+        thermo_daemon.read_temp()
+        latencies.append(monotonic() - t)
+    elapsed = monotonic() - start
+    return {
+        'samples_per_sec': iterations / elapsed,
+        'cpu_per_read': (thread_time() - cpu_start) / iterations,
+        'latency': percentiles(latencies),
+    }
+
+
+def bench_connect(stub, iterations=20):
+    """Times connect() through a warm discovery cache"""
+    directory = tempfile.mkdtemp()
+    saved_cache = thermo_daemon.discovery_cache
+    try:
+        thermo_daemon.discovery_cache = os.path.join(directory, 'tstat.json')
+        thermo_discovery.save_cache(thermo_daemon.discovery_cache, stub.host,
+                                    'CT50 V1.94')
+        client = thermo_http.PooledClient()
+        latencies = []
+        for _ in range(iterations):
+            t = monotonic()
+            thermo_daemon.connect(client)
+            latencies.append(monotonic() - t)
+        client.close()
+    finally:
+        thermo_daemon.discovery_cache = saved_cache
+        shutil.rmtree(directory)
+    return {'latency': percentiles(latencies)}
+
+
+def bench_main(stub, duration=10, read_freq=0.01, send_freq=10):
+    """
+    Runs main() against the stub for duration seconds, measuring how many
+    reads it manages, its CPU per tick and its memory over the run.
+    """
+    backend = use_simulated_adc()
+    client = TimingClient(thermo_http.PooledClient())
+    thermo_daemon.http_client = client
+    thermo_daemon.exitLock = thermo_daemon.Lock()
+    thermo_daemon.exitLock.acquire()
+    tstat = thermo_daemon.radiotherm.get_thermostat(stub.host, 'CT50 V1.94')
+    memory = MemorySampler()
+    memory.start()
+    stopper = Timer(duration, thermo_daemon.exitLock.release)
+    stopper.start()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_start = thread_time()
+    start = monotonic()
+    thermo_daemon.main(tstat, read_freq, send_freq)
+    elapsed = monotonic() - start
+    main_cpu = thread_time() - cpu_start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    memory.stop()
+    process_cpu = (after.ru_utime - usage.ru_utime) + \
+        (after.ru_stime - usage.ru_stime)
+    ticks = max(1, backend.reads - 1)
+    return {
+        'samples_per_sec': backend.reads / elapsed,
+        'expected_per_sec': 1.0 / read_freq,
+        'cpu_per_tick': main_cpu / ticks,
+        # Includes the sender and the stub thermostat's threads
+        'process_cpu_per_tick': process_cpu / ticks,
+        'posts': stub.posts,
+        'post_latency': percentiles(client.latencies),
+        'rss_kb': {
+            'start': memory.samples[0],
+            'end': memory.samples[-1],
+            'max': max(memory.samples),
+        },
+    }
+
+
+def run(args):
+    """Runs every benchmark.  Returns (results, failures)."""
+    stub = StubThermostat(args.latency).start()
+    try:
+        results = {
+            'read_temp': bench_read_temp(args.iterations),
+            'connect': bench_connect(stub),
+            'main': bench_main(stub, args.duration, args.read_freq,
+                               args.send_freq),
+        }
+    finally:
+        stub.shutdown()
+        stub.server_close()
+    failures = []
+    main_results = results['main']
+    rate = main_results['samples_per_sec'] / main_results['expected_per_sec']
+    if args.min_rate is not None and rate < args.min_rate:
+        failures.append("main() kept up %.1f%% of the read rate, wanted %.1f%%"
+                        % (rate * 100, args.min_rate * 100))
+    if args.max_tick_cpu is not None and \
+            main_results['cpu_per_tick'] > args.max_tick_cpu:
+        failures.append("main() used %.6fs CPU per tick, budget %.6fs" %
+                        (main_results['cpu_per_tick'], args.max_tick_cpu))
+    growth = main_results['rss_kb']['end'] - main_results['rss_kb']['start']
+    if args.max_rss_growth is not None and growth > args.max_rss_growth:
+        failures.append("Memory grew %dkB over the run, budget %dkB" %
+                        (growth, args.max_rss_growth))
+    return results, failures
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--duration', type=float, default=10,
+                        help="Seconds to run main() for")
+    parser.add_argument('--read-freq', type=float, default=0.01,
+                        help="read_freq to run main() with")
+    parser.add_argument('--send-freq', type=int, default=10,
+                        help="send_freq to run main() with")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds the stub thermostat takes to answer")
+    parser.add_argument('--iterations', type=int, default=10000,
+                        help="read_temp() calls to time")
+    parser.add_argument('--min-rate', type=float, default=None,
+                        help="Fail below this fraction of the read rate")
+    parser.add_argument('--max-tick-cpu', type=float, default=None,
+                        help="Fail above this many CPU seconds per tick")
+    parser.add_argument('--max-rss-growth', type=int, default=None,
+                        help="Fail if memory grows more than this (kB)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs the benchmarks, printing results as JSON"""
+    args = parse_args(argv)
+    # The daemon's per-tick debug logging is part of what's measured, but
+    # not what anyone wants to read.
+    logging.basicConfig(level=logging.WARNING)
+    results, failures = run(args)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    for failure in failures:
+        sys.stderr.write("FAIL: %s\n" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
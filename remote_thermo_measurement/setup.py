@@ -36,11 +36,20 @@ setup(
     version = "0.1",
     entry_points = {
         'console_scripts': [
-            'remote_thermo_daemon = thermo_daemon:main'
+            'remote_thermo_daemon = thermo_daemon:run',
+            'remote_thermo_engine = thermo_async:cli',
+            'remote_thermo_emulator = thermo_emulator:main',
+            'remote_thermo_replay = thermo_replay:main',
+            'remote_thermo_aggregator = thermo_aggregator:main',
+            'remote_thermo_proxy = thermo_proxy:main',
+            'remote_thermo_stream = thermo_stream:main',
+            'remote_thermo_program = thermo_program:main',
+            'remote_thermo_samples = thermo_shm:main',
         ]
     },
     install_requires = [
         "Adafruit-BBIO",
+        "numpy",
         "radiotherm",
         "requests",
     ],
@@ -5,11 +5,18 @@ Tests for the thermo_daemon.py daemon.
 """
 
 import mock
+import numpy
 import unittest
 import thermo_daemon
+import thermo_discovery
 from mock import patch
 from mock import call
 from multiprocessing import Lock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# test_Application replaces this on the module; keep it for tests which need
+# the real thing.
+REAL_GET_THERMOSTAT = thermo_daemon.radiotherm.get_thermostat
 
 BBIO_SETUP_ERROR = """Unable to setup ADC system. Possible causes are:
   - A cape with a conflicting pin mapping is loaded
@@ -47,17 +54,25 @@ class test_Application(unittest.TestCase):
         r = mock.Mock()
         r.text = "{ \"success\": 0 }"
         r.status_code = 200
-        thermo_daemon.requests.post = mock.MagicMock(return_value=r)
+        self.client = mock.Mock()
+        self.client.post.return_value = r
+        self.client.stats.return_value = {}
+        thermo_daemon.http_client = self.client
+        thermo_daemon.discovery_cache = None
         self.tstat = mock_radiotherm()
         thermo_daemon.radiotherm.get_thermostat = mock.MagicMock(
             return_value=mock_radiotherm())
-        p_read = patch('thermo_daemon.ADC.read')
+        p_read = patch('thermo_sensors.ADC.read')
         self.read = p_read.start()
         self.read.return_value = 0.37
-        p_setup = patch('thermo_daemon.ADC.setup')
+        p_setup = patch('thermo_sensors.ADC.setup')
         self.setup = p_setup.start()
         p_logging = patch('thermo_daemon.logger')
         self.logging = p_logging.start()
+        p_sender_logging = patch('thermo_sender.logger')
+        self.sender_logging = p_sender_logging.start()
+        p_sleep = patch('thermo_resilience.sleep')
+        self.sleep = p_sleep.start()
         # Set up the lock as if setup had been called.
         thermo_daemon.exitLock = Lock()
         thermo_daemon.exitLock.acquire()
@@ -65,10 +80,20 @@ class test_Application(unittest.TestCase):
     def test_readTemp(self):
         """Test reading temperature from the mocked IO"""
         self.assertEqual(thermo_daemon.read_temp(), 61.88)
-        self.logging.debug.assert_called_once_with(
-            "Read a temperature of %.2f",
-            61.88
-        )
+        # Each tick is traced instead of logged
+        self.logging.debug.assert_not_called()
+
+    def test_readTempBurst(self):
+        """Test that a burst's outliers are filtered out"""
+        self.read.side_effect = [0.37, 0.37, 0.95, 0.37, 0.0] * 2
+        thermo_daemon.burst_samples = 5
+        self.addCleanup(setattr, thermo_daemon, 'burst_samples', 1)
+        self.assertEqual(thermo_daemon.read_temp(), 61.88)
+        self.assertEqual(self.read.call_count, 5)
+        burst = thermo_daemon._burst
+        self.assertEqual(thermo_daemon.read_temp(), 61.88)
+        # Reused while the settings stay the same
+        self.assertIs(thermo_daemon._burst, burst)
 
     def test_forceNoThermostatIOError(self):
         """Tests the behavior if the thermostat can't be found"""
@@ -82,6 +107,15 @@ class test_Application(unittest.TestCase):
             "Network is unreachable", 101
         )
 
+    def test_connectRetries(self):
+        """Tests that a thermostat which answers late is still found"""
+        tstat = mock_radiotherm()
+        thermo_daemon.radiotherm.get_thermostat = mock.MagicMock(
+            side_effect=[IOError("No thermostats were found"), tstat])
+        self.assertIs(thermo_daemon.connect(), tstat)
+        self.assertEqual(self.sleep.call_count, 1)
+        self.logging.critical.assert_not_called()
+
     def test_forceNoThermostatIOErrorNoArgs(self):
         """Tests the behavior if the thermostat can't be found"""
         thermo_daemon.radiotherm.get_thermostat = mock.MagicMock(
@@ -105,12 +139,50 @@ class test_Application(unittest.TestCase):
             call("Unable to connect to the thermostat:")
         ])
 
+    def test_readTempSensors(self):
+        """Test reading and combining several calibrated probes"""
+        readings = {'P9_40': 0.37, 'P9_39': 0.38, 'P9_37': 0.6}
+        self.read.side_effect = readings.get
+        thermo_daemon.sensors = {
+            'P9_40': {'weight': 3},
+            'P9_39': {'calibration': -3.24},
+            'P9_37': {},
+        }
+        thermo_daemon.sensor_outlier = 5
+        self.addCleanup(setattr, thermo_daemon, 'sensors', None)
+        self.addCleanup(setattr, thermo_daemon, 'sensor_outlier', None)
+        # P9_37 is ~75F off and ignored; the other two both read 61.88
+        self.assertAlmostEqual(thermo_daemon.read_temp(), 61.88)
+        self.assertEqual(thermo_daemon.get_sensor_array().stats()['P9_37'], 1)
+        self.assertAlmostEqual(thermo_daemon.metrics.adc_raw.value, 0.375)
+        thermo_daemon.sensor_aggregate = 'max'
+        thermo_daemon.sensor_outlier = None
+        self.addCleanup(setattr, thermo_daemon, 'sensor_aggregate',
+                        'weighted')
+        self.assertAlmostEqual(thermo_daemon.read_temp(), 136.4)
+
+    def test_sensorArrayRebuilds(self):
+        """In place changes rebuild the array, keeping changed weights"""
+        self.read.side_effect = {'P9_40': 0.37, 'P9_39': 0.6}.get
+        thermo_daemon.sensors = {'P9_40': {}, 'P9_39': {}}
+        self.addCleanup(setattr, thermo_daemon, 'sensors', None)
+        thermo_daemon.get_sensor_array().set_weight('P9_39', 0)
+        self.assertAlmostEqual(thermo_daemon.read_temp(), 61.88)
+        thermo_daemon.sensors['P9_40']['calibration'] = 1
+        array = thermo_daemon.get_sensor_array()
+        self.assertAlmostEqual(thermo_daemon.read_temp(), 62.88)
+        self.assertEqual(array.weight_overrides, {'P9_39': 0})
+        thermo_daemon.sensors['P9_39']['weight'] = 1
+        self.assertAlmostEqual(thermo_daemon.read_temp(),
+                               (62.88 + 136.4) / 2)
+
     @patch('signal.signal')
     def test_setup(self, signal):
         """Tests that setup functions as expected under normal conditions"""
         from signal import SIGTERM
         main = patch('thermo_daemon.main')
         main.start()
+        self.addCleanup(main.stop)
         thermo_daemon.setup()
         self.logging.debug.assert_has_calls([
             call("Setting up ADC"),
@@ -121,6 +193,46 @@ class test_Application(unittest.TestCase):
         self.setup.assert_called()
         signal.assert_called_with(SIGTERM, thermo_daemon.handle_exit)
 
+    @patch('signal.signal')
+    def test_setupStartsSampler(self, signal):
+        """Tests that the sampler is forked before connect starts threads"""
+        import os
+        import thermo_shm
+        name = 'remote_thermo_test_%d' % os.getpid()
+        for setting, value in (('sampler_process', True),
+                               ('sampler_name', name)):
+            self.addCleanup(setattr, thermo_daemon, setting,
+                            getattr(thermo_daemon, setting))
+            setattr(thermo_daemon, setting, value)
+        running = []
+
+        def connect(client):
+            running.append(thermo_daemon._sampler is not None)
+            return self.tstat
+        with patch('thermo_daemon.connect', side_effect=connect):
+            self.assertIs(thermo_daemon.setup(), self.tstat)
+        self.assertEqual(running, [True])
+        sampler = thermo_daemon._sampler
+        self.assertIs(thermo_daemon.start_sampler(), sampler)
+        thermo_daemon.stop_sampler(sampler,
+                                   thermo_shm.Consumer(sampler[0]))
+        self.assertIsNone(thermo_daemon._sampler)
+        self.assertFalse(os.path.exists('/dev/shm/' + name))
+
+    def test_getClient(self):
+        """Tests that one pooled client is made and shared"""
+        with patch.object(thermo_daemon, 'http_client', None):
+            client = thermo_daemon.get_client()
+            self.addCleanup(client.close)
+            self.assertIsInstance(client,
+                                  thermo_daemon.thermo_http.PooledClient)
+            self.assertIs(thermo_daemon.get_client(), client)
+
+    def test_connectAttachesClient(self):
+        """Tests that connect routes the thermostat through the pool"""
+        tstat = thermo_daemon.connect(self.client)
+        self.client.attach.assert_called_once_with(tstat)
+
     def test_setup_ADC_RuntimeException(self):
         """Tests that we properly show an error message if the adafruit BBIO
         library fails to initalize"""
@@ -138,6 +250,18 @@ class test_Application(unittest.TestCase):
             call("Raw exception: %s", BBIO_SETUP_ERROR),
         ])
 
+    def test_setup_otherBackendFailure(self):
+        """Tests that non-BBIO backends don't get the BBIO advice"""
+        thermo_daemon.sensor_backend = 'iio'
+        thermo_daemon._backend = None
+        self.addCleanup(setattr, thermo_daemon, 'sensor_backend', 'bbio')
+        self.addCleanup(setattr, thermo_daemon, '_backend', None)
+        with patch('thermo_sensors.os.path.isdir', return_value=False):
+            self.assertIsNone(thermo_daemon.setup())
+        self.logging.critical.assert_called_once_with(
+            "Unable to set up the %s sensor backend: %s", 'iio',
+            "No IIO device at /sys/bus/iio/devices/iio:device0")
+
     def test_main(self):
         """Tests the main function.  Forks off a new thread, then uses the
         signal handler to kill it.
@@ -148,11 +272,16 @@ class test_Application(unittest.TestCase):
         from threading import Thread
         signal.signal(signal.SIGINT, thermo_daemon.handle_exit)
         signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        for setting in ('trace', 'trace_capacity'):
+            self.addCleanup(setattr, thermo_daemon, setting,
+                            getattr(thermo_daemon, setting))
+        # A fresh ring, sized by main()
+        thermo_daemon.trace_capacity = 64
         t = Thread(target=main_signal)
         t.start()
         thermo_daemon.main(self.tstat, send_freq=2)
         self.read.assert_called()
-        thermo_daemon.requests.post.assert_has_calls(
+        self.client.post.assert_has_calls(
             [
                 call(
                     "http://10.0.0.21/tstat/remote_temp",
@@ -168,14 +297,459 @@ class test_Application(unittest.TestCase):
         ])
         self.logging.warning.assert_called_with("Caught exit signal, exiting.")
         self.logging.debug.assert_has_calls([
-            call('Read a temperature of %.2f', 61.88),
-            call("Payload to the server is: %s", '{"rem_temp": 61.88 }'),
-            call("Server responded with code %d: %s", 200, '{ "success": 0 }'),
             call(
                 "Deactivating remote temperature with payload %s",
                 '{"rem_mode": 0}'
             ),
         ], any_order=True)
+        self.assertEqual(thermo_daemon.trace.capacity, 64)
+        records = thermo_daemon.trace.snapshot()
+        kinds = set(records['kind'])
+        for kind in (thermo_daemon.thermo_trace.READ,
+                     thermo_daemon.thermo_trace.SUBMIT):
+            self.assertIn(kind, kinds)
+        sends = records[records['kind'] == thermo_daemon.thermo_trace.SEND]
+        self.assertEqual(sends['status'][0], 200)
+        self.assertAlmostEqual(sends['value'][0], 61.88)
+
+    def test_mainMetrics(self):
+        """Tests that main records metrics and serves them when asked"""
+        import signal
+        import requests
+        from threading import Thread
+        thermo_daemon.metrics = thermo_daemon.thermo_metrics.DaemonMetrics()
+        thermo_daemon.metrics_port = 0
+        self.addCleanup(setattr, thermo_daemon, 'metrics_port', None)
+        serve = thermo_daemon.thermo_metrics.serve
+        servers = []
+
+        def record(*args):
+            servers.append(serve(*args))
+            return servers[-1]
+        scraped = []
+
+        def scrape():
+            from time import sleep
+            sleep(3)
+            scraped.append(requests.get(
+                "http://127.0.0.1:%d/metrics" % servers[0].server_port))
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        Thread(target=main_signal).start()
+        Thread(target=scrape).start()
+        with patch('thermo_metrics.serve', record):
+            thermo_daemon.main(self.tstat, send_freq=2)
+        metrics = thermo_daemon.metrics
+        self.assertGreaterEqual(metrics.read_latency.count, 4)
+        self.assertEqual(metrics.avgtemp.value, 61.88)
+        self.assertEqual(metrics.adc_raw.value, 0.37)
+        self.assertIn('200', metrics.post_status.values)
+        self.assertIn("thermo_average_temperature_fahrenheit 61.88",
+                      scraped[0].text)
+
+    def test_mainRing(self):
+        """Tests that main records readings and sends in the ring buffer"""
+        import os
+        import shutil
+        import signal
+        import tempfile
+        from threading import Thread
+        import thermo_ring
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        thermo_daemon.ring_file = os.path.join(directory, 'ring')
+        self.addCleanup(setattr, thermo_daemon, 'ring_file', None)
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        Thread(target=main_signal).start()
+        thermo_daemon.main(self.tstat, send_freq=2)
+        records = thermo_ring.open_ring(thermo_daemon.ring_file).snapshot()
+        readings = records[records['kind'] == thermo_ring.READING]
+        sends = records[records['kind'] == thermo_ring.SEND]
+        self.assertGreaterEqual(len(readings), 4)
+        self.assertAlmostEqual(readings['raw'][0], 0.37, places=5)
+        self.assertAlmostEqual(readings['temp'][0], 61.88, places=4)
+        self.assertEqual(list(sends['status']), [200] * len(sends))
+        self.assertAlmostEqual(sends['temp'][0], 61.88, places=4)
+        # The last send is the rem_mode release, which carries no temperature
+        self.assertTrue(numpy.isnan(sends['temp'][-1]))
+
+    def test_mainAdaptive(self):
+        """Tests that main reads less often while the temperature is flat"""
+        import signal
+        from threading import Thread
+        for name, value in (('adaptive_sampling', True),
+                            ('adaptive_max_interval', 1)):
+            self.addCleanup(setattr, thermo_daemon, name,
+                            getattr(thermo_daemon, name))
+            setattr(thermo_daemon, name, value)
+        thermo_daemon.metrics = thermo_daemon.thermo_metrics.DaemonMetrics()
+        metrics = thermo_daemon.metrics
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        Thread(target=main_signal, args=(3,)).start()
+        thermo_daemon.main(self.tstat, read_freq=0.1, send_freq=10)
+        # 30 reads at a fixed 0.1s
+        self.assertLess(self.read.call_count, 15)
+        self.assertEqual(metrics.read_interval.value, 1)
+        self.assertAlmostEqual(metrics.avgtemp.value, 61.88, places=4)
+
+    def test_mainOutbox(self):
+        """Tests that a release which couldn't be sent goes out next time"""
+        import os
+        import shutil
+        import signal
+        import tempfile
+        from threading import Thread
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        thermo_daemon.outbox_file = os.path.join(directory, 'outbox')
+        self.addCleanup(setattr, thermo_daemon, 'outbox_file', None)
+        url = "http://10.0.0.21/tstat/remote_temp"
+        response = self.client.post.return_value
+
+        def unreachable_for_release(url, data=None, **kwargs):
+            if 'rem_mode' in data:
+                raise IOError("Network is unreachable")
+            return response
+        self.client.post.side_effect = unreachable_for_release
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        Thread(target=main_signal, args=(1,)).start()
+        thermo_daemon.main(self.tstat, read_freq=0.1, send_freq=5)
+        self.logging.warning.assert_any_call(
+            "The rem_mode release will be sent on the next start, from %s",
+            thermo_daemon.outbox_file)
+
+        self.client.post.side_effect = None
+        self.client.post.reset_mock()
+        Thread(target=main_signal, args=(1,)).start()
+        thermo_daemon.main(self.tstat, read_freq=0.1, send_freq=5)
+        self.assertEqual(self.client.post.call_args_list[0],
+                         call(url, data=thermo_daemon.REM_MODE_OFF_PAYLOAD))
+        self.assertEqual(self.client.post.call_args_list[-1],
+                         call(url, data=thermo_daemon.REM_MODE_OFF_PAYLOAD))
+        import thermo_outbox
+        outbox = thermo_outbox.Outbox(thermo_daemon.outbox_file)
+        self.assertEqual(outbox.entries(), [])
+        outbox.close()
+
+    def test_mainSampler(self):
+        """Tests that main works from a separate sampler process"""
+        import os
+        import signal
+        import thermo_shm
+        from threading import Thread
+        from time import sleep
+        name = 'remote_thermo_test_%d' % os.getpid()
+        for setting, value in (('sampler_process', True),
+                               ('sampler_name', name)):
+            self.addCleanup(setattr, thermo_daemon, setting,
+                            getattr(thermo_daemon, setting))
+            setattr(thermo_daemon, setting, value)
+        thermo_daemon.metrics = thermo_daemon.thermo_metrics.DaemonMetrics()
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        real_poll = thermo_shm.Consumer.poll
+        polls = []
+
+        def poll(consumer):
+            polls.append(consumer)
+            if len(polls) == 1:
+                # Ticking before the sampler has read anything
+                return numpy.zeros(0, thermo_shm.RECORD_DTYPE)
+            if len(polls) == 2:
+                # Falling behind it, to get several readings at once
+                sleep(0.2)
+            return real_poll(consumer)
+        Thread(target=main_signal, args=(1,)).start()
+        with patch('thermo_shm.Consumer.poll', poll):
+            self.assertEqual(thermo_daemon.main(self.tstat, read_freq=0.05,
+                                                send_freq=4), 0)
+        self.assertGreater(len(polls), 1)
+        self.client.post.assert_any_call(
+            "http://10.0.0.21/tstat/remote_temp",
+            data="{\"rem_temp\": 61.88 }")
+        self.assertEqual(thermo_daemon.metrics.adc_raw.value, 0.37)
+        # Only the sampler reads the ADC, even for the first average
+        self.read.assert_not_called()
+        self.assertFalse(os.path.exists('/dev/shm/' + name))
+
+    def test_mainSamplerDies(self):
+        """Tests that main gives up, releasing remote mode, without a
+        sampler"""
+        import os
+        import thermo_shm
+        name = 'remote_thermo_test_%d' % os.getpid()
+        for setting, value in (('sampler_process', True),
+                               ('sampler_name', name)):
+            self.addCleanup(setattr, thermo_daemon, setting,
+                            getattr(thermo_daemon, setting))
+            setattr(thermo_daemon, setting, value)
+
+        def poll(consumer):
+            process = thermo_daemon._sampler[1]
+            # It ignores SIGTERM, leaving it to the daemon
+            process.kill()
+            process.join()
+            return numpy.zeros(0, thermo_shm.RECORD_DTYPE)
+        with patch('thermo_shm.Consumer.poll', poll):
+            self.assertEqual(thermo_daemon.main(self.tstat, read_freq=0.05),
+                             1)
+        self.logging.critical.assert_called_once_with(
+            "The sampler process died (exit code %s); exiting", -9)
+        self.assertEqual(self.client.post.call_args_list[-1],
+                         call("http://10.0.0.21/tstat/remote_temp",
+                              data=thermo_daemon.REM_MODE_OFF_PAYLOAD))
+        self.assertIsNone(thermo_daemon._sampler)
+        self.assertFalse(os.path.exists('/dev/shm/' + name))
+
+    def test_samplerReads(self):
+        """Tests what the sampler process reads and how it's configured"""
+        self.addCleanup(setattr, thermo_daemon, 'calibration',
+                        thermo_daemon.calibration)
+        self.assertEqual(thermo_daemon._sample(), (0.37, 61.88))
+        thermo_daemon._configure_sampler({'calibration': 2, 'read_freq': 5})
+        self.assertEqual(thermo_daemon.calibration, 2)
+        self.assertFalse(hasattr(thermo_daemon, 'read_freq'))
+
+    def test_setupBadConfig(self):
+        """Tests that setup stops on a config file it can't use"""
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'daemon.json')
+        with open(path, 'w') as f:
+            f.write('{"decay_factor": 2}')
+        thermo_daemon.config_file = path
+        self.addCleanup(setattr, thermo_daemon, 'config_file', None)
+        self.addCleanup(setattr, thermo_daemon, 'reloader', None)
+        self.assertIsNone(thermo_daemon.setup())
+        self.logging.critical.assert_called_once_with(
+            "Unable to load settings from %s: %s", path, mock.ANY)
+        self.setup.assert_not_called()
+
+    def test_mainReload(self):
+        """
+        Tests that SIGHUP changes settings without reconnecting or
+        resetting the average
+        """
+        import json
+        import os
+        import shutil
+        import signal
+        import tempfile
+        from threading import Thread
+        from time import sleep
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'daemon.json')
+        with open(path, 'w') as f:
+            json.dump({'calibration': 0, 'read_freq': 0.05}, f)
+        thermo_daemon.config_file = path
+        self.addCleanup(setattr, thermo_daemon, 'config_file', None)
+        self.addCleanup(setattr, thermo_daemon, 'reloader', None)
+        self.addCleanup(setattr, thermo_daemon, 'calibration', 0)
+        self.addCleanup(setattr, thermo_daemon, 'decay_factor',
+                        thermo_daemon.decay_factor)
+        self.addCleanup(signal.signal, signal.SIGHUP, signal.SIG_DFL)
+        with patch('signal.signal'), patch('thermo_config.logger'):
+            thermo_daemon.setup()
+        signal.signal(signal.SIGHUP, thermo_daemon.handle_reload)
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        thermo_daemon.metrics = thermo_daemon.thermo_metrics.DaemonMetrics()
+        metrics = thermo_daemon.metrics
+
+        def retune():
+            sleep(0.5)
+            with open(path, 'w') as f:
+                json.dump({'calibration': 10, 'decay_factor': 0.05,
+                           'read_freq': 0.1, 'metrics_port': 9100}, f)
+            os.kill(os.getpid(), signal.SIGHUP)
+            main_signal(1)
+        Thread(target=retune).start()
+        # Overridden by the config file
+        with patch('thermo_config.logger') as config_logging:
+            thermo_daemon.main(self.tstat, read_freq=5, send_freq=5)
+        thermo_daemon.radiotherm.get_thermostat.assert_called_once_with()
+        self.setup.assert_called_once_with()
+        self.assertEqual(thermo_daemon.calibration, 10)
+        self.assertEqual(thermo_daemon.decay_factor, 0.05)
+        self.assertIsNone(thermo_daemon.metrics_port)
+        self.assertEqual(metrics.read_interval.value, 0.1)
+        # About 10 reads at 0.05 weight since the change: on the way to
+        # 71.88, not restarted there
+        self.assertGreater(metrics.avgtemp.value, 63)
+        self.assertLess(metrics.avgtemp.value, 70)
+        self.assertEqual(thermo_daemon.reloader.stats(),
+                         {'reloads': 1, 'failures': 0})
+        config_logging.warning.assert_called_once_with(
+            "%s changed in %s; it takes effect on restart", 'metrics_port',
+            path)
+
+    def test_mainReloadUnusable(self):
+        """Tests that settings which can't be applied are rolled back"""
+        import json
+        import os
+        import shutil
+        import signal
+        import tempfile
+        import thermo_config
+        from threading import Thread
+        from time import sleep
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'daemon.json')
+        with open(path, 'w') as f:
+            json.dump({'read_freq': 0.05}, f)
+        for setting in ('sensors', 'calibration', 'config_file', 'reloader'):
+            self.addCleanup(setattr, thermo_daemon, setting,
+                            getattr(thermo_daemon, setting))
+        thermo_daemon.config_file = path
+        thermo_daemon.reloader = thermo_config.Reloader(path, thermo_daemon)
+        thermo_daemon.reloader.start()
+        thermo_daemon.metrics = thermo_daemon.thermo_metrics.DaemonMetrics()
+
+        def rewire():
+            sleep(0.3)
+            with open(path, 'w') as f:
+                json.dump({'read_freq': 0.1, 'calibration': 10,
+                           'sensors': {'P9_40': {}, 'P9_39': {}}}, f)
+            thermo_daemon.handle_reload(signal.SIGHUP, None)
+            main_signal(1)
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        unusable = patch('thermo_aggregate.SensorArray',
+                         side_effect=ValueError("No such channel"))
+        with patch('thermo_config.logger'), unusable:
+            Thread(target=rewire).start()
+            thermo_daemon.main(self.tstat, read_freq=1, send_freq=4)
+        self.logging.exception.assert_called_once_with(
+            "Unable to apply the settings from %s; keeping the old ones",
+            path)
+        self.assertIsNone(thermo_daemon.sensors)
+        self.assertEqual(thermo_daemon.calibration, 0)
+        self.assertEqual(thermo_daemon.reloader.settings, {'read_freq': 0.05})
+        self.assertEqual(thermo_daemon.metrics.read_interval.value, 0.05)
+        self.assertEqual(thermo_daemon.reloader.stats(),
+                         {'reloads': 0, 'failures': 1})
+        # Read on with the old settings
+        self.assertAlmostEqual(thermo_daemon.metrics.avgtemp.value, 61.88)
+
+    def test_reconfigureAdaptive(self):
+        """Tests that a reload starts adaptive sampling over"""
+        import thermo_adaptive
+        import thermo_policy
+        import thermo_ticker
+        self.addCleanup(setattr, thermo_daemon, 'adaptive_slope',
+                        thermo_daemon.adaptive_slope)
+        thermo_daemon.adaptive_slope = 2
+        thermo_daemon.metrics = thermo_daemon.thermo_metrics.DaemonMetrics()
+        adaptive = thermo_adaptive.AdaptiveInterval(1, 15, 0.5, 0.5)
+        adaptive.interval = 8
+        reader = thermo_ticker.Ticker(1)
+        send_timer = thermo_ticker.Ticker(30)
+        self.assertEqual(thermo_daemon.reconfigure(
+            {'read_freq': 2, 'adaptive_slope': 2}, 1, 30, reader,
+            send_timer, thermo_policy.SendPolicy(), adaptive), (2, 30))
+        self.assertEqual((adaptive.min_interval, adaptive.interval,
+                          adaptive.slope_threshold), (2, 2, 2))
+        self.assertEqual((reader.period, send_timer.period), (2, 60))
+
+    def test_reloadWithoutConfig(self):
+        """Tests that SIGHUP without a config file is only logged"""
+        from signal import SIGHUP
+        self.assertIsNone(thermo_daemon.reloader)
+        thermo_daemon.handle_reload(SIGHUP, None)
+        self.logging.warning.assert_called_once_with(
+            "Recieved signal %d, but there's no config_file to reload",
+            SIGHUP)
+
+    def test_run(self):
+        """Tests that the command line sets the daemon up and runs it"""
+        for setting in ('config_file', 'rediscover'):
+            self.addCleanup(setattr, thermo_daemon, setting,
+                            getattr(thermo_daemon, setting))
+        with patch('thermo_daemon.setup', return_value=self.tstat), \
+                patch('thermo_daemon.main', return_value=0) as main:
+            self.assertEqual(thermo_daemon.run(
+                ['--config', '/etc/remote_thermo/daemon.json',
+                 '--rediscover']), 0)
+        main.assert_called_once_with(self.tstat)
+        self.assertEqual(thermo_daemon.config_file,
+                         '/etc/remote_thermo/daemon.json')
+        self.assertTrue(thermo_daemon.rediscover)
+        with patch('thermo_daemon.setup', return_value=None), \
+                patch('thermo_daemon.main') as main:
+            self.assertEqual(thermo_daemon.run([]), 1)
+        main.assert_not_called()
+
+    def test_mainReloadSampler(self):
+        """Tests that a reload sends the sampler the new settings"""
+        import json
+        import os
+        import shutil
+        import signal
+        import tempfile
+        import thermo_config
+        from threading import Thread
+        from time import sleep
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'daemon.json')
+        name = 'remote_thermo_test_%d' % os.getpid()
+        with open(path, 'w') as f:
+            json.dump({'sampler_process': True, 'sampler_name': name,
+                       'decay_factor': 1}, f)
+        for setting in ('sampler_process', 'sampler_name', 'decay_factor',
+                        'calibration', 'reloader'):
+            self.addCleanup(setattr, thermo_daemon, setting,
+                            getattr(thermo_daemon, setting))
+        thermo_daemon.reloader = thermo_config.Reloader(path, thermo_daemon)
+        thermo_daemon.reloader.start()
+        thermo_daemon.metrics = thermo_daemon.thermo_metrics.DaemonMetrics()
+
+        def recalibrate():
+            sleep(0.5)
+            with open(path, 'w') as f:
+                json.dump({'calibration': 10}, f)
+            thermo_daemon.handle_reload(signal.SIGHUP, None)
+            main_signal(1)
+        signal.signal(signal.SIGTERM, thermo_daemon.handle_exit)
+        buffers = patch('thermo_shm.SampleBuffer',
+                        wraps=thermo_daemon.thermo_shm.SampleBuffer)
+        with patch('thermo_config.logger'), buffers as buffers:
+            Thread(target=recalibrate).start()
+            thermo_daemon.main(self.tstat, read_freq=0.05, send_freq=4)
+        self.assertAlmostEqual(thermo_daemon.metrics.avgtemp.value, 71.88)
+        # One sampler throughout, so readers keep their segment
+        self.assertEqual(buffers.call_count, 1)
+        self.assertFalse(os.path.exists('/dev/shm/' + name))
+
+    def test_traceSignals(self):
+        """Tests that SIGUSR1 dumps the trace and SIGUSR2 profiles"""
+        import glob
+        import os
+        import shutil
+        import tempfile
+        from signal import SIGUSR1, SIGUSR2
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, thermo_daemon, 'trace_dir',
+                        thermo_daemon.trace_dir)
+        self.addCleanup(setattr, thermo_daemon, 'profiler', None)
+        thermo_daemon.trace_dir = directory
+        thermo_daemon.record_sends()('rem_temp', '{"rem_temp": 61.88 }', 200)
+        thermo_daemon.handle_dump(SIGUSR1, None)
+        thermo_daemon.handle_profile(SIGUSR2, None)
+        thermo_daemon.handle_profile(SIGUSR2, None)
+        dumps = glob.glob(os.path.join(directory, '*-trace-*.txt'))
+        self.assertEqual(len(dumps), 1)
+        with open(dumps[0]) as f:
+            self.assertIn(" send 200 61.8800 ", f.read())
+        self.assertEqual(len(glob.glob(os.path.join(directory, '*.prof'))),
+                         1)
+        thermo_daemon.trace_dir = os.path.join(directory, 'missing')
+        thermo_daemon.handle_dump(SIGUSR1, None)
+        thermo_daemon.handle_profile(SIGUSR2, None)
+        thermo_daemon.handle_profile(SIGUSR2, None)
+        self.assertEqual(self.logging.error.call_count, 2)
 
     def test_exitOnSIGTERM(self):
         """Tests that the handler for SIGTERM functions correctly."""
@@ -188,7 +762,7 @@ class test_Application(unittest.TestCase):
     def test_main_HTTP_400(self):
         """Test that we properly throw a warning on HTTP 400+"""
         import signal
-        r = thermo_daemon.requests.post.return_value  # Mock request object
+        r = self.client.post.return_value  # Mock request object
         r.text = "Not found"
         r.status_code = 400
         from threading import Thread
@@ -197,10 +771,2132 @@ class test_Application(unittest.TestCase):
         t = Thread(target=main_signal)
         t.start()
         thermo_daemon.main(self.tstat, send_freq=2)
-        self.logging.warning.assert_any_call(
+        self.sender_logging.warning.assert_any_call(
             "Server returned an HTTP error code (%d): %s",
             r.status_code, r.text
         )
 
+
+class test_AsyncEngine(unittest.TestCase):
+    """Tests for the asyncio multi-thermostat engine."""
+
+    def setUp(self):
+        """Replaces the engine's HTTP post with a recorder"""
+        import asyncio
+        import thermo_async
+        self.loop = asyncio.new_event_loop()
+        self.posts = []
+        self.real_post = thermo_async.post
+
+        async def fake_post(address, path, data, timeout=None):
+            self.posts.append((address, path, data))
+            return 200, "{ \"success\": 0 }"
+        p_post = patch('thermo_async.post', fake_post)
+        p_post.start()
+        self.addCleanup(p_post.stop)
+        self.addCleanup(self.loop.close)
+
+    def run_engine(self, engine, duration):
+        """Runs an engine for duration seconds, then stops it."""
+        self.loop.call_later(duration, engine.stop)
+        self.loop.run_until_complete(engine.run())
+
+    def test_pairingsRunIndependently(self):
+        """Each pairing sends its own temperature, then releases rem_mode"""
+        import thermo_async
+        engine = thermo_async.Engine([
+            thermo_async.Pairing("den", "10.0.0.21", read=lambda: 0.37,
+                                 read_freq=0.01, send_freq=2),
+            thermo_async.Pairing("attic", "10.0.0.22", read=lambda: 0.40,
+                                 read_freq=0.01, send_freq=3),
+        ])
+        self.run_engine(engine, 0.2)
+        self.assertIn(("10.0.0.21", "tstat/remote_temp",
+                       '{"rem_temp": 61.88 }'), self.posts)
+        self.assertIn(("10.0.0.22", "tstat/remote_temp",
+                       '{"rem_temp": 71.60 }'), self.posts)
+        self.assertEqual(self.posts[-2:].count(
+            ("10.0.0.21", "tstat/remote_temp", '{"rem_mode": 0}')), 1)
+        self.assertEqual(self.posts[-2:].count(
+            ("10.0.0.22", "tstat/remote_temp", '{"rem_mode": 0}')), 1)
+        for pairing in engine.pairings:
+            self.assertGreater(pairing.reads, 5)
+            self.assertGreater(pairing.sends, 0)
+
+    def test_pairingFailureReleases(self):
+        """A failing read is logged at once and still releases rem_mode"""
+        import thermo_async
+
+        def broken():
+            raise RuntimeError("ADC gone")
+        engine = thermo_async.Engine([
+            thermo_async.Pairing("den", "10.0.0.21", read=broken,
+                                 read_freq=0.01)])
+        logged_early = []
+        with patch('thermo_async.logger') as logging:
+            self.loop.call_later(0.05, lambda: logged_early.append(
+                logging.exception.called))
+            self.run_engine(engine, 0.1)
+        self.assertEqual(logged_early, [True])
+        logging.exception.assert_called_once_with(
+            "%s: read loop failed", "den")
+        self.assertEqual(self.posts, [
+            ("10.0.0.21", "tstat/remote_temp", '{"rem_mode": 0}')])
+
+    def test_post(self):
+        """The non-blocking post speaks HTTP to a real socket"""
+        import asyncio
+        import thermo_async
+        received = []
+
+        async def handle(reader, writer):
+            received.append(await reader.readuntil(b"\r\n\r\n"))
+            writer.write(b"HTTP/1.1 404 Not Found\r\n\r\nNot found")
+            await writer.drain()
+            writer.close()
+
+        async def exchange():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                return await self.real_post(
+                    '127.0.0.1:%d' % port, 'tstat/remote_temp', '{}')
+
+        status, text = self.loop.run_until_complete(exchange())
+        self.assertEqual((status, text), (404, "Not found"))
+        self.assertTrue(received[0].startswith(b"POST /tstat/remote_temp "))
+
+
+class StubThermostatHandler(BaseHTTPRequestHandler):
+    """A keep-alive HTTP handler answering like a thermostat would"""
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Answers any GET with a model"""
+        self._reply(b'{"model": "CT50 V1.94"}')
+
+    def do_POST(self):
+        """Answers any POST with success"""
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._reply(b'{ "success": 0 }')
+
+    def log_message(self, *args):
+        """Keeps the test output quiet"""
+        pass
+
+
+class test_PooledClient(unittest.TestCase):
+    """Tests for the pooled HTTP client, against a local stub server."""
+
+    def setUp(self):
+        """Starts a stub server in a thread"""
+        from threading import Thread
+        self.server = HTTPServer(('127.0.0.1', 0), StubThermostatHandler)
+        self.addCleanup(self.server.server_close)
+        t = Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(self.server.shutdown)
+        self.base = "http://127.0.0.1:%d/" % self.server.server_port
+
+    def test_reusesConnections(self):
+        """Repeated posts share one keep-alive connection"""
+        import thermo_http
+        client = thermo_http.PooledClient()
+        self.addCleanup(client.close)
+        for _ in range(5):
+            r = client.post(self.base + "tstat/remote_temp",
+                            data='{"rem_temp": 70.00 }')
+            self.assertEqual(r.status_code, 200)
+        self.assertEqual(client.stats(), {
+            'requests': 5,
+            'new_connections': 1,
+            'reused_connections': 4,
+        })
+
+    def test_attach(self):
+        """radiotherm fields work through the pool"""
+        import radiotherm
+        import thermo_http
+        client = thermo_http.PooledClient()
+        self.addCleanup(client.close)
+        tstat = radiotherm.thermostat.CommonThermostat(
+            "127.0.0.1:%d" % self.server.server_port)
+        client.attach(tstat)
+        self.assertEqual(tstat.model['raw'], "CT50 V1.94")
+        tstat.rem_mode = 0
+        self.assertEqual(client.stats()['requests'], 2)
+
+
+class test_Sender(unittest.TestCase):
+    """Tests for the background sender and its latest-value queue."""
+
+    def test_queueCoalescesAndDrops(self):
+        """Same-key puts replace in place; a full queue drops the oldest"""
+        import thermo_sender
+        q = thermo_sender.LatestValueQueue(maxsize=2)
+        q.put('rem_temp', 1)
+        q.put('rem_temp', 2)
+        q.put('rem_mode', 0)
+        q.put('led', 4)
+        self.assertEqual((q.coalesced, q.dropped, q.qsize()), (1, 1, 2))
+        self.assertEqual(q.get(), ('rem_mode', 0))
+        self.assertEqual(q.get(), ('led', 4))
+        self.assertIsNone(q.get(timeout=0.01))
+
+    @patch('thermo_sender.logger')
+    def test_slowThermostatDoesNotBlockSubmit(self, logger):
+        """submit() returns immediately while a post is stuck in flight"""
+        import thermo_sender
+        from threading import Event
+        from time import time
+        release = Event()
+        r = mock.Mock(status_code=200, text="")
+
+        def slow_post(url, data=None):
+            release.wait(5)
+            return r
+        client = mock.Mock()
+        client.post.side_effect = slow_post
+        sender = thermo_sender.Sender(client, "http://10.0.0.21/tstat")
+        sender.start()
+        start = time()
+        for i in range(10):
+            sender.submit('{"rem_temp": %d }' % i)
+        self.assertLess(time() - start, 1)
+        release.set()
+        sender.stop(timeout=5)
+        stats = sender.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertGreater(stats['coalesced'], 0)
+        self.assertEqual(stats['sent'], client.post.call_count)
+
+    @patch('thermo_sender.logger')
+    def test_unexpectedErrorKeepsSending(self, logger):
+        """A post failing oddly is logged and the worker carries on"""
+        import thermo_sender
+        from threading import Event
+        done = Event()
+        r = mock.Mock(status_code=200, text="")
+        client = mock.Mock()
+        client.post.side_effect = [ValueError("Bad response body"), r]
+        sender = thermo_sender.Sender(client, "http://10.0.0.21/tstat",
+                                      on_result=lambda *args: done.set())
+        sender.start()
+        sender.submit('{"rem_temp": 1 }')
+        while client.post.call_count < 1:
+            done.wait(0.01)
+        sender.submit('{"rem_temp": 2 }')
+        self.assertTrue(done.wait(5))
+        sender.stop(timeout=5)
+        logger.exception.assert_called_once_with(
+            "Unexpected error sending %s", 'rem_temp')
+        self.assertEqual((sender.sent, sender.errors), (1, 1))
+
+
+class FakeClock(object):
+    """A settable stand-in for time.monotonic"""
+
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class test_Ticker(unittest.TestCase):
+    """Tests for the deadline based read scheduler."""
+
+    def test_noDrift(self):
+        """Time spent working doesn't push later deadlines back"""
+        import thermo_ticker
+        clock = FakeClock()
+        ticker = thermo_ticker.Ticker(1, start=clock.now, clock=clock)
+        self.assertEqual(ticker.timeout(), 1)
+        clock.now += 1.25  # woke late
+        self.assertEqual(ticker.tick(), 0.25)
+        clock.now += 0.5  # work done during the tick
+        self.assertEqual(ticker.timeout(), 0.25)
+        self.assertEqual(ticker.deadline, 102)
+
+    def test_skipPolicy(self):
+        """SKIP drops whole missed periods and counts them"""
+        import thermo_ticker
+        clock = FakeClock()
+        ticker = thermo_ticker.Ticker(1, thermo_ticker.SKIP, clock.now, clock)
+        clock.now += 3.5
+        ticker.tick()
+        self.assertEqual(ticker.deadline, 104)
+        stats = ticker.stats()
+        self.assertEqual((stats['ticks'], stats['missed']), (1, 2))
+        self.assertEqual(stats['max_lateness'], 2.5)
+
+    def test_catchUpPolicy(self):
+        """CATCH_UP fires every missed tick back to back"""
+        import thermo_ticker
+        clock = FakeClock()
+        ticker = thermo_ticker.Ticker(1, thermo_ticker.CATCH_UP, clock.now,
+                                      clock)
+        clock.now += 3.5
+        fired = 0
+        while ticker.due():
+            ticker.tick()
+            fired += 1
+        self.assertEqual(fired, 3)
+        self.assertEqual(ticker.timeout(), 0.5)
+        self.assertEqual(ticker.stats()['missed'], 0)
+
+    def test_badPolicy(self):
+        """Unknown policies are rejected"""
+        import thermo_ticker
+        with self.assertRaises(ValueError):
+            thermo_ticker.Ticker(1, 'sometimes')
+
+    def test_setPeriod(self):
+        """A new period applies from the last deadline"""
+        import thermo_ticker
+        clock = FakeClock()
+        ticker = thermo_ticker.Ticker(1, start=clock.now, clock=clock)
+        clock.now += 1
+        ticker.tick()
+        ticker.set_period(4)
+        self.assertEqual(ticker.deadline, 105)
+        ticker.set_period(0.5)
+        self.assertEqual(ticker.deadline, 101.5)
+        with self.assertRaises(ValueError):
+            ticker.set_period(0)
+
+
+class test_SendPolicy(unittest.TestCase):
+    """Tests for deadband/heartbeat send suppression."""
+
+    def test_noDeadbandSendsEverything(self):
+        """Without a deadband nothing is suppressed"""
+        import thermo_policy
+        policy = thermo_policy.SendPolicy()
+        for _ in range(3):
+            self.assertTrue(policy.should_send(70.0))
+            policy.sent(70.0)
+        self.assertEqual(policy.stats()['suppressed'], 0)
+
+    def test_deadband(self):
+        """Small changes are suppressed, larger ones go through"""
+        import thermo_policy
+        clock = FakeClock()
+        policy = thermo_policy.SendPolicy(deadband=0.5, clock=clock)
+        self.assertTrue(policy.should_send(70.0))
+        policy.sent(70.0)
+        self.assertFalse(policy.should_send(70.4))
+        self.assertFalse(policy.should_send(69.6))
+        self.assertTrue(policy.should_send(70.6))
+        policy.sent(70.6)
+        self.assertFalse(policy.should_send(70.2))
+        self.assertEqual(policy.stats(),
+                         {'sent': 2, 'heartbeats': 0, 'suppressed': 3})
+
+    def test_heartbeat(self):
+        """An unchanged value is resent once the heartbeat expires"""
+        import thermo_policy
+        clock = FakeClock()
+        policy = thermo_policy.SendPolicy(deadband=0.5, heartbeat=60,
+                                          clock=clock)
+        self.assertTrue(policy.should_send(70.0))
+        policy.sent(70.0)
+        clock.now += 59
+        self.assertFalse(policy.should_send(70.0))
+        clock.now += 1
+        self.assertTrue(policy.should_send(70.0))
+        policy.sent(70.0)
+        clock.now += 30
+        self.assertFalse(policy.should_send(70.0))
+        self.assertEqual(policy.stats(),
+                         {'sent': 2, 'heartbeats': 1, 'suppressed': 2})
+
+    def test_unsentValueOfferedAgain(self):
+        """A value which didn't get through isn't suppressed as sent"""
+        import thermo_policy
+        clock = FakeClock()
+        policy = thermo_policy.SendPolicy(deadband=0.5, heartbeat=60,
+                                          clock=clock)
+        self.assertTrue(policy.should_send(70.0))
+        policy.sent(70.0)
+        clock.now += 10
+        self.assertTrue(policy.should_send(71.0))
+        # The post failed, so no sent(); the same value goes again
+        clock.now += 10
+        self.assertTrue(policy.should_send(71.0))
+        self.assertEqual(policy.stats()['sent'], 1)
+
+    def test_daemonReportsAcceptedPosts(self):
+        """Only rem_temp posts the thermostat accepted count as sent"""
+        import thermo_policy
+        policy = thermo_policy.SendPolicy(deadband=0.5)
+        on_result = thermo_daemon.record_sends(policy=policy)
+        on_result('rem_temp', '{"rem_temp": 70.00 }', None)
+        on_result('rem_temp', '{"rem_temp": 70.00 }', 500)
+        on_result('rem_mode', '{"rem_mode": 0}', 200)
+        self.assertIsNone(policy.last_value)
+        on_result('rem_temp', '{"rem_temp": 70.00 }', 200)
+        self.assertEqual((policy.last_value, policy.sends), (70.0, 1))
+
+    def test_daemonRecordsUnparseablePosts(self):
+        """A payload which isn't JSON is recorded with no temperature"""
+        ring = mock.Mock()
+        policy = mock.Mock()
+        thermo_daemon.record_sends(ring, policy)('rem_temp', 'not json', 200)
+        policy.sent.assert_not_called()
+        ring.record_send.assert_called_once_with(mock.ANY, 200)
+        self.assertTrue(numpy.isnan(ring.record_send.call_args[0][0]))
+
+
+class test_Filters(unittest.TestCase):
+    """Tests for the oversampling filter chain."""
+
+    def test_reducers(self):
+        """Median and trimmed mean ignore outliers, mean doesn't"""
+        import numpy
+        import thermo_filters
+        burst = [0.30, 0.31, 0.99, 0.29, 0.30, 0.0]
+        self.assertAlmostEqual(
+            thermo_filters.median(numpy.array(burst)), 0.30)
+        self.assertAlmostEqual(
+            thermo_filters.TrimmedMean(0.2)(numpy.array(burst)), 0.30)
+        self.assertAlmostEqual(
+            thermo_filters.mean(numpy.array(burst)), 0.365)
+        with self.assertRaises(ValueError):
+            thermo_filters.TrimmedMean(0.5)
+
+    def test_stages(self):
+        """Smoothing stages carry state between ticks"""
+        import thermo_filters
+        ema = thermo_filters.Ema(0.5)
+        self.assertEqual([ema(v) for v in (1.0, 0.0, 0.0)], [1.0, 0.5, 0.25])
+        kalman = thermo_filters.Kalman(process_var=0, measurement_var=1)
+        for v in (1.0, 0.0, 1.0, 0.0):
+            value = kalman(v)
+        self.assertAlmostEqual(value, 0.5)
+
+    def test_burstSampler(self):
+        """A sampler reuses its buffer and feeds the whole chain"""
+        import thermo_filters
+        readings = iter([0.1, 0.2, 0.9] * 2)
+        chain = thermo_filters.FilterChain(thermo_filters.median,
+                                           [thermo_filters.Ema(0.5)])
+        sampler = thermo_filters.BurstSampler(lambda: next(readings), 3,
+                                              chain)
+        buf = sampler.buffer
+        self.assertAlmostEqual(sampler(), 0.2)
+        self.assertAlmostEqual(sampler(), 0.2)
+        self.assertIs(sampler.buffer, buf)
+
+
+class test_SensorBackends(unittest.TestCase):
+    """Tests for the IIO and replay sensor backends."""
+
+    def test_iio(self):
+        """IIO reads keep the file open and see new values"""
+        import os
+        import tempfile
+        import thermo_sensors
+        device = tempfile.mkdtemp()
+        path = os.path.join(device, 'in_voltage1_raw')
+        with open(path, 'w') as f:
+            f.write("4095\n")
+        backend = thermo_sensors.IIOBackend(device)
+        self.addCleanup(backend.close)
+        backend.setup()
+        self.assertEqual(backend.read('P9_40'), 1.0)
+        with open(path, 'w') as f:
+            f.write("0\n")
+        self.assertEqual(backend.read('AIN1'), 0.0)
+        self.assertEqual(len(backend._fds), 2)
+        with self.assertRaises(ValueError):
+            backend.read('P8_1')
+        for raw, expected in (("2048", 2048 / 4095.0), ("", None),
+                              ("12x\n", None), ("-1\n", None)):
+            with open(path, 'w') as f:
+                f.write(raw)
+            if expected is None:
+                with self.assertRaises(ValueError):
+                    backend.read('AIN1')
+            else:
+                self.assertAlmostEqual(backend.read('AIN1'), expected)
+
+    def test_replay(self):
+        """Replays run out unless looping"""
+        import thermo_sensors
+        backend = thermo_sensors.get_backend('replay', readings=[0.1, 0.2])
+        self.assertEqual([backend.read('P9_40') for _ in range(2)],
+                         [0.1, 0.2])
+        with self.assertRaises(EOFError):
+            backend.read('P9_40')
+        backend = thermo_sensors.ReplayBackend([0.1, 0.2], loop=True)
+        self.assertEqual([backend.read(0) for _ in range(3)],
+                         [0.1, 0.2, 0.1])
+
+    def test_unknownBackend(self):
+        """Unknown backend names are rejected"""
+        import thermo_sensors
+        with self.assertRaises(ValueError):
+            thermo_sensors.get_backend('gpio')
+
+
+class test_Discovery(unittest.TestCase):
+    """Tests for the cached thermostat discovery."""
+
+    def setUp(self):
+        """Points the cache at a scratch directory"""
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cache', 'thermostat.json')
+        p_get = patch('thermo_discovery.radiotherm.get_thermostat')
+        self.get_thermostat = p_get.start()
+        self.addCleanup(p_get.stop)
+        tstat = thermo_discovery.radiotherm.CT50v194('10.0.0.21')
+        self.get_thermostat.return_value = tstat
+        self.client = mock.Mock()
+        self.client.get.return_value.json.return_value = {
+            'model': 'CT50 V1.94'}
+
+    def test_firstStartDiscoversAndCaches(self):
+        """With no cache, full discovery runs and is remembered"""
+        thermo_discovery.get_thermostat(self.path, client=self.client)
+        self.get_thermostat.assert_called_once_with()
+        entry = thermo_discovery.load_cache(self.path)
+        self.assertEqual((entry['host'], entry['model']),
+                         ('10.0.0.21', 'CT50 V1.94'))
+
+    def test_validCacheSkipsDiscovery(self):
+        """A valid cache entry costs one request and no discovery"""
+        thermo_discovery.save_cache(self.path, '10.0.0.21', 'CT50 V1.94')
+        thermo_discovery.get_thermostat(self.path, client=self.client)
+        self.get_thermostat.assert_called_once_with('10.0.0.21',
+                                                    'CT50 V1.94')
+        self.client.get.assert_called_once_with(
+            'http://10.0.0.21/tstat/model', timeout=2)
+
+    def test_invalidCacheRediscovers(self):
+        """A different model or no answer falls back to discovery"""
+        thermo_discovery.save_cache(self.path, '10.0.0.21', 'CT80 Rev B')
+        thermo_discovery.get_thermostat(self.path, client=self.client)
+        self.get_thermostat.assert_called_with()
+        self.client.get.side_effect = IOError("Connection refused")
+        thermo_discovery.get_thermostat(self.path, client=self.client)
+        self.assertEqual(self.get_thermostat.call_count, 2)
+
+    def test_unknownModelRediscovers(self):
+        """A model radiotherm doesn't know never validates"""
+        thermo_discovery.save_cache(self.path, '10.0.0.21', 'CT99 V9.99')
+        self.client.get.return_value.json.return_value = {
+            'model': 'CT98 V9.98'}
+        tstat = thermo_discovery.get_thermostat(self.path,
+                                                client=self.client)
+        self.get_thermostat.assert_called_once_with()
+        self.assertIsNotNone(tstat)
+
+    def test_expiredOrForced(self):
+        """Stale entries and forced rediscovery skip validation"""
+        thermo_discovery.save_cache(self.path, '10.0.0.21', 'CT50 V1.94')
+        thermo_discovery.get_thermostat(self.path, ttl=-1,
+                                        client=self.client)
+        thermo_discovery.get_thermostat(self.path, client=self.client,
+                                        rediscover=True)
+        self.client.get.assert_not_called()
+        self.assertEqual(self.get_thermostat.call_count, 2)
+        thermo_discovery.clear_cache(self.path)
+        self.assertIsNone(thermo_discovery.load_cache(self.path))
+
+
+class test_Resilience(unittest.TestCase):
+    """Tests for retries and the circuit breaker."""
+
+    def setUp(self):
+        """Stubs out sleeping between retries"""
+        p_sleep = patch('thermo_resilience.sleep')
+        self.sleep = p_sleep.start()
+        self.addCleanup(p_sleep.stop)
+
+    def test_retryBacksOff(self):
+        """Retries are bounded and wait longer each time"""
+        import thermo_resilience
+        func = mock.Mock(side_effect=IOError("Connection refused"))
+        with patch('thermo_resilience.random.uniform',
+                   side_effect=lambda low, high: high):
+            with self.assertRaises(IOError):
+                thermo_resilience.retry(func, retries=3, base=1, cap=3)
+        self.assertEqual(func.call_count, 4)
+        self.sleep.assert_has_calls([call(1), call(2), call(3)])
+
+    def test_breaker(self):
+        """The breaker opens, rejects, probes and closes again"""
+        import thermo_resilience
+        clock = FakeClock()
+        breaker = thermo_resilience.CircuitBreaker(2, 30, clock)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        clock.now += 30
+        self.assertTrue(breaker.allow())  # The probe
+        self.assertFalse(breaker.allow())  # Only one at a time
+        breaker.failure()
+        self.assertEqual(breaker.state, thermo_resilience.OPEN)
+        clock.now += 30
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.stats(), {
+            'state': 'closed', 'failures': 0, 'rejected': 2,
+            'closed->open': 1, 'open->half_open': 2, 'half_open->open': 1,
+            'half_open->closed': 1,
+        })
+
+    def test_resilientClient(self):
+        """5xx counts as a failure, an open circuit stops sending"""
+        import thermo_resilience
+        client = mock.Mock()
+        client.post.return_value = mock.Mock(status_code=503, text="Busy")
+        resilient = thermo_resilience.ResilientClient(
+            client, thermo_resilience.CircuitBreaker(2, 30), retries=0)
+        for _ in range(2):
+            with self.assertRaises(thermo_resilience.ServerError):
+                resilient.post("http://10.0.0.21/tstat/remote_temp")
+        with self.assertRaises(thermo_resilience.CircuitOpenError):
+            resilient.post("http://10.0.0.21/tstat/remote_temp", retries=5)
+        self.assertEqual(client.post.call_count, 2)
+        client.post.return_value = mock.Mock(status_code=200)
+        resilient.post("http://10.0.0.21/tstat/remote_temp", force=True)
+        self.assertEqual(client.post.call_count, 3)
+
+
+class test_Metrics(unittest.TestCase):
+    """Tests for the metrics registry and its Prometheus rendering."""
+
+    def test_render(self):
+        """Histograms are cumulative, counters labelled, gauges live"""
+        import thermo_metrics
+        clock = FakeClock()
+        metrics = thermo_metrics.DaemonMetrics(clock)
+        metrics.read_latency.observe(0.0002)
+        metrics.read_latency.observe(5)
+        metrics.post_status.inc(200)
+        metrics.post_status.inc('error')
+        clock.now += 42
+        text = metrics.render()
+        self.assertIn('# TYPE thermo_read_seconds histogram\n', text)
+        self.assertIn('thermo_read_seconds_bucket{le="0.0001"} 0\n', text)
+        self.assertIn('thermo_read_seconds_bucket{le="0.00025"} 1\n', text)
+        self.assertIn('thermo_read_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('thermo_read_seconds_count 2\n', text)
+        self.assertIn('thermo_post_responses_total{code="200"} 1\n', text)
+        self.assertIn('thermo_post_responses_total{code="error"} 1\n',
+                      text)
+        self.assertIn('thermo_uptime_seconds 42.0\n', text)
+
+    def test_instrumentedClient(self):
+        """Every request is timed and its outcome counted"""
+        import thermo_metrics
+        metrics = thermo_metrics.DaemonMetrics()
+        client = mock.Mock()
+        client.post.return_value = mock.Mock(status_code=404)
+        client.get.side_effect = IOError("Timed out")
+        instrumented = thermo_metrics.InstrumentedClient(client, metrics)
+        instrumented.post("http://10.0.0.21/tstat/remote_temp", data="{}")
+        with self.assertRaises(IOError):
+            instrumented.get("http://10.0.0.21/tstat")
+        self.assertEqual(metrics.post_latency.count, 2)
+        self.assertEqual(metrics.post_status.values,
+                         {'404': 1, 'error': 1})
+
+    def test_queueingNotTimed(self):
+        """The daemon's requests are timed from leaving the queue"""
+        import thermo_metrics
+        metrics = thermo_metrics.DaemonMetrics()
+        client = mock.Mock()
+        client.post.return_value = mock.Mock(status_code=200)
+        with patch.multiple(thermo_daemon, http_client=client,
+                            metrics=metrics, request_gap=0.2,
+                            _scheduler=None):
+            scheduler = thermo_daemon.get_scheduler()
+            self.addCleanup(scheduler.close)
+            for _ in range(2):
+                scheduler.post("http://10.0.0.21/tstat/remote_temp",
+                               data="{}")
+        # The second request waited out the gap in the queue
+        self.assertGreater(metrics.queue_wait.sum, 0.1)
+        self.assertEqual(metrics.post_latency.count, 2)
+        self.assertLess(metrics.post_latency.sum, 0.1)
+
+
+class test_Benchmarks(unittest.TestCase):
+    """Smoke tests so the benchmark suite doesn't rot."""
+
+    def setUp(self):
+        """Puts back the daemon state the benchmarks replace"""
+        for name in ('_backend', 'http_client', 'exitLock'):
+            self.addCleanup(setattr, thermo_daemon, name,
+                            getattr(thermo_daemon, name))
+        p_get = patch('thermo_daemon.radiotherm.get_thermostat',
+                      REAL_GET_THERMOSTAT)
+        p_get.start()
+        self.addCleanup(p_get.stop)
+
+    @patch('thermo_daemon.logger')
+    def test_run(self, logger):
+        """A short run reports every benchmark and checks budgets"""
+        import benchmarks
+        args = benchmarks.parse_args([
+            '--duration', '0.5', '--iterations', '100', '--latency', '0.01',
+            '--max-tick-cpu', '0'])
+        results, failures = benchmarks.run(args)
+        self.assertGreater(results['read_temp']['samples_per_sec'], 0)
+        self.assertIsNotNone(results['connect']['latency']['p50'])
+        self.assertGreater(results['main']['posts'], 0)
+        self.assertGreaterEqual(
+            results['main']['post_latency']['p50'], 0.01)
+        self.assertEqual(len(failures), 1)
+
+
+class test_Emulator(unittest.TestCase):
+    """Tests for the thermostat emulator."""
+
+    def test_thermalModel(self):
+        """The HVAC reacts to the remote temperature, not the room"""
+        import thermo_emulator
+        clock = FakeClock()
+        model = thermo_emulator.ThermalModel(temp=72.0, outdoor=60.0,
+                                             clock=clock)
+        clock.now += 60
+        model.step()
+        self.assertEqual(model.tstate, 0)
+        model.set_remote(rem_temp=65.0)
+        clock.now += 600
+        model.step()
+        self.assertEqual(model.tstate, 1)
+        self.assertEqual(model.tstat()['temp'], 65.0)
+        self.assertGreater(model.temp, 72.0)
+        model.set_remote(rem_mode=0)
+        clock.now += 60
+        model.step()
+        self.assertEqual(model.tstate, 0)
+
+    def test_remoteTempExpires(self):
+        """Without fresh posts the thermostat falls back to its own sensor"""
+        import thermo_emulator
+        clock = FakeClock()
+        model = thermo_emulator.ThermalModel(rem_timeout=600, clock=clock)
+        model.set_remote(rem_temp=60.0)
+        clock.now += 601
+        model.step()
+        self.assertEqual(model.rem_mode, 0)
+
+    def test_api(self):
+        """radiotherm can talk to emulated thermostats"""
+        import radiotherm
+        import thermo_emulator
+        emulator = thermo_emulator.Emulator(2, seed=1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        tstats = [REAL_GET_THERMOSTAT(a) for a in emulator.addresses]
+        self.assertIsInstance(tstats[0], radiotherm.CT50v194)
+        tstats[0].rem_temp = 60
+        self.assertEqual(tstats[0].rem_mode['raw'], 1)
+        self.assertEqual(tstats[0].temp['raw'], 60.0)
+        self.assertEqual(tstats[1].rem_mode['raw'], 0)
+        tstats[1].t_heat = 66
+        self.assertEqual(tstats[1].t_heat['raw'], 66.0)
+        tstats[1].set_day_program('heat', 'tue', {"1": [0, 60] * 4})
+        self.assertEqual(tstats[1].program_heat['raw']['1'], [0, 60] * 4)
+
+    def test_serialisedWithInjectedFaults(self):
+        """Requests queue behind each other; errors are injected"""
+        import requests
+        import thermo_emulator
+        from concurrent.futures import ThreadPoolExecutor
+        from time import monotonic
+        emulator = thermo_emulator.Emulator(
+            1, latency=0.1, error_rate=0.5, seed=1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        url = "http://%s/tstat/model" % emulator.addresses[0]
+        start = monotonic()
+        with ThreadPoolExecutor(4) as pool:
+            codes = list(pool.map(lambda _: requests.get(url).status_code,
+                                  range(4)))
+        self.assertGreaterEqual(monotonic() - start, 0.4)
+        self.assertEqual(sorted(set(codes)), [200, 500])
+        self.assertEqual(emulator.thermostats[0].errors, codes.count(500))
+
+    def test_keepAliveAndBadRequests(self):
+        """The pooled client reuses connections; nonsense gets a 400"""
+        import socket
+        import thermo_emulator
+        import thermo_http
+        emulator = thermo_emulator.Emulator(1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        client = thermo_http.PooledClient()
+        self.addCleanup(client.close)
+        url = "http://%s/tstat/remote_temp" % emulator.addresses[0]
+        for temp in (60, 61, 62):
+            r = client.post(url, data='{"rem_temp": %d}' % temp)
+            self.assertEqual(r.status_code, 200)
+        self.assertEqual(client.stats()['new_connections'], 1)
+        self.assertEqual(emulator.thermostats[0].requests, 3)
+        tstat = emulator.thermostats[0]
+        for raw in (b"POST /tstat HTTP/1.1\r\nContent-Length: x\r\n\r\n",
+                    b"NONSENSE\r\n\r\n"):
+            sock = socket.create_connection(('127.0.0.1', tstat.port))
+            self.addCleanup(sock.close)
+            sock.sendall(raw)
+            response = b""
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+            self.assertTrue(response.startswith(b"HTTP/1.1 400 "))
+            self.assertIn(b"Connection: close", response)
+        self.assertEqual(tstat.requests, 3)
+
+
+class test_RingBuffer(unittest.TestCase):
+    """Tests for the memory-mapped ring buffer of readings."""
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'ring')
+
+    def test_wrapsInOrder(self):
+        """Once full, the oldest records are overwritten; views stay ordered"""
+        import thermo_ring
+        ring = thermo_ring.RingBuffer(self.path, capacity=4)
+        for i in range(6):
+            ring.record_reading(i / 10.0, 60 + i, when=1000 + i)
+        self.assertEqual((ring.count, len(ring)), (6, 4))
+        self.assertEqual(list(ring.snapshot()['time']),
+                         [1002, 1003, 1004, 1005])
+        self.assertEqual([len(v) for v in ring.views()], [2, 2])
+        ring.close()
+
+    def test_survivesRestart(self):
+        """Reopening the file carries on where it left off"""
+        import os
+        import thermo_ring
+        ring = thermo_ring.RingBuffer(self.path, capacity=8)
+        size = os.path.getsize(self.path)
+        ring.record_reading(0.5, 70, when=1)
+        ring.record_send(70, 200, when=2)
+        ring.close()
+        ring = thermo_ring.RingBuffer(self.path, capacity=8)
+        ring.record_send(70, -1, when=3)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(list(ring.snapshot()['status']), [0, 200, -1])
+        ring.close()
+
+    def test_readersShareMemory(self):
+        """open_ring() gives views straight into the writer's file"""
+        import thermo_ring
+        ring = thermo_ring.RingBuffer(self.path, capacity=8)
+        ring.record_reading(0.5, 70, when=1)
+        reader = thermo_ring.open_ring(self.path)
+        view = reader.views()[0]
+        self.assertTrue(numpy.shares_memory(view, reader.records))
+        self.assertEqual(reader.capacity, 8)
+        ring.record_reading(0.6, 71, when=2)
+        self.assertEqual(list(reader.snapshot()['temp']), [70, 71])
+        self.assertRaises(ValueError, view.__setitem__, 0, view[0])
+        ring.close()
+
+    @patch('thermo_ring.logger')
+    def test_capacityChangeRecreates(self, logger):
+        """A file of the wrong size or kind is replaced, not appended to"""
+        import thermo_ring
+        ring = thermo_ring.RingBuffer(self.path, capacity=8)
+        ring.record_reading(0.5, 70)
+        ring.close()
+        ring = thermo_ring.RingBuffer(self.path, capacity=16)
+        self.assertEqual((ring.capacity, ring.count), (16, 0))
+        ring.close()
+        logger.warning.assert_called_once()
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 64)
+        self.assertRaises(ValueError, thermo_ring.open_ring, self.path)
+
+
+class test_SensorArray(unittest.TestCase):
+    """Tests for combining several sensors into one temperature."""
+
+    def convert(self, raw, offsets):
+        return raw * 100 + offsets
+
+    def test_aggregates(self):
+        """Each aggregate combines calibrated channels as documented"""
+        import thermo_aggregate
+        channels = {'a': {'weight': 3}, 'b': {'calibration': 2}, 'c': {}}
+        raw = numpy.array([0.70, 0.66, 0.60])  # 70, 68 and 60 degrees
+        expected = {'weighted': 67.6, 'mean': 66, 'median': 68, 'min': 60,
+                    'max': 70}
+        for aggregate, temp in expected.items():
+            array = thermo_aggregate.SensorArray(channels, self.convert,
+                                                 aggregate)
+            self.assertAlmostEqual(array.combine(raw), temp, msg=aggregate)
+        array.set_weight('a', 0)
+        array.aggregate = 'weighted'
+        self.assertAlmostEqual(array.combine(raw), 64)
+
+    def test_outliersAndFailures(self):
+        """Far-off and unreadable channels are left out"""
+        import thermo_aggregate
+        channels = dict((c, {}) for c in 'abcd')
+        array = thermo_aggregate.SensorArray(channels, self.convert, 'mean',
+                                             outlier_threshold=3)
+        raw = numpy.array([0.70, 0.71, 0.9, numpy.nan])
+        self.assertAlmostEqual(array.combine(raw), 70.5)
+        self.assertEqual(list(array.keep), [True, True, False, False])
+        self.assertEqual(array.stats()['c'], 1)
+        raw[:] = numpy.nan
+        self.assertRaises(ValueError, array.combine, raw)
+
+    def test_readsEveryChannel(self):
+        """One pass through the backend fills the preallocated array"""
+        import thermo_aggregate
+        import thermo_sensors
+        backend = thermo_sensors.ReplayBackend([0.5, 0.6])
+        array = thermo_aggregate.SensorArray({'a': {}, 'b': {}},
+                                             self.convert, 'min')
+        raw = array.raw
+        self.assertAlmostEqual(array(backend), 50)
+        self.assertIs(array.raw, raw)
+        self.assertRaises(ValueError, thermo_aggregate.SensorArray,
+                          {'a': {}}, self.convert, 'mode')
+
+
+class test_Replay(unittest.TestCase):
+    """Tests for replaying traces through the daemon's send logic."""
+
+    def test_replayMatchesMain(self):
+        """A constant trace posts every send_freq readings, as main() does"""
+        import thermo_replay
+        result = thermo_replay.replay([0.37] * 10, send_freq=3,
+                                      decay_factor=.1, reference_window=3)
+        self.assertEqual(result['posts'],
+                         [[3.0, 61.88], [6.0, 61.88], [9.0, 61.88]])
+        stats = result['stats']
+        self.assertEqual(stats['sends']['sent'], 3)
+        self.assertAlmostEqual(stats['average_error']['max_abs'], 0)
+        self.assertEqual(stats['lag'], 0)
+
+    def test_deadbandAndLag(self):
+        """Deadband sweeps suppress posts; a slow average shows lag"""
+        import thermo_replay
+        readings = 0.5 + 0.02 * numpy.sin(numpy.arange(7200) / 1000.0)
+        loose = thermo_replay.replay(readings, send_freq=10,
+                                     send_deadband=1, decay_factor=.05)
+        tight = thermo_replay.replay(readings, send_freq=10,
+                                     decay_factor=.05)
+        self.assertLess(len(loose['posts']), len(tight['posts']))
+        self.assertGreater(loose['stats']['sends']['suppressed'], 0)
+        self.assertGreater(loose['stats']['thermostat_error']['rms'],
+                           tight['stats']['thermostat_error']['rms'])
+        # An EMA with factor a lags by about (1 - a) / a readings
+        self.assertTrue(15 <= tight['stats']['lag'] <= 23,
+                        tight['stats']['lag'])
+
+    def test_timedTraceResampled(self):
+        """A timed trace is read every read_freq seconds, not per line"""
+        import thermo_replay
+        times, readings = thermo_replay.resample(
+            numpy.array([0, 0.5, 3.0]), numpy.array([1.0, 2.0, 3.0]), 1)
+        self.assertEqual(times.tolist(), [0, 1, 2, 3])
+        self.assertEqual(readings.tolist(), [1, 2, 2, 3])
+        readings = 0.5 + 0.02 * numpy.sin(numpy.arange(3600) / 300.0)
+        timed = thermo_replay.replay(readings, numpy.arange(3600.0),
+                                     read_freq=2, send_freq=10,
+                                     send_deadband=.1, decay_factor=.05)
+        every_other = thermo_replay.replay(readings[::2], read_freq=2,
+                                           send_freq=10, send_deadband=.1,
+                                           decay_factor=.05)
+        self.assertEqual(timed['stats']['readings'], 1800)
+        self.assertEqual(timed, every_other)
+
+    def test_mainSweepsRingTrace(self):
+        """The command line replays a ring buffer over a parameter grid"""
+        import io
+        import json
+        import os
+        import shutil
+        import tempfile
+        import thermo_replay
+        import thermo_ring
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ring')
+        ring = thermo_ring.RingBuffer(path, capacity=100)
+        for i in range(60):
+            ring.record_reading(0.37, 61.88, when=1000 + i)
+            if i % 30 == 29:
+                ring.record_send(61.88, 200, when=1000 + i)
+        ring.close()
+        out = io.StringIO()
+        with patch('sys.stdout', out):
+            thermo_replay.main([path, '--decay-factor', '.1', '.2',
+                                '--deadband', 'none', '0.5', '--posts'])
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[1]['params']['deadband'], 0.5)
+        self.assertEqual(results[0]['posts'], [[1030.0, 61.88]])
+        self.assertEqual(results[0]['stats']['readings'], 60)
+
+
+class test_Aggregator(unittest.TestCase):
+    """Tests for the central aggregator and its sensor nodes."""
+
+    def test_batchEncoding(self):
+        """Batches round trip compactly; garbage is rejected"""
+        import thermo_aggregator
+        data = thermo_aggregator.encode_batch(
+            7, [(10.0, 70.5), (11.5, 71.0)], now=12.0)
+        self.assertEqual(len(data), 8 + 2 * 6)
+        node, readings = thermo_aggregator.decode_batch(data)
+        self.assertEqual(node, 7)
+        self.assertEqual(readings, [(2.0, 70.5), (0.5, 71.0)])
+        for bad in (b'', b'XX' + data[2:], data[:-1]):
+            self.assertRaises(ValueError, thermo_aggregator.decode_batch, bad)
+
+    def test_loadConfig(self):
+        """Zones post a heartbeat by default, as the daemon does"""
+        import json
+        import os
+        import shutil
+        import tempfile
+        import thermo_aggregator
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'aggregator.json')
+        with open(path, 'w') as f:
+            json.dump({'port': 0, 'deadband': 0.5, 'thermostats': [
+                {'name': 'up', 'address': '10.0.0.21', 'nodes': {'1': {}}},
+            ]}, f)
+        aggregator, port = thermo_aggregator.load_config(path)
+        policy = aggregator.zones[0].policy
+        self.assertEqual(port, 0)
+        self.assertEqual(policy.deadband, 0.5)
+        self.assertEqual(policy.heartbeat, thermo_daemon.send_heartbeat)
+
+    def test_zoneFusesFreshNodes(self):
+        """Stale nodes drop out; weights and calibrations apply"""
+        import thermo_aggregator
+        clock = FakeClock()
+        zone = thermo_aggregator.Zone(
+            'den', '10.0.0.21', {'1': {'weight': 3}, '2': {},
+                                 '3': {'calibration': -1}},
+            stale_after=60, clock=clock)
+        self.assertIsNone(zone.fuse())
+        zone.update(1, 0, 70.0)
+        zone.update(2, 0, 66.0)
+        zone.update(3, 90, 80.0)  # Already stale
+        self.assertEqual(zone.fuse(), 69.0)
+        zone.update(2, 5, 50.0)  # Older than what's there, ignored
+        zone.update(3, 0, 73.0)
+        self.assertEqual(zone.fuse(), 69.6)
+        clock.now += 61
+        self.assertIsNone(zone.fuse())
+        self.assertEqual(zone.stats()['fresh_nodes'], 0)
+
+    def test_forwardsOneStreamPerThermostat(self):
+        """Nodes' pushes reach the thermostat as one fused rem_temp"""
+        import asyncio
+        import thermo_aggregator
+        import thermo_emulator
+        emulator = thermo_emulator.Emulator(1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        model = emulator.thermostats[0].model
+        zone = thermo_aggregator.Zone('den', emulator.addresses[0],
+                                      {'1': {}, '2': {}})
+        aggregator = thermo_aggregator.Aggregator(
+            [zone, thermo_aggregator.Zone('attic', '127.0.0.1:9', {'3': {}})],
+            send_interval=0.2, timeout=1)
+        self.assertRaises(ValueError, thermo_aggregator.Aggregator,
+                          [zone, zone])
+        posted = []
+
+        async def run():
+            ports = []
+            task = asyncio.ensure_future(aggregator.run(
+                '127.0.0.1', 0, started=ports.append))
+            while not ports:
+                await asyncio.sleep(0.01)
+            address = '127.0.0.1:%d' % ports[0]
+            for node, temp in ((1, 70.0), (2, 72.0), (99, 50.0)):
+                pusher = thermo_aggregator.Pusher(address, node, 2)
+                pusher.push(temp - 1)
+                pusher.push(temp)
+                pusher.close()
+            await asyncio.sleep(0.5)
+            posted.append((model.rem_mode, model.rem_temp))
+            aggregator.stop()
+            await task
+        with patch('thermo_aggregator.logger'):
+            asyncio.run(run())
+        self.assertEqual(posted, [(1, 71.0)])
+        self.assertEqual(model.rem_mode, 0)
+        stats = aggregator.stats()
+        self.assertEqual((stats['batches'], stats['readings'],
+                          stats['unknown']), (2, 4, 1))
+        self.assertGreaterEqual(stats['zones']['den']['sends'], 2)
+        self.assertEqual(stats['zones']['attic']['sends'], 0)
+
+
+class test_Proxy(unittest.TestCase):
+    """Tests for the caching, coalescing thermostat proxy."""
+
+    def run_proxy(self, proxy, scenario):
+        """Runs scenario(address) against proxy on a fresh loop"""
+        import asyncio
+        import thermo_proxy
+
+        async def run():
+            stop = asyncio.Event()
+            ports = []
+            task = asyncio.ensure_future(thermo_proxy.run(
+                proxy, '127.0.0.1', 0, stop, ports.append))
+            while not ports:
+                await asyncio.sleep(0.01)
+            try:
+                return await scenario('127.0.0.1:%d' % ports[0])
+            finally:
+                stop.set()
+                await task
+        with patch('thermo_proxy.logger'):
+            return asyncio.run(run())
+
+    def test_cachesAndCoalesces(self):
+        """Many clients cost the thermostat one request per TTL"""
+        import asyncio
+        import json
+        import thermo_async
+        import thermo_emulator
+        import thermo_proxy
+        emulator = thermo_emulator.Emulator(1, latency=0.05)
+        emulator.start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        tstat = emulator.thermostats[0]
+        clock = FakeClock()
+        proxy = thermo_proxy.Proxy(emulator.addresses[0], state_ttl=5,
+                                   clock=clock)
+
+        async def scenario(address):
+            def get(path):
+                return thermo_async.request(address, 'GET', path)
+            results = await asyncio.gather(
+                *([get('/tstat') for _ in range(10)] +
+                  [get('/tstat/model') for _ in range(10)]))
+            counts = [tstat.requests]
+            await get('/tstat')
+            counts.append(tstat.requests)
+            clock.now += 5
+            await get('/tstat')
+            await get('/tstat/model')
+            counts.append(tstat.requests)
+            await thermo_async.post(address, '/tstat', '{"t_heat": 65}')
+            state = await get('/tstat')
+            counts.append(tstat.requests)
+            return results, counts, json.loads(state[1])
+        results, counts, state = self.run_proxy(proxy, scenario)
+        self.assertEqual(set(r[0] for r in results), set([200]))
+        self.assertEqual(json.loads(results[-1][1]),
+                         {'model': thermo_emulator.MODEL})
+        # One upstream request each for the state and model, then one more
+        # for the state once it expired, then a post and a fresh read.
+        self.assertEqual(counts, [2, 2, 3, 5])
+        self.assertEqual(state['t_heat'], 65.0)
+        stats = proxy.stats()
+        self.assertEqual(stats['coalesced'], 18)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_corsAndFailures(self):
+        """Preflights are answered locally; a dead thermostat is a 502"""
+        import asyncio
+        import thermo_async
+        import thermo_proxy
+        proxy = thermo_proxy.Proxy('127.0.0.1:9', timeout=1,
+                                   origin='http://thermo.local')
+
+        async def scenario(address):
+            return await asyncio.gather(
+                thermo_async.request(address, 'OPTIONS', '/tstat'),
+                thermo_async.request(address, 'GET', '/tstat'),
+                thermo_async.request(address, 'GET', '/tstat'))
+        results = self.run_proxy(proxy, scenario)
+        self.assertEqual([r[0] for r in results], [204, 502, 502])
+        self.assertEqual(proxy.stats()['upstream'], 1)
+        response = proxy.format_response(200, '{}')
+        self.assertIn(b"Access-Control-Allow-Origin: http://thermo.local\r\n",
+                      response)
+        self.assertTrue(response.endswith(b"\r\n\r\n{}"))
+
+    def test_streamAndProgramShareTheQueue(self):
+        """The stream and program syncs reach the thermostat via the proxy"""
+        import asyncio
+        import thermo_emulator
+        import thermo_http
+        import thermo_program
+        import thermo_proxy
+        import thermo_stream
+        emulator = thermo_emulator.Emulator(1, seed=1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        tstat = emulator.thermostats[0]
+        proxy = thermo_proxy.Proxy(emulator.addresses[0], min_gap=0.01)
+        proxy.streamer = thermo_stream.StateStreamer(
+            emulator.addresses[0], interval=0.1, upstream=proxy)
+        client = thermo_http.PooledClient()
+        self.addCleanup(client.close)
+        sat = [420, 68, 480, 68, 1080, 68, 1380, 60]
+
+        async def scenario(address):
+            host, port = address.split(':')
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(b"GET /tstat/stream HTTP/1.1\r\n\r\n")
+            head = await reader.readuntil(b"event: state\n")
+
+            def sync():
+                return thermo_program.sync_all(
+                    [client.attach(REAL_GET_THERMOSTAT(address))],
+                    {'heat': {'sat': sat}}, thermo_program.ProgramCache(None))
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, sync)
+            writer.close()
+            return head, results[address]
+        with patch('thermo_stream.logger'):
+            head, result = self.run_proxy(proxy, scenario)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertEqual(result, {'heat': ['sat']})
+        self.assertEqual(tstat.model.programs['heat']['5'], sat)
+        self.assertGreater(proxy.streamer.stats()['polls'], 0)
+        # Nothing reached the thermostat except through the proxy's queue
+        queue = proxy.stats()['queue']
+        self.assertEqual(tstat.requests, proxy.stats()['upstream'])
+        self.assertEqual(tstat.requests, queue['read']['requests'] +
+                         queue['control']['requests'])
+        self.assertEqual(queue['control']['requests'], 1)
+
+    def test_cancelledFetchAnswersWaiters(self):
+        """Cancelling the first GET gives the coalesced ones a 502"""
+        import asyncio
+        import thermo_proxy
+        proxy = thermo_proxy.Proxy('127.0.0.1:9')
+
+        async def scenario():
+            started = asyncio.Event()
+
+            async def stuck(method, path, body=None):
+                started.set()
+                await asyncio.sleep(60)
+            proxy._fetch = stuck
+            first = asyncio.ensure_future(proxy.get('/tstat'))
+            await started.wait()
+            waiters = [asyncio.ensure_future(proxy.get('/tstat'))
+                       for _ in range(2)]
+            await asyncio.sleep(0)
+            first.cancel()
+            results = await asyncio.gather(*waiters)
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            return results
+        results = asyncio.run(scenario())
+        self.assertEqual([r[0] for r in results], [502, 502])
+        self.assertEqual(proxy.inflight, {})
+
+
+class test_Stream(unittest.TestCase):
+    """Tests for streaming thermostat state to web clients."""
+
+    def test_diffState(self):
+        """Diffs hold changed and new keys; removed keys are None"""
+        import thermo_stream
+        old = {'temp': 70.0, 't_heat': 68, 'tmode': 1}
+        new = {'temp': 70.5, 't_cool': 78, 'tmode': 1}
+        self.assertEqual(thermo_stream.diff_state(old, new),
+                         {'temp': 70.5, 't_cool': 78, 't_heat': None})
+
+    def test_subscriberMerges(self):
+        """A slow subscriber gets merged updates, not a backlog"""
+        import asyncio
+        import thermo_stream
+
+        async def run():
+            subscriber = thermo_stream.Subscriber()
+            subscriber.send_changes({'temp': 70})
+            subscriber.send_changes({'temp': 71, 'fmode': 0})
+            first = subscriber.take()
+            subscriber.send_state({'temp': 71, 't_heat': 68})
+            subscriber.send_changes({'t_heat': None})
+            return first, subscriber.take(), subscriber.take()
+        self.assertEqual(asyncio.run(run()), (
+            ('diff', {'temp': 71, 'fmode': 0}), ('state', {'temp': 71}),
+            None))
+
+    def test_streamsToManyClients(self):
+        """Every client gets the state then diffs from one poller"""
+        import asyncio
+        import json
+        import thermo_emulator
+        import thermo_stream
+        emulator = thermo_emulator.Emulator(1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        tstat = emulator.thermostats[0]
+        streamer = thermo_stream.StateStreamer(emulator.addresses[0],
+                                               interval=0.1)
+
+        async def next_event(reader):
+            event = {}
+            while True:
+                line = (await reader.readline()).decode('utf-8').strip()
+                if not line:
+                    if 'event' in event:
+                        return event['event'], json.loads(event['data'])
+                    continue
+                name, _, value = line.partition(': ')
+                event[name] = value
+
+        async def run():
+            stop = asyncio.Event()
+            ports = []
+            task = asyncio.ensure_future(thermo_stream.run(
+                streamer, '127.0.0.1', 0, stop, ports.append))
+            while not ports:
+                await asyncio.sleep(0.01)
+            clients = []
+            for _ in range(5):
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', ports[0])
+                writer.write(b"GET /tstat/stream HTTP/1.1\r\n\r\n")
+                clients.append((reader, writer))
+            states = [await next_event(r) for r, _ in clients]
+            tstat.model.t_heat = 64.0
+            diffs = []
+            for reader, _ in clients:
+                # Skipping any diff of the clock ticking over meanwhile
+                diff = await next_event(reader)
+                while 't_heat' not in diff[1]:
+                    diff = await next_event(reader)
+                diffs.append(diff)
+            polls = streamer.stats()['polls']
+            stop.set()
+            await task
+            return states, diffs, polls
+        with patch('thermo_stream.logger'):
+            states, diffs, polls = asyncio.run(run())
+        self.assertEqual(set(s[0] for s in states), set(['state']))
+        self.assertEqual(states[0][1]['t_heat'], 70.0)
+        # The lower target may also switch the heat off
+        self.assertEqual(diffs, [diffs[0]] * 5)
+        self.assertEqual(diffs[0][0], 'diff')
+        self.assertEqual(diffs[0][1]['t_heat'], 64.0)
+        self.assertNotIn('tmode', diffs[0][1])
+        # One request per poll, however many clients
+        self.assertEqual(tstat.requests, polls)
+        self.assertEqual(streamer.stats()['subscribers'], 0)
+
+    def test_model(self):
+        """/tstat/model is answered, asking the thermostat only once"""
+        import asyncio
+        import json
+        import thermo_async
+        import thermo_emulator
+        import thermo_stream
+        emulator = thermo_emulator.Emulator(1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        tstat = emulator.thermostats[0]
+        streamer = thermo_stream.StateStreamer(emulator.addresses[0])
+        # Nothing listens on port 9 to be asked
+        unreachable = thermo_stream.StateStreamer('127.0.0.1:9', timeout=1)
+
+        async def run():
+            stop = asyncio.Event()
+            ports = []
+            tasks = [asyncio.ensure_future(thermo_stream.run(
+                s, '127.0.0.1', 0, stop, ports.append))
+                for s in (streamer, unreachable)]
+            while len(ports) < 2:
+                await asyncio.sleep(0.01)
+            answers = []
+            for port in (ports[0], ports[0], ports[1]):
+                answers.append(await thermo_async.request(
+                    '127.0.0.1:%d' % port, 'GET', '/tstat/model'))
+            stop.set()
+            await asyncio.gather(*tasks)
+            return answers
+        with patch('thermo_stream.logger'):
+            answers = asyncio.run(run())
+        model = json.dumps({'model': thermo_emulator.MODEL})
+        self.assertEqual(answers[:2], [(200, model)] * 2)
+        self.assertEqual(tstat.requests, 1)
+        self.assertEqual(answers[2], (502, ''))
+        self.assertEqual(unreachable.stats()['errors'], 1)
+
+    def test_unsubscribedDuringPoll(self):
+        """A poll finishing after everyone left doesn't keep its state"""
+        import asyncio
+        import thermo_stream
+        streamer = thermo_stream.StateStreamer('10.0.0.21')
+
+        async def request(*args, **kwargs):
+            streamer.unsubscribe(subscriber)
+            return 200, '{"temp": 70.0}'
+
+        async def run():
+            await streamer.poll_once()
+            return streamer.subscribe().take()
+        subscriber = streamer.subscribe()
+        with patch('thermo_stream.thermo_async.request', request):
+            self.assertIsNone(asyncio.run(run()))
+        self.assertIsNone(streamer.state)
+        self.assertIsNone(subscriber.take())
+
+
+class test_RequestScheduler(unittest.TestCase):
+    """Tests for the prioritizing thermostat request scheduler."""
+
+    def blocked_scheduler(self, **kwargs):
+        """
+        Returns a scheduler whose client records every call and holds the
+        first one until the returned Event is set.
+        """
+        from threading import Event
+        import thermo_arbiter
+        release = Event()
+        calls = []
+
+        def request(method):
+            def send(url, **kwargs):
+                calls.append((method, url, kwargs.get('data')))
+                if len(calls) == 1:
+                    release.wait(5)
+                return len(calls)
+            return send
+        client = mock.Mock()
+        client.get.side_effect = request('GET')
+        client.post.side_effect = request('POST')
+        scheduler = thermo_arbiter.RequestScheduler(client, **kwargs)
+        self.addCleanup(scheduler.close)
+        return scheduler, release, calls
+
+    def queue(self, scheduler, calls, *requests):
+        """
+        Sends each (method, url, kwargs) from its own thread, waiting until
+        it's queued, sent or coalesced.  Returns the threads and a dict of
+        their results.
+        """
+        from threading import Thread
+        from time import sleep
+
+        def accepted():
+            stats = scheduler.stats()
+            return stats['depth'] + len(calls) + sum(
+                stats[name]['coalesced']
+                for name in ('control', 'telemetry', 'read'))
+        results = {}
+        threads = []
+        for method, url, kwargs in requests:
+            def run(method=method, url=url, kwargs=kwargs):
+                results[url] = getattr(scheduler, method)(url, **kwargs)
+            before = accepted()
+            threads.append(Thread(target=run))
+            threads[-1].start()
+            while accepted() == before:
+                sleep(0.001)
+        return threads, results
+
+    def test_priorityOrder(self):
+        """Control writes go before telemetry, which goes before reads"""
+        import thermo_arbiter
+        scheduler, release, calls = self.blocked_scheduler(min_gap=0)
+        threads, results = self.queue(
+            scheduler, calls,
+            ('get', 'first', {}),
+            ('get', 'read', {}),
+            ('post', 'telemetry',
+             {'data': '1', 'priority': thermo_arbiter.TELEMETRY}),
+            ('post', 'control', {'data': '2'}))
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([url for _, url, _ in calls],
+                         ['first', 'control', 'telemetry', 'read'])
+        self.assertEqual(results, {'first': 1, 'control': 2,
+                                   'telemetry': 3, 'read': 4})
+        stats = scheduler.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['read']['requests'], 2)
+        self.assertGreater(stats['read']['max_wait'],
+                           stats['control']['max_wait'])
+
+    def test_coalescing(self):
+        """A queued write is replaced by a newer one with the same key"""
+        import thermo_arbiter
+        histogram = thermo_daemon.thermo_metrics.Histogram(
+            'wait', "Wait", (1,))
+        scheduler, release, calls = self.blocked_scheduler(
+            min_gap=0, wait_histogram=histogram)
+        telemetry = {'priority': thermo_arbiter.TELEMETRY,
+                     'coalesce_key': 'rem_temp'}
+        threads, results = self.queue(
+            scheduler, calls,
+            ('get', 'first', {}),
+            ('get', 'read', {}),
+            ('post', 'a', dict(telemetry, data='61')),
+            ('post', 'b', dict(telemetry, data='62')),
+            # Moves the pending write up
+            ('post', 'c', dict(telemetry, data='63',
+                               priority=thermo_arbiter.CONTROL)))
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [('GET', 'first', None), ('POST', 'a', '63'),
+                                 ('GET', 'read', None)])
+        # Every caller of the coalesced write gets its response
+        self.assertEqual(results, {'first': 1, 'a': 2, 'b': 2, 'c': 2,
+                                   'read': 3})
+        stats = scheduler.stats()
+        self.assertEqual(stats['telemetry']['coalesced'], 1)
+        self.assertEqual(stats['control']['coalesced'], 1)
+        self.assertEqual(histogram.count, 3)
+
+    def test_gapAndErrors(self):
+        """Requests are spaced out, and failures reach their callers"""
+        from time import monotonic
+        import thermo_arbiter
+        times = []
+        client = mock.Mock()
+        client.get.side_effect = lambda url: times.append(monotonic())
+        client.post.side_effect = IOError("Connection refused")
+        scheduler = thermo_arbiter.RequestScheduler(client, min_gap=0.05)
+        scheduler.get('http://10.0.0.21/tstat')
+        scheduler.get('http://10.0.0.21/tstat')
+        self.assertGreaterEqual(times[1] - times[0], 0.05)
+        with self.assertRaises(IOError):
+            scheduler.post('http://10.0.0.21/tstat', data='{}')
+        client.post.assert_called_once_with('http://10.0.0.21/tstat',
+                                            data='{}')
+        scheduler.close()
+        with self.assertRaises(IOError):
+            scheduler.get('http://10.0.0.21/tstat')
+
+    def test_asyncGate(self):
+        """The asyncio gate orders waiters by priority"""
+        import asyncio
+        import thermo_arbiter
+        gate = thermo_arbiter.AsyncGate(min_gap=0.01)
+        order = []
+
+        async def use(name, priority):
+            async with gate.turn(priority):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            first = asyncio.ensure_future(use('first', thermo_arbiter.READ))
+            await asyncio.sleep(0)
+            await asyncio.gather(
+                first, use('read', thermo_arbiter.READ),
+                use('telemetry', thermo_arbiter.TELEMETRY),
+                use('control', thermo_arbiter.CONTROL))
+        asyncio.run(scenario())
+        self.assertEqual(order, ['first', 'control', 'telemetry', 'read'])
+        stats = gate.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['read']['requests'], 2)
+        self.assertGreaterEqual(stats['read']['max_wait'], 0.03)
+
+
+class test_ProgramSync(unittest.TestCase):
+    """Tests for diff-based program syncing."""
+
+    def test_diff(self):
+        """Only days which differ are returned, by the thermostat's keys"""
+        import thermo_program
+        current = {"0": [360, 70, 480, 62], "1": [360, 70, 480, 62]}
+        desired = {"mon": [360, 70.0, 480, 62], "tue": [300, 70, 480, 62],
+                   6: [0, 60, 0, 60]}
+        self.assertEqual(thermo_program.diff_program(current, desired),
+                         {"1": [300, 70, 480, 62], "6": [0, 60, 0, 60]})
+        with self.assertRaises(ValueError):
+            thermo_program.normalize({"mon": [360, 70, 480]})
+        with self.assertRaises(ValueError):
+            thermo_program.normalize({"someday": []})
+
+    def test_syncAll(self):
+        """Changed days are written to every thermostat, once"""
+        import os
+        import shutil
+        import tempfile
+        import thermo_emulator
+        import thermo_http
+        import thermo_program
+        emulator = thermo_emulator.Emulator(3, seed=1).start_in_thread()
+        self.addCleanup(emulator.stop_thread)
+        client = thermo_http.PooledClient()
+        self.addCleanup(client.close)
+        tstats = [client.attach(REAL_GET_THERMOSTAT(a))
+                  for a in emulator.addresses]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'programs.json')
+        tstats[2].host = '127.0.0.1:9'  # Nothing listens there
+        schedule = {
+            'heat': {'sat': [420, 68, 480, 68, 1080, 68, 1380, 60],
+                     'mon': thermo_emulator.DEFAULT_HEAT_PROGRAM},
+            'cool': {'sun': [0, 85] * 4},
+        }
+        clock = FakeClock()
+        cache = thermo_program.ProgramCache(path, clock=clock)
+        with patch('thermo_program.logger'):
+            results = thermo_program.sync_all(tstats, schedule, cache)
+        hosts = [t.host for t in tstats]
+        self.assertEqual(results[hosts[0]], {'heat': ['sat'],
+                                             'cool': ['sun']})
+        self.assertEqual(results[hosts[1]], results[hosts[0]])
+        self.assertIsInstance(results[hosts[2]], IOError)
+        model = emulator.thermostats[0].model
+        self.assertEqual(model.programs['heat']['5'], schedule['heat']['sat'])
+        self.assertEqual(model.programs['cool']['6'], [0, 85] * 4)
+        # Two reads and two writes each
+        self.assertEqual([t.requests for t in emulator.thermostats[:2]],
+                         [5, 5])
+
+        # Cached, so nothing is read or written again
+        cache = thermo_program.ProgramCache(path, clock=clock)
+        results = thermo_program.sync_all(tstats[:2], schedule, cache)
+        self.assertEqual(results[hosts[0]], {'heat': [], 'cool': []})
+        self.assertEqual(emulator.thermostats[0].requests, 5)
+
+        # A change made behind the cache's back is found once it expires
+        model.programs['heat']['0'] = [0, 50] * 4
+        sync = thermo_program.ProgramSync(tstats[0], cache)
+        self.assertEqual(sync.sync('heat', schedule['heat']), [])
+        clock.now += thermo_program.DEFAULT_TTL + 1
+        with patch('thermo_program.logger'):
+            self.assertEqual(sync.sync('heat', schedule['heat']), ['mon'])
+        self.assertEqual(model.programs['heat']['0'],
+                         thermo_emulator.DEFAULT_HEAT_PROGRAM)
+        self.assertEqual((sync.reads, sync.writes), (1, 1))
+
+    def test_failedWriteInvalidates(self):
+        """A failed write drops the cached program"""
+        import thermo_program
+        tstat = mock.Mock(host='10.0.0.21')
+        tstat.program_heat = {'raw': {"0": [0, 60] * 4}}
+        tstat.post.return_value.getcode.return_value = 500
+        sync = thermo_program.ProgramSync(tstat)
+        with self.assertRaises(IOError):
+            sync.sync('heat', {'mon': [0, 65] * 4})
+        self.assertIsNone(sync.cache.get('10.0.0.21', 'heat'))
+        tstat.post.assert_called_once_with(
+            '/tstat/program/heat/mon', b'{"0": [0, 65, 0, 65, 0, 65, 0, 65]}')
+
+    def test_unknownModel(self):
+        """A thermostat of an unknown model is logged and fails the run"""
+        import os
+        import shutil
+        import tempfile
+        import thermo_program
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'schedule.json')
+        with open(path, 'w') as f:
+            f.write('{"heat": {"mon": [0, 60, 0, 60, 0, 60, 0, 60]}}')
+        with patch('thermo_program.radiotherm') as radiotherm, \
+                patch('thermo_program.logger') as logger, \
+                patch('sys.stdout'):
+            radiotherm.CommonThermostat.return_value.model = {
+                'raw': 'CT99 V9.99'}
+            radiotherm.get_thermostat.return_value = None
+            self.assertEqual(thermo_program.main(
+                [path, '10.0.0.21', '--cache',
+                 os.path.join(directory, 'cache.json')]), 1)
+        radiotherm.get_thermostat.assert_called_once_with(
+            '10.0.0.21', 'CT99 V9.99')
+        logger.error.assert_called_once_with(
+            "Unrecognised thermostat model at %s: %s", '10.0.0.21',
+            'CT99 V9.99')
+
+
+class test_AdaptiveSampling(unittest.TestCase):
+    """Tests for signal driven read intervals."""
+
+    def test_scaledFactor(self):
+        """Two reads half a period apart weigh the same as one"""
+        import thermo_adaptive
+        factor = thermo_adaptive.scaled_factor(0.1, 0.5, 1)
+        average = 60.0
+        for _ in range(2):
+            average = thermo_daemon.update_average(average, 70.0, factor)
+        self.assertAlmostEqual(
+            average, thermo_daemon.update_average(60.0, 70.0, 0.1))
+        self.assertAlmostEqual(thermo_adaptive.scaled_factor(0.1, 1, 1), 0.1)
+        self.assertEqual(thermo_adaptive.scaled_factor(0.1, 0, 1), 0.0)
+
+    def test_interval(self):
+        """Steady readings stretch the interval; change tightens it"""
+        import thermo_adaptive
+        adaptive = thermo_adaptive.AdaptiveInterval(1, 10, 0.5, 0.5)
+        intervals = [adaptive.observe(65.0, 65.0, 1, 0.1)
+                     for _ in range(8)]
+        self.assertEqual(intervals[:4], [1, 1.5, 2.25, 3.375])
+        self.assertEqual(intervals[-1], 10)
+        # One degree a minute
+        self.assertEqual(adaptive.observe(65.0, 65.0 + 1 / 6.0, 10, 0.5), 1)
+        self.assertEqual(adaptive.stats()['tightened'], 1)
+        self.assertAlmostEqual(adaptive.stats()['mean_interval'],
+                               17 / 8.0)
+        # Noisy but flat
+        adaptive = thermo_adaptive.AdaptiveInterval(1, 10, 0.5, 0.5)
+        for temp in [65.0, 67.0, 63.0, 67.0, 63.0]:
+            interval = adaptive.observe(temp, 65.0, 1, 0.5)
+        self.assertEqual(interval, 1)
+        with self.assertRaises(ValueError):
+            thermo_adaptive.AdaptiveInterval(5, 1, 0.5, 0.5)
+
+
+class test_Outbox(unittest.TestCase):
+    """Tests for the durable store-and-forward outbox."""
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'outbox')
+
+    def open(self, **kwargs):
+        """Opens the outbox at self.path, closing it after the test"""
+        import thermo_outbox
+        outbox = thermo_outbox.Outbox(self.path, **kwargs)
+        self.addCleanup(outbox.close)
+        return outbox
+
+    def test_survivesRestart(self):
+        """Unacknowledged writes are there after reopening"""
+        outbox = self.open(fsync=False)
+        outbox.put('rem_temp', '{"rem_temp": 61.00 }')
+        outbox.put('t_heat', '{"t_heat": 65}')
+        outbox.put('rem_temp', '{"rem_temp": 62.00 }')
+        outbox.ack('t_heat', '{"t_heat": 64}')  # An older value
+        outbox.put('fmode', '{"fmode": 1}')
+        outbox.ack('fmode', '{"fmode": 1}')
+        outbox.put('tmode', '{"tmode": 1}')
+        outbox.discard('tmode')
+        outbox.close()
+        with open(self.path, 'a') as f:
+            f.write('{"op": "put", "key": "rem_')  # Torn by a crash
+        with patch('thermo_outbox.logger') as logger:
+            outbox = self.open()
+        logger.warning.assert_called_once()
+        self.assertEqual(outbox.entries(), [
+            ('t_heat', '{"t_heat": 65}'),
+            ('rem_temp', '{"rem_temp": 62.00 }'),
+        ])
+
+    def test_supersedesAndCompaction(self):
+        """Superseded keys go, and the log stays within its limit"""
+        import os
+        outbox = self.open(max_bytes=512, fsync=False, supersedes={
+            'rem_temp': ('rem_mode',), 'rem_mode': ('rem_temp',)})
+        outbox.put('rem_mode', '{"rem_mode": 0}')
+        for i in range(100):
+            outbox.put('rem_temp', '{"rem_temp": %d }' % i)
+        self.assertEqual(outbox.entries(), [('rem_temp', '{"rem_temp": 99 }')])
+        outbox.put('rem_mode', '{"rem_mode": 0}')
+        self.assertEqual(outbox.entries(), [('rem_mode', '{"rem_mode": 0}')])
+        self.assertGreater(outbox.stats()['compactions'], 1)
+        self.assertLessEqual(os.path.getsize(self.path), 512)
+
+    def test_senderDrains(self):
+        """A sender posts what's in the outbox, then acknowledges it"""
+        from time import sleep
+        import thermo_sender
+        outbox = self.open(fsync=False)
+        outbox.put('rem_mode', '{"rem_mode": 0}')
+        client = mock.Mock()
+        client.post.side_effect = [IOError("No route to host"),
+                                   mock.Mock(status_code=200),
+                                   mock.Mock(status_code=200)]
+        sender = thermo_sender.Sender(client, 'http://10.0.0.21/tstat',
+                                      outbox=outbox)
+        with patch('thermo_sender.logger'):
+            sender.start()
+            sender.submit('{"rem_temp": 62.00 }')
+            while client.post.call_count < 3:
+                sleep(0.01)
+            sender.stop(5)
+        self.assertEqual(client.post.call_args_list, [
+            call('http://10.0.0.21/tstat', data='{"rem_mode": 0}'),
+            call('http://10.0.0.21/tstat', data='{"rem_temp": 62.00 }'),
+            # Sent again once the thermostat was back
+            call('http://10.0.0.21/tstat', data='{"rem_mode": 0}'),
+        ])
+        self.assertEqual(outbox.entries(), [])
+
+    def test_senderDurableKeys(self):
+        """Only durable keys are written; others still supersede"""
+        import thermo_sender
+        outbox = self.open(fsync=False, supersedes={
+            'rem_temp': ('rem_mode',), 'rem_mode': ('rem_temp',)})
+        outbox.put('rem_mode', '{"rem_mode": 0}')
+        sender = thermo_sender.Sender(mock.Mock(), 'http://10.0.0.21/tstat',
+                                      outbox=outbox, durable=('rem_mode',))
+        size = outbox.size()
+        sender.submit('{"rem_temp": 62.00 }')
+        self.assertEqual(outbox.entries(), [])
+        sender.submit('{"rem_temp": 62.50 }')
+        self.assertEqual(outbox.entries(), [])
+        # Just the drop of the release
+        self.assertEqual(outbox.size() - size, len(
+            '{"op": "drop", "key": "rem_mode"}\n'))
+        sender.submit('{"rem_mode": 0}', 'rem_mode')
+        self.assertEqual(outbox.entries(), [('rem_mode', '{"rem_mode": 0}')])
+
+    def test_senderDrainsOnlyUndelivered(self):
+        """Entries still queued aren't queued again after each post"""
+        from threading import Event
+        from time import sleep
+        import thermo_sender
+        outbox = self.open(fsync=False)
+        release = Event()
+        posting = Event()
+
+        def post(url, data=None):
+            posting.set()
+            release.wait(5)
+            return mock.Mock(status_code=200)
+        client = mock.Mock()
+        client.post.side_effect = post
+        sender = thermo_sender.Sender(client, 'http://10.0.0.21/tstat',
+                                      outbox=outbox)
+        with patch('thermo_sender.logger'):
+            sender.start()
+            sender.submit('{"t_heat": 65}', 't_heat')
+            posting.wait(5)
+            sender.submit('{"fmode": 1}', 'fmode')
+            sender.submit('{"tmode": 1}', 'tmode')
+            release.set()
+            while outbox.entries():
+                sleep(0.01)
+            sender.stop(5)
+        self.assertEqual(client.post.call_count, 3)
+        self.assertEqual(sender.stats()['coalesced'], 0)
+
+
+class test_SampleBuffer(unittest.TestCase):
+    """Tests for readings shared between processes."""
+
+    def setUp(self):
+        import os
+        import thermo_shm
+        self.name = 'remote_thermo_test_%d' % os.getpid()
+        self.buffer = thermo_shm.SampleBuffer(self.name, 4, create=True)
+        self.addCleanup(self.buffer.close)
+
+    def test_ring(self):
+        """Readers see every reading, or know how many they missed"""
+        import thermo_shm
+        reader = thermo_shm.SampleBuffer(self.name)
+        self.addCleanup(reader.close)
+        self.assertIsNone(reader.latest())
+        for i in range(3):
+            self.buffer.publish(i, 0.37, 60.0 + i)
+        consumer = thermo_shm.Consumer(reader)
+        self.assertEqual(list(consumer.poll()['temp']), [60.0, 61.0, 62.0])
+        self.assertEqual(len(consumer.poll()), 0)
+        for i in range(3, 9):
+            self.buffer.publish(i, 0.37, 60.0 + i)
+        with patch('thermo_shm.logger'):
+            self.assertEqual(list(consumer.poll()['time']), [5, 6, 7, 8])
+        self.assertEqual((consumer.seen, consumer.lost), (9, 2))
+        self.assertEqual(reader.latest()['temp'], 68.0)
+        with self.assertRaises(IOError):
+            thermo_shm.SampleBuffer('remote_thermo_test_missing')
+
+    def test_defaultName(self):
+        """Buffers are named after their process by default"""
+        import os
+        import thermo_shm
+        buffer = thermo_shm.SampleBuffer(capacity=4, create=True)
+        self.addCleanup(buffer.close)
+        self.assertEqual(buffer.name,
+                         'remote_thermo_samples-%d' % os.getpid())
+
+    def test_seqlock(self):
+        """Readers wait out a write in progress"""
+        from threading import Timer
+        self.buffer.publish(0, 0.37, 60.0)
+        self.buffer.header['seq'] += 1
+        self.buffer.records[0]['temp'] = 99.0  # Half written
+
+        def finish():
+            self.buffer.records[0]['temp'] = 61.0
+            self.buffer.header['seq'] += 1
+        Timer(0.05, finish).start()
+        count, records, lost = self.buffer.read_since(0)
+        self.assertEqual((count, list(records['temp']), lost),
+                         (1, [61.0], 0))
+
+    def test_sampler(self):
+        """A sampler process publishes until stopped"""
+        import multiprocessing
+        import thermo_shm
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        process = context.Process(target=thermo_shm.run_sampler, args=(
+            self.buffer, lambda: (0.37, 61.88), 0.01, stop))
+        process.start()
+        consumer = thermo_shm.Consumer(self.buffer)
+        records = consumer.poll()
+        while len(records) == 0:
+            records = consumer.poll()
+        stop.set()
+        process.join(5)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(records[0]['temp'], 61.88)
+
+    def test_samplerSettings(self):
+        """A sampler takes new settings without restarting"""
+        import multiprocessing
+        import thermo_shm
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        control, child_control = context.Pipe()
+        # Only the sampler's copy is changed
+        settings = {'temp': 61.88}
+        process = context.Process(target=thermo_shm.run_sampler, args=(
+            self.buffer, lambda: (0.37, settings['temp']), 0.01, stop,
+            thermo_shm.thermo_ticker.SKIP, child_control, settings.update))
+        process.start()
+        consumer = thermo_shm.Consumer(self.buffer)
+        control.send({'temp': 62.5, 'read_freq': 0.02})
+        temps = []
+        while 62.5 not in temps:
+            with patch('thermo_shm.logger'):
+                temps.extend(consumer.poll()['temp'])
+        stop.set()
+        process.join(5)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(settings, {'temp': 61.88})
+
+
+class test_Trace(unittest.TestCase):
+    """Tests for the hot path trace ring and profiler."""
+
+    def test_ring(self):
+        """The newest events are kept, oldest first"""
+        import thermo_trace
+        clock = FakeClock()
+        trace = thermo_trace.TraceRing(4, clock)
+        for i in range(6):
+            clock.now += 1
+            trace.record(thermo_trace.READ, 60.0 + i, 61.0, 0.002)
+        trace.record(thermo_trace.SEND, status=404)
+        records = trace.snapshot()
+        self.assertEqual(list(records['time']), [104, 105, 106, 106])
+        self.assertEqual(list(records['kind']), [thermo_trace.READ] * 3 +
+                         [thermo_trace.SEND])
+        self.assertEqual(records['status'][-1], 404)
+        self.assertTrue(numpy.isnan(records['value'][-1]))
+        self.assertEqual(len(thermo_trace.TraceRing(4).snapshot()), 0)
+
+    def test_threads(self):
+        """An event recorded while another is being written is kept"""
+        from threading import Event, Thread
+        import thermo_trace
+        writing = Event()
+        recorded = Event()
+        times = iter([1, 2])
+
+        def clock():
+            # The first event waits (briefly) for the second
+            when = next(times)
+            if when == 1:
+                writing.set()
+                recorded.wait(0.2)
+            return when
+        trace = thermo_trace.TraceRing(4, clock)
+        first = Thread(target=trace.record, args=(thermo_trace.TICK,))
+        first.start()
+        writing.wait(5)
+        trace.record(thermo_trace.SEND, status=200)
+        recorded.set()
+        first.join()
+        self.assertEqual(trace.count, 2)
+        self.assertEqual(list(trace.snapshot()['kind']),
+                         [thermo_trace.TICK, thermo_trace.SEND])
+
+    def test_dump(self):
+        """Dumps are readable text with a header"""
+        import os
+        import shutil
+        import tempfile
+        import thermo_trace
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        trace = thermo_trace.TraceRing(2, FakeClock())
+        for i in range(3):
+            trace.record(thermo_trace.TICK, 0.001 * i)
+        path = os.path.join(directory, 'trace.txt')
+        self.assertEqual(trace.dump(path), 2)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[0].startswith("# 2 events, 1 dropped;"))
+        self.assertEqual(lines[2:], [
+            "100.000000 tick 0 0.0010 nan nan",
+            "100.000000 tick 0 0.0020 nan nan",
+        ])
+
+    def test_profiler(self):
+        """Each profile is written when profiling stops"""
+        import pstats
+        import shutil
+        import tempfile
+        import thermo_trace
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profiler = thermo_trace.Profiler(directory)
+        with patch('thermo_trace.logger'):
+            self.assertIsNone(profiler.toggle())
+            thermo_daemon.reading_to_temp(0.37)
+            path = profiler.toggle()
+        self.assertIn('reading_to_temp', str(pstats.Stats(path).stats))
+
+
+class test_Config(unittest.TestCase):
+    """Tests for loading and reloading the daemon's settings."""
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        import types
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'daemon.json')
+        self.target = types.SimpleNamespace(calibration=0, decay_factor=.1,
+                                            metrics_port=None)
+        p_logging = patch('thermo_config.logger')
+        self.logging = p_logging.start()
+        self.addCleanup(p_logging.stop)
+
+    def write(self, settings):
+        import json
+        with open(self.path, 'w') as f:
+            json.dump(settings, f)
+
+    def test_load(self):
+        """Settings are checked by name and value"""
+        import thermo_config
+        self.write({'calibration': -1.5, 'send_freq': 10})
+        self.assertEqual(thermo_config.load(self.path),
+                         {'calibration': -1.5, 'send_freq': 10})
+        for settings, message in (
+                ({'calibraton': 1}, "Unknown setting 'calibraton'"),
+                ({'decay_factor': 0}, "decay_factor must be between"),
+                ({'send_freq': True}, "send_freq must be a whole"),
+                ({'tick_policy': 'eventually'}, "tick_policy must be one"),
+                ({'sensor_aggregate': 'mode'}, "sensor_aggregate must be"),
+                ({'sensor_pin': 40}, "sensor_pin must be a channel"),
+                ({'sensors': ['P9_40']}, "sensors must be"),
+                ({'sensors': {'P9_40': 2}}, "sensors must be"),
+                ({'sensors': {'P9_40': {'weight': '2'}}}, "sensors must be"),
+                ([1], "must hold a JSON object")):
+            self.write(settings)
+            with self.assertRaisesRegex(ValueError, message):
+                thermo_config.load(self.path)
+
+    def test_start(self):
+        """Everything but the frequencies is set at startup"""
+        import thermo_config
+        self.write({'calibration': 2, 'metrics_port': 9100, 'read_freq': 2})
+        reloader = thermo_config.Reloader(self.path, self.target)
+        reloader.start()
+        self.assertEqual(self.target.calibration, 2)
+        self.assertEqual(self.target.metrics_port, 9100)
+        self.assertFalse(hasattr(self.target, 'read_freq'))
+        self.assertEqual(reloader.settings['read_freq'], 2)
+
+    def test_startMissing(self):
+        """A missing file leaves the defaults, until it's reloaded"""
+        import thermo_config
+        reloader = thermo_config.Reloader(self.path, self.target)
+        self.assertEqual(reloader.start(), {})
+        self.assertEqual(self.target.calibration, 0)
+        self.logging.warning.assert_called_once_with(
+            "No settings file at %s; using the defaults", self.path)
+        self.write({'calibration': 2})
+        reloader.request()
+        self.assertEqual(reloader.poll(), {'calibration': 2})
+        self.assertEqual(self.target.calibration, 2)
+
+    def test_poll(self):
+        """Only requested, wholly valid, live changes are applied"""
+        import thermo_config
+        self.write({'calibration': 2, 'read_freq': 2})
+        reloader = thermo_config.Reloader(self.path, self.target)
+        reloader.start()
+        self.write({'calibration': 3, 'read_freq': 2, 'metrics_port': 9100,
+                    'decay_factor': .1})
+        self.assertIsNone(reloader.poll())
+        self.assertEqual(self.target.calibration, 2)
+        reloader.request()
+        self.assertEqual(reloader.poll(), {'calibration': 3})
+        self.assertEqual(self.target.calibration, 3)
+        self.assertIsNone(self.target.metrics_port)
+        self.logging.warning.assert_called_once_with(
+            "%s changed in %s; it takes effect on restart", 'metrics_port',
+            self.path)
+        self.write({'calibration': 4, 'read_freq': -1})
+        reloader.request()
+        self.assertIsNone(reloader.poll())
+        self.assertEqual(self.target.calibration, 3)
+        self.assertEqual(reloader.settings['read_freq'], 2)
+        self.write({'read_freq': 1})
+        reloader.request()
+        self.assertEqual(reloader.poll(), {'read_freq': 1})
+        self.assertEqual(reloader.stats(), {'reloads': 2, 'failures': 1})
+
+    def test_revert(self):
+        """A reload which couldn't be used is undone"""
+        import thermo_config
+        self.write({'calibration': 2, 'read_freq': 2})
+        reloader = thermo_config.Reloader(self.path, self.target)
+        reloader.start()
+        self.write({'calibration': 3, 'read_freq': 1, 'send_freq': 10,
+                    'sensors': {'P9_40': {}}, 'sensor_aggregate': 'median'})
+        self.target.sensors = None
+        self.target.sensor_aggregate = 'weighted'
+        reloader.request()
+        reloader.poll()
+        self.assertEqual(reloader.revert(), {
+            'calibration': 2, 'read_freq': 2, 'sensors': None,
+            'sensor_aggregate': 'weighted'})
+        self.assertEqual(self.target.calibration, 2)
+        self.assertIsNone(self.target.sensors)
+        self.assertEqual(self.target.sensor_aggregate, 'weighted')
+        # send_freq wasn't set before, so the caller's own stands
+        self.assertEqual(reloader.settings['read_freq'], 2)
+        self.assertNotIn('send_freq', reloader.settings)
+        self.assertEqual(reloader.stats(), {'reloads': 0, 'failures': 1})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+
+"""
+Adaptive read intervals for the daemon's sampling loop.
+
+Reading every read_freq seconds is only needed while the temperature is
+moving.  An AdaptiveInterval stretches the time between reads while the
+averaged temperature is steady, growing it by a factor each quiet read up
+to max_interval, and drops straight back to min_interval as soon as the
+average moves faster than slope_threshold degrees per minute or readings
+scatter by more than noise_threshold degrees (a running standard deviation
+about the average).
+
+With reads at varying intervals, a fixed decay_factor would weight a
+reading taken after a minute the same as one taken after a second.
+scaled_factor() gives the weight that forgets the same fraction of the old
+average per second whatever the interval.
+"""
+
+import logging
+from math import sqrt
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GROWTH = 1.5
+
+
+def scaled_factor(factor, elapsed, period):
+    """
+    Returns the weight for a reading elapsed seconds after the last, such
+    that the average decays as it would with weight factor every period
+    seconds.
+    """
+    if elapsed <= 0:
+        return 0.0
+    return 1 - (1 - factor) ** (elapsed / float(period))
+
+
+class AdaptiveInterval(object):
+    """
+    Picks the time until the next read from how the last ones went.
+
+    slope_threshold is in degrees per minute, noise_threshold in degrees;
+    either being exceeded tightens the interval to min_interval.  Otherwise
+    it's multiplied by growth each read, up to max_interval.
+    """
+
+    def __init__(self, min_interval, max_interval, slope_threshold,
+                 noise_threshold, growth=DEFAULT_GROWTH):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("Need 0 < min_interval <= max_interval")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.slope_threshold = slope_threshold
+        self.noise_threshold = noise_threshold
+        self.growth = growth
+        self.interval = min_interval
+        self.variance = 0.0
+        self.last_average = None
+        self.reads = 0
+        self.tightened = 0
+        self.intervals = 0
+        self.total_elapsed = 0.0
+
+    def observe(self, temp, avgtemp, elapsed, weight):
+        """
+        Records a read of temp, taken elapsed seconds after the last, which
+        moved the average to avgtemp with the given weight.  Returns the
+        seconds to wait before the next read.
+        """
+        self.reads += 1
+        last, self.last_average = self.last_average, avgtemp
+        if last is None or elapsed <= 0:
+            return self.interval
+        self.intervals += 1
+        self.total_elapsed += elapsed
+        slope = abs(avgtemp - last) * 60.0 / elapsed
+        self.variance += weight * ((temp - last) ** 2 - self.variance)
+        if slope > self.slope_threshold or \
+                sqrt(self.variance) > self.noise_threshold:
+            if self.interval > self.min_interval:
+                self.tightened += 1
+                logger.debug("Temperature moving at %.2f/min (noise %.2f), "
+                             "reading every %.1fs", slope,
+                             sqrt(self.variance), self.min_interval)
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval,
+                                self.interval * self.growth)
+        return self.interval
+
+    def stats(self):
+        """Returns the current interval and read counters"""
+        return {
+            'interval': self.interval,
+            'reads': self.reads,
+            'tightened': self.tightened,
+            'mean_interval': self.total_elapsed / self.intervals
+            if self.intervals else 0.0,
+        }
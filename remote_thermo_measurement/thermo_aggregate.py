@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+
+"""
+Reading several temperature sensors as one.
+
+A SensorArray reads a set of ADC channels in a single pass into a
+preallocated array, converts them all at once with per-channel calibration,
+drops channels which disagree too far with the rest, and combines what's
+left into one temperature.  Everything after the reads is vectorized, so a
+handful of probes costs little more than one.
+
+Aggregations:
+
+- weighted: a weighted mean.  Weights can be changed at any time with
+  set_weight(), e.g. to follow which rooms are occupied.
+- mean, median, min, max: what they say, ignoring weights.
+"""
+
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+def _weighted(temps, weights):
+    total = weights.sum()
+    if total <= 0:
+        return float(temps.mean())
+    return float((temps * weights).sum() / total)
+
+
+AGGREGATES = {
+    'weighted': _weighted,
+    'mean': lambda temps, weights: float(temps.mean()),
+    'median': lambda temps, weights: float(numpy.median(temps)),
+    'min': lambda temps, weights: float(temps.min()),
+    'max': lambda temps, weights: float(temps.max()),
+}
+
+
+class SensorArray(object):
+    """
+    A set of channels read and combined as one sensor.
+
+    channels maps each channel (as the backend names it, e.g. 'P9_40') to a
+    dict of options: 'calibration' (degrees added to that channel, defaulting
+    to the calibration argument) and 'weight' (defaulting to 1).  convert
+    turns an array of raw readings and an array of calibrations into
+    temperatures.  aggregate is one of AGGREGATES.  With outlier_threshold
+    set, channels more than that many degrees from the median are left out
+    of the result; it takes at least three usable channels to tell which
+    one is off, so with fewer nothing is left out.
+    """
+
+    def __init__(self, channels, convert, aggregate='weighted',
+                 outlier_threshold=None, calibration=0):
+        if not channels:
+            raise ValueError("A sensor array needs at least one channel")
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate %r (known: %s)" %
+                             (aggregate, ", ".join(sorted(AGGREGATES))))
+        self.channels = list(channels)
+        self.convert = convert
+        self.aggregate = aggregate
+        self.outlier_threshold = outlier_threshold
+        self.calibrations = numpy.array(
+            [channels[c].get('calibration', calibration)
+             for c in self.channels], dtype=numpy.float64)
+        self.weights = numpy.array(
+            [channels[c].get('weight', 1) for c in self.channels],
+            dtype=numpy.float64)
+        self.raw = numpy.empty(len(self.channels), dtype=numpy.float64)
+        self.temps = numpy.empty_like(self.raw)
+        self.keep = numpy.ones(len(self.channels), dtype=bool)
+        self.rejected = dict((c, 0) for c in self.channels)
+        # Weights changed since construction, by channel
+        self.weight_overrides = {}
+
+    def set_weight(self, channel, weight):
+        """Changes the weight of channel in the weighted aggregate"""
+        self.weights[self.channels.index(channel)] = weight
+        self.weight_overrides[channel] = weight
+
+    def read(self, backend):
+        """Reads every channel from backend in one pass into self.raw"""
+        backend.read_many(self.channels, self.raw)
+        return self.raw
+
+    def combine(self, raw=None):
+        """
+        Converts raw readings (self.raw by default) and aggregates them into
+        a temperature.  self.temps and self.keep are left holding every
+        channel's temperature and whether it was used.
+        """
+        if raw is None:
+            raw = self.raw
+        temps = self.temps
+        temps[:] = self.convert(raw, self.calibrations)
+        keep = numpy.isfinite(temps, out=self.keep)
+        if not keep.any():
+            raise ValueError("No usable reading from any channel")
+        if self.outlier_threshold is not None and keep.sum() > 2:
+            middle = numpy.median(temps[keep])
+            keep &= numpy.abs(temps - middle) <= self.outlier_threshold
+            for i in numpy.flatnonzero(~keep):
+                channel = self.channels[i]
+                self.rejected[channel] += 1
+                logger.debug("Ignoring %s: %.2f is too far from %.2f",
+                             channel, temps[i], middle)
+        return AGGREGATES[self.aggregate](temps[keep], self.weights[keep])
+
+    def __call__(self, backend):
+        """Reads and combines in one go.  Returns a temperature."""
+        return self.combine(self.read(backend))
+
+    def stats(self):
+        """Returns how often each channel has been rejected as an outlier"""
+        return dict(self.rejected)
@@ -0,0 +1,427 @@
+#! /usr/bin/env python
+
+"""
+A central aggregator for rooms with several sensor nodes.
+
+With more than one BeagleBone per thermostat, each daemon posting its own
+rem_temp means they overwrite each other, and the thermostat (which serves
+one connection at a time) gets several times the requests.  Instead, nodes
+push their readings here and the aggregator alone talks to the
+thermostats.
+
+Nodes send batches of readings as single UDP datagrams (see encode_batch()),
+so hundreds of nodes cost one socket and a few bytes per reading.  For each
+thermostat the aggregator keeps every node's latest reading, fuses the fresh
+ones with a thermo_aggregate.SensorArray (weights, per-node calibration,
+outlier rejection), and posts the result no more than once per
+send_interval, one request at a time, through a thermo_policy.SendPolicy.
+On shutdown every thermostat is released from remote mode.
+
+    ./thermo_aggregator.py aggregator.json
+
+where aggregator.json looks like:
+
+    {"port": 7370, "send_interval": 30, "stale_after": 120,
+     "aggregate": "weighted", "outlier_threshold": 5,
+     "thermostats": [
+         {"name": "downstairs", "address": "10.0.0.21",
+          "nodes": {"1": {"weight": 2}, "2": {"calibration": -0.5}}}]}
+
+Nodes are run with `thermo_aggregator.py --node ID HOST:PORT`, which reads
+the sensor configured in thermo_daemon and pushes its average every tick.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import socket
+import struct
+import sys
+from threading import Event
+from time import monotonic
+
+import numpy
+
+import thermo_aggregate
+import thermo_async
+import thermo_daemon
+import thermo_policy
+import thermo_ticker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 7370
+DEFAULT_SEND_INTERVAL = 30
+DEFAULT_STALE_AFTER = 120
+
+# A batch is a header then up to 255 readings, each its age in tenths of a
+# second when the batch was sent and the temperature.
+MAGIC = b'TB'
+VERSION = 1
+HEADER = struct.Struct('!2sBBI')  # magic, version, count, node id
+READING = struct.Struct('!Hf')    # age (0.1s), temperature
+MAX_BATCH = 255
+MAX_AGE = 0xffff / 10.0
+
+
+def encode_batch(node_id, readings, now):
+    """
+    Packs readings, a list of (time, temperature) pairs, from node_id into
+    one datagram.  Ages are measured back from now.
+    """
+    if len(readings) > MAX_BATCH:
+        raise ValueError("At most %d readings per batch" % MAX_BATCH)
+    parts = [HEADER.pack(MAGIC, VERSION, len(readings), node_id)]
+    for when, temp in readings:
+        age = min(MAX_AGE, max(0.0, now - when))
+        parts.append(READING.pack(int(round(age * 10)), temp))
+    return b''.join(parts)
+
+
+def decode_batch(data):
+    """
+    Unpacks a datagram.  Returns (node id, [(age, temperature), ...]).
+    Raises ValueError for anything which isn't a valid batch.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Short batch")
+    magic, version, count, node_id = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version %d batch" % VERSION)
+    if len(data) != HEADER.size + count * READING.size:
+        raise ValueError("Batch length doesn't match its count")
+    readings = [(age / 10.0, temp) for age, temp in
+                READING.iter_unpack(data[HEADER.size:])]
+    return node_id, readings
+
+
+def _offset(values, calibrations):
+    """Converts node temperatures for a SensorArray: just calibration"""
+    return values + calibrations
+
+
+class Zone(object):
+    """
+    One thermostat and the nodes feeding it.
+
+    nodes maps each node id to its SensorArray options ('weight',
+    'calibration').  Readings older than stale_after seconds are left out
+    of the fused temperature.  deadband and heartbeat are as the daemon's
+    send_deadband and send_heartbeat, and default the same way, so a zone
+    with a deadband still posts often enough to stay in remote mode.
+    """
+
+    def __init__(self, name, address, nodes, aggregate='weighted',
+                 outlier_threshold=None, stale_after=DEFAULT_STALE_AFTER,
+                 deadband=None, heartbeat=thermo_daemon.send_heartbeat,
+                 clock=monotonic):
+        self.name = name
+        self.address = address
+        nodes = dict((int(node), options) for node, options in nodes.items())
+        self.array = thermo_aggregate.SensorArray(
+            nodes, _offset, aggregate, outlier_threshold)
+        self.index = dict((node, i) for i, node in
+                          enumerate(self.array.channels))
+        self.stale_after = stale_after
+        self.clock = clock
+        self.policy = thermo_policy.SendPolicy(deadband, heartbeat, clock)
+        self.latest = numpy.full(len(self.index), numpy.nan)
+        self.updated = numpy.full(len(self.index), -numpy.inf)
+        self._scratch = numpy.empty(len(self.index))
+        self.sends = 0
+        self.errors = 0
+
+    def update(self, node, age, temp, now=None):
+        """Records a reading from node taken age seconds before now"""
+        if now is None:
+            now = self.clock()
+        i = self.index[node]
+        when = now - age
+        if when >= self.updated[i]:
+            self.updated[i] = when
+            self.latest[i] = temp
+
+    def fuse(self, now=None):
+        """
+        Returns the fused temperature of every node with a fresh reading,
+        or None if there are none.
+        """
+        if now is None:
+            now = self.clock()
+        values = self._scratch
+        values[:] = self.latest
+        values[now - self.updated > self.stale_after] = numpy.nan
+        try:
+            return self.array.combine(values)
+        except ValueError:
+            return None
+
+    def stats(self):
+        """Returns counters and the nodes currently contributing"""
+        now = self.clock()
+        return {
+            'sends': self.sends,
+            'errors': self.errors,
+            'fresh_nodes': int((now - self.updated <=
+                                self.stale_after).sum()),
+            'rejected': self.array.stats(),
+        }
+
+
+class Aggregator(asyncio.DatagramProtocol):
+    """
+    Receives node batches and forwards each zone's fused temperature.
+
+    zones is a list of Zone.  A node id may only feed one zone.
+    """
+
+    def __init__(self, zones, send_interval=DEFAULT_SEND_INTERVAL,
+                 timeout=thermo_async.DEFAULT_TIMEOUT):
+        self.zones = list(zones)
+        self.send_interval = send_interval
+        self.timeout = timeout
+        self.nodes = {}
+        for zone in self.zones:
+            for node in zone.index:
+                if node in self.nodes:
+                    raise ValueError("Node %d feeds both %s and %s" %
+                                     (node, self.nodes[node].name,
+                                      zone.name))
+                self.nodes[node] = zone
+        self.batches = 0
+        self.readings = 0
+        self.invalid = 0
+        self.unknown = {}
+        self.transport = None
+        self._stop = None
+
+    def datagram_received(self, data, addr):
+        """Files a batch's readings under its node's zone"""
+        try:
+            node, readings = decode_batch(data)
+        except (ValueError, struct.error) as e:
+            self.invalid += 1
+            logger.debug("Ignoring datagram from %s: %s", addr, e)
+            return
+        zone = self.nodes.get(node)
+        if zone is None:
+            if node not in self.unknown:
+                logger.warning("Ignoring unknown node %d at %s", node, addr)
+            self.unknown[node] = self.unknown.get(node, 0) + 1
+            return
+        now = zone.clock()
+        for age, temp in readings:
+            zone.update(node, age, temp, now)
+        self.batches += 1
+        self.readings += len(readings)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    async def forward(self, zone):
+        """
+        Posts zone's fused temperature every send_interval until cancelled,
+        one request at a time.  Releases remote mode on the way out.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        try:
+            while True:
+                deadline += self.send_interval
+                await asyncio.sleep(max(0, deadline - loop.time()))
+                temp = zone.fuse()
+                if temp is None:
+                    logger.debug("%s: no fresh readings", zone.name)
+                    continue
+                if not zone.policy.should_send(temp):
+                    continue
+                status = await self._post(
+                    zone, thermo_daemon.REM_TEMP_PAYLOAD % temp)
+                if status is not None and status < 400:
+                    zone.policy.sent(temp)
+        except asyncio.CancelledError:
+            logger.debug("%s: deactivating remote temperature", zone.name)
+            await self._post(zone, thermo_daemon.REM_MODE_OFF_PAYLOAD)
+            raise
+
+    async def _post(self, zone, data):
+        """
+        Posts data to zone's thermostat, logging the outcome.  Returns the
+        HTTP status, or None if the thermostat couldn't be reached.
+        """
+        try:
+            status, text = await thermo_async.post(
+                zone.address, 'tstat/remote_temp', data, self.timeout)
+        except (IOError, asyncio.TimeoutError) as e:
+            zone.errors += 1
+            logger.warning("%s: unable to reach the thermostat: %r",
+                           zone.name, e)
+            return None
+        zone.sends += 1
+        if status >= 400:
+            zone.errors += 1
+            logger.warning("%s: server returned an HTTP error code (%d): %s",
+                           zone.name, status, text)
+        return status
+
+    async def run(self, host='', port=DEFAULT_PORT, started=None):
+        """
+        Listens for nodes and forwards to every zone until stop() is called.
+        If given, started is called with the bound port once listening.
+        """
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(host, port))
+        port = transport.get_extra_info('sockname')[1]
+        logger.info("Aggregating for %d thermostats on port %d",
+                    len(self.zones), port)
+        if started is not None:
+            started(port)
+        tasks = [loop.create_task(self.forward(zone)) for zone in self.zones]
+        try:
+            await self._stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            transport.close()
+
+    def stop(self):
+        """Asks the aggregator to shut down.  Must be called from the loop."""
+        if self._stop is not None:
+            self._stop.set()
+
+    def stats(self):
+        """Returns receive counters and every zone's stats"""
+        return {
+            'batches': self.batches,
+            'readings': self.readings,
+            'invalid': self.invalid,
+            'unknown': sum(self.unknown.values()),
+            'zones': dict((z.name, z.stats()) for z in self.zones),
+        }
+
+
+def load_config(path):
+    """Builds an Aggregator and its listening port from a JSON file"""
+    with open(path) as f:
+        config = json.load(f)
+    zones = [Zone(t['name'], t['address'], t['nodes'],
+                  config.get('aggregate', 'weighted'),
+                  config.get('outlier_threshold'),
+                  config.get('stale_after', DEFAULT_STALE_AFTER),
+                  config.get('deadband'),
+                  config.get('heartbeat', thermo_daemon.send_heartbeat))
+             for t in config['thermostats']]
+    return (Aggregator(zones, config.get('send_interval',
+                                         DEFAULT_SEND_INTERVAL)),
+            config.get('port', DEFAULT_PORT))
+
+
+class Pusher(object):
+    """
+    The node side: collects readings and sends them to the aggregator at
+    address (host:port) batch_size at a time.  Sending never blocks; a
+    batch which can't be sent is dropped, as the next will supersede it.
+    """
+
+    def __init__(self, address, node_id, batch_size=1, clock=monotonic):
+        if not 1 <= batch_size <= MAX_BATCH:
+            raise ValueError("Batches hold 1 to %d readings" % MAX_BATCH)
+        host, _, port = address.rpartition(':')
+        self.address = (host, int(port))
+        self.node_id = node_id
+        self.batch_size = batch_size
+        self.clock = clock
+        self.pending = []
+        self.sent = 0
+        self.errors = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def push(self, temp):
+        """Adds a reading, sending the batch once it's full"""
+        self.pending.append((self.clock(), temp))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Sends whatever is pending"""
+        if not self.pending:
+            return
+        data = encode_batch(self.node_id, self.pending, self.clock())
+        self.pending = []
+        try:
+            self.sock.sendto(data, self.address)
+            self.sent += 1
+        except (IOError, OSError) as e:
+            self.errors += 1
+            logger.warning("Unable to reach the aggregator: %s", e)
+
+    def close(self):
+        """Flushes and closes the socket"""
+        self.flush()
+        self.sock.close()
+
+
+def run_node(address, node_id, read_freq=1, batch_size=1, stop=None):
+    """
+    Reads thermo_daemon's sensor every read_freq seconds and pushes the
+    moving average to the aggregator until stop (a threading.Event) is set.
+    """
+    if stop is None:
+        stop = Event()
+    pusher = Pusher(address, node_id, batch_size)
+    avgtemp = thermo_daemon.read_temp()
+    reader = thermo_ticker.Ticker(read_freq, thermo_daemon.tick_policy)
+    while not stop.wait(reader.timeout()):
+        reader.tick()
+        avgtemp = thermo_daemon.update_average(avgtemp,
+                                               thermo_daemon.read_temp())
+        pusher.push(avgtemp)
+    pusher.close()
+    logger.debug("Pushed %d batches, %d failed", pusher.sent, pusher.errors)
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('target', help="Config file, or with --node the "
+                        "aggregator's host:port")
+    parser.add_argument('--node', type=int, metavar='ID',
+                        help="Run as sensor node ID instead")
+    parser.add_argument('--read-freq', type=float, default=1,
+                        help="Node: seconds between reads")
+    parser.add_argument('--batch', type=int, default=1,
+                        help="Node: readings per datagram")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs the aggregator, or a node, until SIGINT/SIGTERM"""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.node is not None:
+        stop = Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        thermo_daemon.get_backend().setup()
+        run_node(args.target, args.node, args.read_freq, args.batch, stop)
+        return 0
+    aggregator, port = load_config(args.target)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, aggregator.stop)
+        await aggregator.run(port=port)
+    asyncio.run(run())
+    logger.info("Aggregator stats: %s", aggregator.stats())
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
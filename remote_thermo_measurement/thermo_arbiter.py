@@ -0,0 +1,303 @@
+#! /usr/bin/env python
+
+"""
+A prioritizing request scheduler: one queue in front of each thermostat.
+
+The thermostat handles one request at a time and drops or stalls requests
+which overlap.  A RequestScheduler sends everything for a thermostat from a
+single worker thread, one request at a time, at least min_gap seconds
+apart, in priority order:
+
+- CONTROL: writes which change what the thermostat does, including the
+  rem_mode release at shutdown.
+- TELEMETRY: periodic rem_temp posts.
+- READ: reads, such as the UI's state and program requests.
+
+Requests of the same class go first come, first served.  A write given a
+coalesce key replaces any write with the same key still waiting in the
+queue, so only the latest value is sent; every caller gets its response.
+
+The scheduler has the same get/post interface as thermo_http.PooledClient,
+plus priority and coalesce_key arguments, so it can sit between the
+daemon's other layers and the pool.  AsyncGate does the same ordering for
+asyncio code such as thermo_proxy.
+"""
+
+import asyncio
+import heapq
+import logging
+from threading import Condition, Event, Thread
+from time import monotonic, sleep
+
+import thermo_http
+
+logger = logging.getLogger(__name__)
+
+CONTROL = 0
+TELEMETRY = 1
+READ = 2
+PRIORITY_NAMES = {CONTROL: 'control', TELEMETRY: 'telemetry', READ: 'read'}
+
+DEFAULT_MIN_GAP = 0.25
+
+
+class Job(object):
+    """One queued request and whoever is waiting for it"""
+
+    def __init__(self, priority, seq, method, url, kwargs, key, queued):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.key = key
+        self.queued = queued
+        self.started = False
+        self.done = Event()
+        self.response = None
+        self.error = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class ClassStats(object):
+    """Queue wait statistics for one priority class"""
+
+    def __init__(self):
+        self.requests = 0
+        self.coalesced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def as_dict(self):
+        """Returns the statistics as a dict"""
+        return {
+            'requests': self.requests,
+            'coalesced': self.coalesced,
+            'mean_wait': self.total_wait / self.requests
+            if self.requests else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+class RequestScheduler(object):
+    """
+    Serializes and prioritizes requests to client (normally a
+    thermo_http.PooledClient).
+
+    min_gap is the least time, in seconds, between one request finishing
+    and the next starting.  If given, wait_histogram (a
+    thermo_metrics.Histogram) observes every request's time in the queue.
+    """
+
+    def __init__(self, client, min_gap=DEFAULT_MIN_GAP, wait_histogram=None,
+                 clock=monotonic):
+        self.client = client
+        self.min_gap = min_gap
+        self.wait_histogram = wait_histogram
+        self.clock = clock
+        self.classes = dict((p, ClassStats()) for p in PRIORITY_NAMES)
+        self._queue = []
+        self._pending = {}
+        self._seq = 0
+        self._cond = Condition()
+        self._closed = False
+        self._thread = None
+        self._last_finished = None
+
+    def _start(self):
+        """Starts the worker, if it isn't running"""
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="thermo-arbiter")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def request(self, method, url, priority=READ, coalesce_key=None,
+                **kwargs):
+        """
+        Queues a request and waits for it to be sent.  Returns the
+        response, or raises whatever the client raised.
+        """
+        with self._cond:
+            if self._closed:
+                raise IOError("Request scheduler is closed")
+            job = self._pending.get(coalesce_key) \
+                if coalesce_key is not None else None
+            if job is not None and not job.started:
+                job.kwargs = kwargs
+                self.classes[priority].coalesced += 1
+                if priority < job.priority:
+                    # Move it up; the heap is rebuilt with its new place
+                    job.priority = priority
+                    heapq.heapify(self._queue)
+            else:
+                self._seq += 1
+                job = Job(priority, self._seq, method, url, kwargs,
+                          coalesce_key, self.clock())
+                if coalesce_key is not None:
+                    self._pending[coalesce_key] = job
+                heapq.heappush(self._queue, job)
+                self._start()
+                self._cond.notify()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.response
+
+    def get(self, url, priority=READ, **kwargs):
+        """GETs url, by default as a READ"""
+        return self.request('GET', url, priority, **kwargs)
+
+    def post(self, url, data=None, priority=CONTROL, **kwargs):
+        """POSTs data to url, by default as a CONTROL write"""
+        return self.request('POST', url, priority, data=data, **kwargs)
+
+    def attach(self, tstat):
+        """Routes a radiotherm thermostat's own requests through here"""
+        return thermo_http.attach(self, tstat)
+
+    def _next(self):
+        """Waits for and dequeues the next job, or returns None once closed"""
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            job = heapq.heappop(self._queue)
+            job.started = True
+            if job.key is not None and self._pending.get(job.key) is job:
+                del self._pending[job.key]
+            return job
+
+    def _run(self):
+        """Worker loop: sends each job in turn, min_gap apart"""
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            if self._last_finished is not None:
+                gap = self._last_finished + self.min_gap - self.clock()
+                if gap > 0:
+                    sleep(gap)
+            wait = self.clock() - job.queued
+            stats = self.classes[job.priority]
+            stats.requests += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            if self.wait_histogram is not None:
+                self.wait_histogram.observe(wait)
+            try:
+                job.response = getattr(self.client, job.method.lower())(
+                    job.url, **job.kwargs)
+            except Exception as e:  # Handed to the caller
+                job.error = e
+            self._last_finished = self.clock()
+            job.done.set()
+
+    def close(self):
+        """Fails anything still queued and stops the worker"""
+        with self._cond:
+            self._closed = True
+            queue, self._queue = self._queue, []
+            self._pending.clear()
+            self._cond.notify_all()
+        for job in queue:
+            job.error = IOError("Request scheduler closed")
+            job.done.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        """Returns queue depth and per-class wait statistics"""
+        with self._cond:
+            depth = len(self._queue)
+        stats = {'depth': depth}
+        for priority, name in PRIORITY_NAMES.items():
+            stats[name] = self.classes[priority].as_dict()
+        return stats
+
+
+class AsyncGate(object):
+    """
+    Lets asyncio requests through one at a time, in priority order and at
+    least min_gap seconds apart:
+
+        async with gate.turn(CONTROL):
+            await thermo_async.request(...)
+
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, min_gap=DEFAULT_MIN_GAP, clock=monotonic):
+        self.min_gap = min_gap
+        self.clock = clock
+        self.classes = dict((p, ClassStats()) for p in PRIORITY_NAMES)
+        self._waiters = []
+        self._seq = 0
+        self._busy = False
+        self._last_finished = None
+
+    def turn(self, priority=READ):
+        """Returns an async context manager holding the gate for priority"""
+        return _Turn(self, priority)
+
+    async def acquire(self, priority=READ):
+        """Waits for the gate, behind anything more urgent"""
+        queued = self.clock()
+        if self._busy or self._waiters:
+            self._seq += 1
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, self._seq, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Handed the gate just as we gave up; pass it on
+                    self.release()
+                raise
+        self._busy = True
+        if self._last_finished is not None:
+            gap = self._last_finished + self.min_gap - self.clock()
+            if gap > 0:
+                try:
+                    await asyncio.sleep(gap)
+                except asyncio.CancelledError:
+                    self.release()
+                    raise
+        wait = self.clock() - queued
+        stats = self.classes[priority]
+        stats.requests += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+
+    def release(self):
+        """Hands the gate to the most urgent waiter"""
+        self._last_finished = self.clock()
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._busy = False
+
+    def stats(self):
+        """Returns queue depth and per-class wait statistics"""
+        stats = {'depth': len(self._waiters)}
+        for priority, name in PRIORITY_NAMES.items():
+            stats[name] = self.classes[priority].as_dict()
+        return stats
+
+
+class _Turn(object):
+    """One hold of an AsyncGate, see AsyncGate.turn()"""
+
+    def __init__(self, gate, priority):
+        self.gate = gate
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.gate.acquire(self.priority)
+
+    async def __aexit__(self, *exc_info):
+        self.gate.release()
@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+
+"""
+An asyncio engine for driving many sensor to thermostat pairings from one
+process.
+
+thermo_daemon.main() drives a single thermostat from a blocking loop.  Here
+each pairing is an independent task with its own read/send cadence, all
+sharing one event loop.  Sends are plain non-blocking HTTP posts, so a slow
+thermostat only delays its own pairing rather than the whole process.
+"""
+
+import asyncio
+import json
+import logging
+import signal
+import sys
+
+import thermo_daemon
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10
+# Request headers beyond this are treated as a bad request
+MAX_HEADER_BYTES = 8192
+
+
+class Pairing(object):
+    """
+    A single sensor to thermostat pairing.
+
+    name is used for logging only.  address is the host (optionally
+    host:port) of the thermostat.  read is a callable returning a raw ADC
+    reading (0.0-1.0); if not given, sensor_pin is read through the
+    thermo_daemon sensor backend.  The remaining arguments mirror the
+    thermo_daemon globals of the same names.
+    """
+
+    def __init__(self, name, address, sensor_pin=None, read=None,
+                 read_freq=1, send_freq=30, calibration=0, decay_factor=.1):
+        self.name = name
+        self.address = address
+        self.sensor_pin = sensor_pin
+        if read is None:
+            read = self._read_adc
+        self.read = read
+        self.read_freq = read_freq
+        self.send_freq = send_freq
+        self.calibration = calibration
+        self.decay_factor = decay_factor
+        self.avgtemp = None
+        self.reads = 0
+        self.sends = 0
+        self.send_errors = 0
+        self.sends_skipped = 0
+
+    def _read_adc(self):
+        """Reads the configured pin through the sensor backend"""
+        return thermo_daemon.get_backend().read(self.sensor_pin)
+
+    def read_temp(self):
+        """Reads and converts a single temperature.  Returns a float"""
+        return thermo_daemon.reading_to_temp(self.read(), self.calibration)
+
+    def sample(self):
+        """Takes a reading and folds it into the average.  Returns the
+        average."""
+        temp = self.read_temp()
+        if self.avgtemp is None:
+            self.avgtemp = temp
+        else:
+            self.avgtemp = thermo_daemon.update_average(
+                self.avgtemp, temp, self.decay_factor)
+        self.reads += 1
+        return self.avgtemp
+
+    def __repr__(self):
+        return "Pairing(%r, %r)" % (self.name, self.address)
+
+
+async def request(address, method, path, data=None,
+                  timeout=DEFAULT_TIMEOUT):
+    """
+    Sends one HTTP request to http://address/path without blocking the
+    event loop.
+
+    Returns a (status_code, body) tuple.  Raises IOError (or
+    asyncio.TimeoutError) if the thermostat can't be reached in time.
+    """
+    host, _, port = address.partition(':')
+    port = int(port) if port else 80
+    body = data.encode('utf-8') if data is not None else b""
+    head = "%s /%s HTTP/1.1\r\nHost: %s\r\n" % (
+        method, path.lstrip('/'), address)
+    if data is not None:
+        head += "Content-Type: application/json\r\n" \
+            "Content-Length: %d\r\n" % len(body)
+    request = (head + "Connection: close\r\n\r\n").encode('ascii') + body
+
+    async def _exchange():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(request)
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    response = await asyncio.wait_for(_exchange(), timeout)
+    head, _, payload = response.partition(b"\r\n\r\n")
+    status_line = head.split(b"\r\n", 1)[0].split()
+    if len(status_line) < 2 or not status_line[1].isdigit():
+        raise IOError("Malformed response from %s: %r" %
+                      (address, status_line))
+    return int(status_line[1]), payload.decode('utf-8', 'replace')
+
+
+async def read_request(reader):
+    """
+    Reads one HTTP request, for the servers here (the emulator, proxy and
+    streamer).  Returns (method, path, body, keep_alive), or None if the
+    client went away.  keep_alive is whether the client wants the
+    connection kept open afterwards.  Raises ValueError for requests which
+    can't be parsed.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return None
+    if len(head) > MAX_HEADER_BYTES:
+        raise ValueError("Headers too long")
+    lines = head.decode('latin-1').split("\r\n")
+    request_line = lines[0].split()
+    if len(request_line) < 2:
+        raise ValueError("Bad request line %r" % lines[0])
+    # HTTP/1.1 connections persist unless closed; 1.0 ones the opposite
+    keep_alive = request_line[-1].upper() == 'HTTP/1.1'
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        if name == 'content-length':
+            if not value.isdigit():
+                raise ValueError("Bad Content-Length %r" % value)
+            length = int(value)
+        elif name == 'connection':
+            keep_alive = value.lower() == 'keep-alive'
+    body = await reader.readexactly(length) if length else b""
+    return (request_line[0].upper(), request_line[1], body.decode('utf-8'),
+            keep_alive)
+
+
+async def post(address, path, data, timeout=DEFAULT_TIMEOUT):
+    """POSTs data to http://address/path.  See request()."""
+    return await request(address, 'POST', path, data, timeout)
+
+
+async def send_temp(pairing, avgtemp):
+    """Sends one remote temperature for a pairing, logging failures."""
+    data = thermo_daemon.REM_TEMP_PAYLOAD % (avgtemp)
+    logger.debug("%s: payload to the server is: %s", pairing.name, data)
+    try:
+        status, text = await post(pairing.address, 'tstat/remote_temp', data)
+    except (IOError, asyncio.TimeoutError) as e:
+        pairing.send_errors += 1
+        logger.warning("%s: unable to reach the thermostat: %r",
+                       pairing.name, e)
+        return
+    pairing.sends += 1
+    logger.debug("%s: server responded with code %d: %s",
+                 pairing.name, status, text)
+    if status >= 400:  # HTTP errors
+        pairing.send_errors += 1
+        logger.warning("%s: server returned an HTTP error code (%d): %s",
+                       pairing.name, status, text)
+
+
+async def run_pairing(pairing):
+    """
+    Runs the read/send loop for a single pairing until cancelled.
+
+    Reads are scheduled against the loop's monotonic clock so they don't
+    drift.  Sends run as their own task so a slow thermostat never delays a
+    read; if the previous send is still outstanding the new one is skipped.
+    When cancelled, or if the loop fails, the thermostat is told to stop
+    using remote temperature.
+    """
+    loop = asyncio.get_running_loop()
+    sending = None
+    try:
+        pairing.sample()
+        deadline = loop.time()
+        while True:
+            deadline += pairing.read_freq
+            await asyncio.sleep(max(0, deadline - loop.time()))
+            avgtemp = pairing.sample()
+            if pairing.reads % pairing.send_freq != 0:
+                continue
+            if sending is not None and not sending.done():
+                pairing.sends_skipped += 1
+                logger.debug("%s: previous send still in flight, skipping",
+                             pairing.name)
+                continue
+            sending = loop.create_task(send_temp(pairing, avgtemp))
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Otherwise nothing is heard of it until the engine stops
+        logger.exception("%s: read loop failed", pairing.name)
+        raise
+    finally:
+        if sending is not None:
+            sending.cancel()
+        logger.debug("%s: deactivating remote temperature", pairing.name)
+        try:
+            await post(pairing.address, 'tstat/remote_temp',
+                       thermo_daemon.REM_MODE_OFF_PAYLOAD)
+        except (IOError, asyncio.TimeoutError) as e:
+            logger.warning("%s: unable to deactivate remote temperature: %r",
+                           pairing.name, e)
+
+
+class Engine(object):
+    """Runs a set of pairings on a single event loop."""
+
+    def __init__(self, pairings):
+        self.pairings = list(pairings)
+        self._stop = None
+
+    async def run(self):
+        """Runs every pairing until stop() is called."""
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        logger.info("Starting %d pairings", len(self.pairings))
+        tasks = [loop.create_task(run_pairing(p)) for p in self.pairings]
+        await self._stop.wait()
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for pairing, result in zip(self.pairings, results):
+            if not isinstance(result, (asyncio.CancelledError, type(None))):
+                logger.error("%s: exited with %r", pairing.name, result)
+
+    def stop(self):
+        """Asks all pairings to shut down.  Must be called from the loop."""
+        if self._stop is not None:
+            self._stop.set()
+
+
+def load_pairings(path):
+    """
+    Loads pairings from a JSON file containing a list of objects, each
+    holding the keyword arguments for Pairing.
+    """
+    with open(path) as f:
+        return [Pairing(**entry) for entry in json.load(f)]
+
+
+def main(pairings):
+    """Runs the engine for the given pairings until SIGINT/SIGTERM."""
+    engine = Engine(pairings)
+
+    async def _run():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, engine.stop)
+        await engine.run()
+
+    if any(p.sensor_pin is not None for p in engine.pairings):
+        thermo_daemon.get_backend().setup()
+    asyncio.run(_run())
+
+
+def cli():
+    """Console entry point: thermo_async.py pairings.json"""
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s pairings.json\n" % sys.argv[0])
+        return 2
+    main(load_pairings(sys.argv[1]))
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(cli())
@@ -0,0 +1,243 @@
+#! /usr/bin/env python
+
+"""
+Daemon settings from a file, reloadable while the daemon runs.
+
+Changing the calibration or a frequency used to mean editing thermo_daemon
+and restarting it, which rediscovers the thermostat, sets the ADC up again
+and starts the average over.  Instead the settings can live in a JSON file
+of thermo_daemon globals, plus main()'s read_freq and send_freq:
+
+    {"calibration": -1.5, "decay_factor": 0.2, "read_freq": 2}
+
+A Reloader applies the whole file at startup.  Sent SIGHUP, the daemon asks
+it to reload: the file is read and checked in full, and only if all of it
+is good are the changes applied, between two ticks, so a tick never sees
+half a configuration.  Should the daemon still fail to use them, revert()
+puts the old ones back.  The thermostat connection and the average carry
+on.  Settings only read at startup (ports, files, retry counts) can't be
+changed this way; changes to them are logged and wait for a restart.
+Settings left out of the file keep their current values.
+"""
+
+import errno
+import json
+import logging
+from numbers import Number
+
+import thermo_aggregate
+import thermo_ticker
+
+logger = logging.getLogger(__name__)
+
+# main()'s arguments rather than module settings
+FREQUENCIES = frozenset(['read_freq', 'send_freq'])
+
+# Settings the daemon picks up on the next tick
+LIVE = frozenset([
+    'calibration', 'decay_factor', 'sensor_pin', 'burst_samples', 'sensors',
+    'sensor_aggregate', 'sensor_outlier', 'adaptive_max_interval',
+    'adaptive_slope', 'adaptive_noise', 'tick_policy', 'send_deadband',
+    'send_heartbeat', 'shutdown_retries', 'trace_dir',
+]) | FREQUENCIES
+
+# Live settings the sampler process reads; changes are forwarded to it
+SAMPLED = frozenset([
+    'calibration', 'sensor_pin', 'burst_samples', 'sensors',
+    'sensor_aggregate', 'sensor_outlier', 'tick_policy', 'read_freq',
+])
+
+# Settings only read at startup
+RESTART = frozenset([
+    'sensor_backend', 'sensor_backend_args', 'adaptive_sampling',
+    'sampler_process', 'sampler_name', 'sampler_capacity',
+    'discovery_cache', 'discovery_ttl', 'connect_retries', 'send_retries',
+    'breaker_threshold', 'breaker_reset', 'request_gap', 'metrics_port',
+    'metrics_address', 'ring_file', 'ring_capacity', 'outbox_file',
+    'outbox_max_bytes', 'trace_capacity',
+])
+
+
+def _positive(value):
+    """Returns whether value is a number above 0"""
+    return isinstance(value, Number) and value > 0
+
+
+def _optional_positive(value):
+    """Returns whether value is None or a number above 0"""
+    return value is None or _positive(value)
+
+
+def _channels(value):
+    """
+    Returns whether value is None or maps channel names to dicts of numeric
+    options
+    """
+    if value is None:
+        return True
+    if not isinstance(value, dict):
+        return False
+    for options in value.values():
+        if not isinstance(options, dict) or any(
+                isinstance(option, bool) or not isinstance(option, Number)
+                for option in options.values()):
+            return False
+    return True
+
+
+# Checks on values, and what a failing one should have been
+CHECKS = {
+    'calibration': (lambda v: isinstance(v, Number), "a number"),
+    'decay_factor': (lambda v: isinstance(v, Number) and 0 < v <= 1,
+                     "between 0 and 1"),
+    'read_freq': (_positive, "positive"),
+    'send_freq': (lambda v: isinstance(v, int) and v >= 1,
+                  "a whole number of reads"),
+    'burst_samples': (lambda v: isinstance(v, int) and v >= 1,
+                      "a whole number of reads"),
+    'adaptive_max_interval': (_positive, "positive"),
+    'adaptive_slope': (_positive, "positive"),
+    'adaptive_noise': (_positive, "positive"),
+    'tick_policy': (lambda v: v in thermo_ticker.POLICIES,
+                    "one of %s" % ", ".join(thermo_ticker.POLICIES)),
+    'send_deadband': (_optional_positive, "positive or null"),
+    'send_heartbeat': (_optional_positive, "positive or null"),
+    'sensor_outlier': (_optional_positive, "positive or null"),
+    'sensor_pin': (lambda v: isinstance(v, str), "a channel name"),
+    'sensors': (_channels, "null or channel names mapped to objects of "
+                "numeric options"),
+    'sensor_aggregate': (lambda v: v in thermo_aggregate.AGGREGATES,
+                         "one of %s" % ", ".join(
+                             sorted(thermo_aggregate.AGGREGATES))),
+    'shutdown_retries': (lambda v: isinstance(v, int) and v >= 0,
+                         "a whole number"),
+}
+
+
+def load(path):
+    """
+    Reads and checks the settings in path.  Raises ValueError, naming the
+    setting, if any is unknown or out of range.
+    """
+    with open(path) as f:
+        settings = json.load(f)
+    if not isinstance(settings, dict):
+        raise ValueError("%s must hold a JSON object" % path)
+    for name, value in settings.items():
+        if name not in LIVE and name not in RESTART:
+            raise ValueError("Unknown setting %r in %s" % (name, path))
+        check, expected = CHECKS.get(name, (None, None))
+        # bool is an int, but never a sensible number here
+        if check is not None and (isinstance(value, bool) or
+                                  not check(value)):
+            raise ValueError("%s must be %s, not %r" % (
+                name, expected, value))
+    return settings
+
+
+class Reloader(object):
+    """
+    Applies the settings in path to target, a module.  request() may be
+    called from a signal handler; poll() does the work, from the thread
+    which uses the settings.
+    """
+
+    def __init__(self, path, target):
+        self.path = path
+        self.target = target
+        self.settings = {}
+        # What the last reload changed, and the settings before it, for
+        # revert()
+        self.previous = {}
+        self.previous_settings = {}
+        self.requested = False
+        self.reloads = 0
+        self.failures = 0
+
+    def start(self):
+        """
+        Loads and applies every setting in the file, for use before the
+        daemon starts.  Errors are raised, except that a missing file holds
+        no settings; it can be created and reloaded later.
+        """
+        try:
+            settings = load(self.path)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            logger.warning("No settings file at %s; using the defaults",
+                           self.path)
+            return {}
+        for name, value in settings.items():
+            if name not in FREQUENCIES:
+                setattr(self.target, name, value)
+        self.settings = settings
+        logger.info("Loaded %d settings from %s", len(settings), self.path)
+        return settings
+
+    def request(self):
+        """Asks for the file to be reloaded at the next poll()"""
+        self.requested = True
+
+    def poll(self):
+        """
+        Reloads the file if asked to.  Returns the live settings which
+        changed, by name, or None if there was no reload or it failed (in
+        which case nothing was changed).
+        """
+        if not self.requested:
+            return None
+        self.requested = False
+        try:
+            settings = load(self.path)
+        except (IOError, OSError, ValueError) as e:
+            self.failures += 1
+            logger.error("Not reloading %s: %s", self.path, e)
+            return None
+        changed = {}
+        for name, value in settings.items():
+            if name in FREQUENCIES:
+                current = self.settings.get(name)
+            else:
+                current = getattr(self.target, name)
+            if value == current:
+                continue
+            if name in RESTART:
+                logger.warning("%s changed in %s; it takes effect on "
+                               "restart", name, self.path)
+                continue
+            changed[name] = value
+        self.previous = dict((name, getattr(self.target, name))
+                             for name in changed if name not in FREQUENCIES)
+        self.previous_settings = dict(self.settings)
+        for name, value in changed.items():
+            if name not in FREQUENCIES:
+                setattr(self.target, name, value)
+            self.settings[name] = value
+        self.reloads += 1
+        logger.info("Reloaded %s, changing %s", self.path,
+                    ", ".join(sorted(changed)) or "nothing")
+        return changed
+
+    def revert(self):
+        """
+        Puts back the settings the last poll() changed, for when they turn
+        out to be unusable.  Returns the restored live settings, by name;
+        frequencies the file didn't give before are left out, for the
+        caller's own values to stand.
+        """
+        restored = dict(self.previous)
+        for name, value in restored.items():
+            setattr(self.target, name, value)
+        for name in FREQUENCIES.intersection(self.settings):
+            if name in self.previous_settings:
+                restored[name] = self.previous_settings[name]
+        self.settings = dict(self.previous_settings)
+        self.previous = {}
+        self.reloads -= 1
+        self.failures += 1
+        return restored
+
+    def stats(self):
+        """Returns how many reloads were applied and how many failed"""
+        return {'reloads': self.reloads, 'failures': self.failures}
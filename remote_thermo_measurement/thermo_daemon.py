@@ -10,28 +10,238 @@ https://learn.adafruit.com/measuring-temperature-with-a-beaglebone-black?\
 view=all
 """
 
-import Adafruit_BBIO.ADC as ADC
+import argparse
 import radiotherm
-import requests
 import signal
 import logging
+import json
+import copy
+import math
 from traceback import format_exc
+import multiprocessing
 from multiprocessing import Lock
+import os
+import sys
+from time import monotonic, strftime
+
+import thermo_adaptive
+import thermo_aggregate
+import thermo_arbiter
+import thermo_config
+import thermo_discovery
+import thermo_filters
+import thermo_http
+import thermo_metrics
+import thermo_outbox
+import thermo_policy
+import thermo_resilience
+import thermo_ring
+import thermo_sender
+import thermo_sensors
+import thermo_shm
+import thermo_ticker
+import thermo_trace
 
 calibration = 0
 decay_factor = .1
 
 sensor_pin = 'P9_40'
 
+# Where readings come from: 'bbio' (Adafruit_BBIO), 'iio' (Linux IIO sysfs,
+# for current kernels) or 'replay'.  sensor_backend_args are passed to the
+# backend's constructor; see thermo_sensors.
+sensor_backend = 'bbio'
+sensor_backend_args = {}
+
+# ADC reads taken per tick.  Above 1, each burst is reduced by filter_chain
+# (a thermo_filters.FilterChain; None means a plain median).  If the chain
+# has its own smoothing stage, consider setting decay_factor to 1.
+burst_samples = 1
+filter_chain = None
+
+# To read several probes instead of just sensor_pin, map each channel to its
+# options, e.g. {'P9_40': {'calibration': -1.5, 'weight': 2}, 'P9_39': {}}.
+# Channels without a calibration use the one above.  They're combined with
+# sensor_aggregate ('weighted', 'mean', 'median', 'min' or 'max'); any more
+# than sensor_outlier degrees from the median are ignored, which takes at
+# least three channels.  burst_samples only applies to single sensor reads.
+# See thermo_aggregate.
+sensors = None
+sensor_aggregate = 'weighted'
+sensor_outlier = None
+
+# Adaptive sampling: while the average is steady, the time between reads
+# grows from read_freq up to adaptive_max_interval seconds, and drops back
+# to read_freq once the average moves faster than adaptive_slope degrees per
+# minute or readings scatter by more than adaptive_noise degrees.
+# decay_factor is rescaled for each interval so the average responds at the
+# same rate per second.  Sends can only happen on a read, so keep
+# adaptive_max_interval below the send period.  See thermo_adaptive.
+adaptive_sampling = False
+adaptive_max_interval = 15
+adaptive_slope = 0.5
+adaptive_noise = 0.5
+
+# Read the ADC in a separate sampler process, which publishes readings to
+# the shared memory segment sampler_name (see thermo_shm), so nothing else
+# the daemon does can delay a read.  Other processes can read the segment
+# too; None names it after the daemon's pid, which is logged.  It holds
+# sampler_capacity readings.  adaptive_sampling only applies to reads in the
+# main process.
+sampler_process = False
+sampler_name = None
+sampler_capacity = thermo_shm.DEFAULT_CAPACITY
+
+# What the read loop does after falling a whole period or more behind.  See
+# thermo_ticker.
+tick_policy = thermo_ticker.SKIP
+
+# Only post when the average has moved more than this many degrees since the
+# last post.  None posts every send period.
+send_deadband = None
+# With a deadband set, still post at least this often (in seconds) so the
+# thermostat doesn't fall back to its internal sensor.
+send_heartbeat = 300
+
+REM_TEMP_PAYLOAD = "{\"rem_temp\": %.2f }"
+REM_MODE_OFF_PAYLOAD = "{\"rem_mode\": 0}"
+# A fresh rem_temp makes an undelivered release moot, and the release makes
+# an undelivered rem_temp wrong.
+OUTBOX_SUPERSEDES = {'rem_temp': ('rem_mode',), 'rem_mode': ('rem_temp',)}
+
+# Where the last discovered thermostat is remembered, so restarts don't
+# need to rediscover it.  None disables the cache.  Entries older than
+# discovery_ttl seconds are rediscovered; so is everything if rediscover is
+# set (--rediscover on the command line).
+discovery_cache = thermo_discovery.CACHE_FILE
+discovery_ttl = thermo_discovery.DEFAULT_TTL
+rediscover = False
+
+# How many times to retry finding the thermostat at startup, the periodic
+# rem_temp post and the rem_mode release at shutdown.  Retries back off
+# exponentially.  After breaker_threshold failures in a row, rem_temp posts
+# stop until a probe every breaker_reset seconds gets through.
+connect_retries = 3
+send_retries = 1
+shutdown_retries = 5
+breaker_threshold = 3
+breaker_reset = 30
+
+# Least time between requests to the thermostat, in seconds.  Every request
+# the daemon makes goes through one thermo_arbiter.RequestScheduler, so the
+# shutdown rem_mode release goes ahead of rem_temp posts, which go ahead of
+# reads, and a rem_temp still waiting its turn is replaced by a newer one.
+request_gap = thermo_arbiter.DEFAULT_MIN_GAP
+
+# Port to serve Prometheus metrics on, at /metrics.  None disables the
+# endpoint (metrics are still recorded; it costs next to nothing).
+metrics_port = None
+metrics_address = ''
+
+# File to keep a memory-mapped ring buffer of every reading and send in, for
+# later analysis (see thermo_ring).  None disables it.  Holds ring_capacity
+# records; a week of one second reads is about 14MB.
+ring_file = None
+ring_capacity = thermo_ring.DEFAULT_CAPACITY
+
+# File to keep writes to the thermostat in until they're delivered (see
+# thermo_outbox), so a rem_mode release which couldn't be sent at shutdown
+# goes out on the next start.  None disables it.  The file is compacted once
+# it passes outbox_max_bytes.
+outbox_file = None
+outbox_max_bytes = thermo_outbox.DEFAULT_MAX_BYTES
+
+# Each tick's events are kept in memory (see thermo_trace), the last
+# trace_capacity of them.  SIGUSR1 writes them to a file in trace_dir; SIGUSR2
+# starts profiling the read loop, and writes the profile there when sent
+# again.
+trace_capacity = thermo_trace.DEFAULT_CAPACITY
+trace_dir = '/var/tmp'
+
+# JSON file of settings: any of the above, plus main()'s read_freq and
+# send_freq, which override its arguments.  Read by setup(), and again on
+# SIGHUP, when most changes take effect from the next tick without
+# reconnecting or resetting the average (see thermo_config).  None disables
+# it; --config PATH on the command line sets it.
+config_file = None
+
 logger = logging.getLogger(__name__)
 
 exitLock = None
 
+# Hot path metrics, see thermo_metrics
+metrics = thermo_metrics.DaemonMetrics()
+
+# Hot path events, see thermo_trace
+trace = thermo_trace.TraceRing(trace_capacity)
+profiler = None
+
+# thermo_config.Reloader for config_file, see setup()
+reloader = None
+
+# The sensor backend in use, see get_backend()
+_backend = None
+
+# BurstSampler built from burst_samples and filter_chain, see read_adc()
+_burst = None
+_burst_config = None
+
+# SensorArray built from sensors, see get_sensor_array()
+_array = None
+_array_config = None
+
+# Pooled HTTP client shared by every request to the thermostat
+http_client = None
+
+# RequestScheduler serializing access through http_client, timed by an
+# InstrumentedClient so that queueing isn't counted as the request's time,
+# see get_scheduler()
+_scheduler = None
+
+# The running sampler process, see start_sampler()
+_sampler = None
+
+
+def get_client():
+    """Returns the shared pooled HTTP client, creating it if needed"""
+    global http_client
+    if http_client is None:
+        http_client = thermo_http.PooledClient()
+    return http_client
 
-def connect():
-    """Connect to the thermostat.  Returns a radiotherm object"""
+
+def get_scheduler():
+    """
+    Returns the request scheduler in front of the shared HTTP client,
+    creating it if needed
+    """
+    global _scheduler
+    client = get_client()
+    if _scheduler is None or _scheduler.client.client is not client or \
+            _scheduler.client.metrics is not metrics or \
+            _scheduler.min_gap != request_gap:
+        if _scheduler is not None:
+            _scheduler.close()
+        _scheduler = thermo_arbiter.RequestScheduler(
+            thermo_metrics.InstrumentedClient(client, metrics), request_gap,
+            metrics.queue_wait)
+    return _scheduler
+
+
+def connect(client=None):
+    """
+    Connect to the thermostat.  Returns a radiotherm object
+
+    If client is given, the thermostat's own requests are routed through
+    that pooled client.  IOErrors are retried connect_retries times.
+    """
+    def find():
+        if discovery_cache is None:
+            return radiotherm.get_thermostat()
+        return thermo_discovery.get_thermostat(
+            discovery_cache, discovery_ttl, client, rediscover)
     try:
-        tstat = radiotherm.get_thermostat()
+        tstat = thermo_resilience.retry(find, connect_retries)
     except IOError as e:
         if len(e.args) == 0:
             logger.critical("Unable to find the thermostat: Generic IOError."
@@ -44,25 +254,117 @@ def connect():
         logger.critical("Unable to connect to the thermostat:")
         logger.critical(format_exc())
         raise
+    if client is not None and tstat is not None:
+        client.attach(tstat)
     return tstat
 
 
+def reading_to_temp(reading, offset=None):
+    """
+    Converts a raw ADC reading (0.0-1.0) from a TMP36 into degrees F.
+
+    offset is the calibration to apply.  Defaults to the module calibration.
+    """
+    if offset is None:
+        offset = calibration
+    millivolts = reading * 1800  # 1.8V reference = 1800 mV
+    return ((millivolts - 500) / 10 * 9/5) + 32 + offset
+
+
+def update_average(avgtemp, temp, factor=None):
+    """
+    Folds a new reading into the exponential moving average.
+
+    factor is the weight of the new reading.  Defaults to decay_factor.
+    """
+    if factor is None:
+        factor = decay_factor
+    return ((1 - factor) * avgtemp) + (factor * temp)
+
+
+def get_backend():
+    """Returns the configured sensor backend, creating it if needed"""
+    global _backend
+    if _backend is None:
+        _backend = thermo_sensors.get_backend(sensor_backend,
+                                              **sensor_backend_args)
+    return _backend
+
+
+def _read_pin():
+    """Takes a single ADC reading from sensor_pin"""
+    return get_backend().read(sensor_pin)
+
+
+def read_adc():
+    """
+    Reads the raw ADC value, oversampled and filtered if burst_samples is
+    more than 1.  Returns a float between 0 and 1.
+    """
+    global _burst, _burst_config
+    if burst_samples <= 1:
+        return _read_pin()
+    if _burst_config != (burst_samples, filter_chain):
+        _burst = thermo_filters.BurstSampler(_read_pin, burst_samples,
+                                             filter_chain)
+        _burst_config = (burst_samples, filter_chain)
+    return _burst()
+
+
+def get_sensor_array():
+    """
+    Returns the SensorArray for sensors, rebuilding it if they changed, even
+    in place.  Weights changed with set_weight() carry over to the new array
+    for channels whose options are unchanged.
+    """
+    global _array, _array_config
+    config = (sensors, sensor_aggregate, sensor_outlier, calibration)
+    if _array is None or _array_config != config:
+        array = thermo_aggregate.SensorArray(
+            sensors, reading_to_temp, sensor_aggregate, sensor_outlier,
+            calibration)
+        if _array is not None:
+            for channel, weight in _array.weight_overrides.items():
+                if channel in sensors and \
+                        sensors[channel] == _array_config[0].get(channel):
+                    array.set_weight(channel, weight)
+        _array = array
+        # A copy, so that changes made to sensors in place are noticed
+        _array_config = copy.deepcopy(config)
+    return _array
+
+
 def read_temp():
     """Reads temperature locally.  Returns a float"""
-    reading = ADC.read(sensor_pin)
-    millivolts = reading * 1800  # 1.8V reference = 1800 mV
-    temp_f = ((millivolts - 500) / 10 * 9/5) + 32 + calibration
-    logger.debug("Read a temperature of %.2f", temp_f)
-    return temp_f
+    if sensors:
+        array = get_sensor_array()
+        temp_f = array(get_backend())
+        metrics.adc_raw.set(float(array.raw[array.keep].mean()))
+        return temp_f
+    reading = read_adc()
+    metrics.adc_raw.set(reading)
+    return reading_to_temp(reading)
 
 
 def setup():
     """Performs basic setup for the daemon and ADC"""
-    global exitLock
+    global exitLock, reloader
+    if config_file is not None:
+        reloader = thermo_config.Reloader(config_file, sys.modules[__name__])
+        try:
+            reloader.start()
+        except (IOError, OSError, ValueError) as e:
+            logger.critical("Unable to load settings from %s: %s",
+                            config_file, e)
+            return
     logger.debug("Setting up ADC")
     try:
-        ADC.setup()
+        get_backend().setup()
     except RuntimeError as e:
+        if sensor_backend != 'bbio':
+            logger.critical("Unable to set up the %s sensor backend: %s",
+                            sensor_backend, str(e))
+            return
         logger.critical(
             "Attempting to start the BBB GPIO library failed.  This can be "
             "due to a number of things, including:"
@@ -75,9 +377,16 @@ def setup():
         logger.critical("- Not running on a BBB")
         logger.critical("- Conflicting capes")
         logger.critical("Raw exception: %s", str(e))
+        logger.critical("On newer kernels, try sensor_backend = 'iio'.")
         return
-    tstat = connect()  # TODO: retries
+    if sampler_process:
+        # Forked while there's only one thread; main() sets the frequency
+        start_sampler()
+    tstat = connect(get_scheduler())
     logger.debug("Attaching signal handlers")
+    signal.signal(signal.SIGUSR1, handle_dump)
+    signal.signal(signal.SIGUSR2, handle_profile)
+    signal.signal(signal.SIGHUP, handle_reload)
     signal.signal(signal.SIGINT, handle_exit)
     signal.signal(signal.SIGTERM, handle_exit)
     logger.debug("Building Lock for singal interrupts")
@@ -87,40 +396,318 @@ def setup():
     return tstat
 
 
+def _sample():
+    """The sampler process's read: returns the raw reading and temperature"""
+    temp = read_temp()
+    # read_temp() leaves the raw reading in the adc_raw gauge
+    return metrics.adc_raw.value, temp
+
+
+def _configure_sampler(settings):
+    """The sampler process's copy of a reload: applies settings"""
+    for name, value in settings.items():
+        if name not in thermo_config.FREQUENCIES:
+            setattr(sys.modules[__name__], name, value)
+
+
+def start_sampler(read_freq=1):
+    """
+    Starts the sampler process reading every read_freq seconds, unless it's
+    already running.  It's forked, which is only safe before any thread is
+    started, so setup() starts it before connecting.  Returns its
+    SampleBuffer, the process, the Event which stops it and the end of the
+    Pipe which sends it settings (see configure_sampler()).
+    """
+    global _sampler
+    if _sampler is None:
+        context = multiprocessing.get_context('fork')
+        buffer = thermo_shm.SampleBuffer(sampler_name, sampler_capacity,
+                                         create=True)
+        stop = context.Event()
+        control, child_control = context.Pipe()
+        process = context.Process(
+            target=thermo_shm.run_sampler, name="thermo-sampler",
+            args=(buffer, _sample, read_freq, stop, tick_policy,
+                  child_control, _configure_sampler))
+        process.daemon = True
+        process.start()
+        logger.info("Sampling into shared memory %s", buffer.name)
+        _sampler = buffer, process, stop, control
+    return _sampler
+
+
+def configure_sampler(sampler, settings):
+    """
+    Sends settings, a dict, to a sampler from start_sampler().  It applies
+    them before its next read, carrying on into the same buffer.
+    """
+    sampler[3].send(settings)
+
+
+def stop_sampler(sampler, consumer):
+    """Stops a sampler from start_sampler() and removes its buffer"""
+    global _sampler
+    buffer, process, stop, control = sampler
+    if process.is_alive():
+        # Were it killed while waiting on stop, set() would wait forever
+        # for it to wake
+        stop.set()
+    process.join()
+    control.close()
+    logger.debug("Sampler published %d readings, %d lost",
+                 consumer.seen, consumer.lost)
+    buffer.close()
+    _sampler = None
+
+
+def step(avgtemp, temp, send_timer, policy, factor=None):
+    """
+    Makes one tick's decisions for main(): folds temp into avgtemp and, if
+    send_timer says a send is due and policy agrees, builds the payload.
+    Returns the new average and the payload, or None if nothing is to be
+    sent.  factor is passed to update_average().
+    """
+    avgtemp = update_average(avgtemp, temp, factor)
+    if not send_timer.due():
+        return avgtemp, None
+    send_timer.tick()
+    if not policy.should_send(avgtemp):
+        return avgtemp, None
+    return avgtemp, REM_TEMP_PAYLOAD % (avgtemp)
+
+
+def record_sends(ring=None, policy=None):
+    """
+    Returns a thermo_sender on_result callback which traces each post and,
+    if given, records it in ring, along with the temperature it carried (if
+    any).  rem_temp posts the thermostat accepted are reported to policy,
+    if given, as sent.
+    """
+    def on_result(key, data, status):
+        try:
+            temp = json.loads(data).get(key, float('nan'))
+        except ValueError:
+            temp = float('nan')
+        if policy is not None and key == 'rem_temp' and \
+                status is not None and status < 400 and not math.isnan(temp):
+            policy.sent(temp)
+        status = -1 if status is None else status
+        trace.record(thermo_trace.SEND, temp, status=status)
+        if ring is not None:
+            ring.record_send(temp, status)
+    return on_result
+
+
+def reconfigure(changed, read_freq, send_freq, reader, send_timer, policy,
+                adaptive):
+    """
+    Brings main()'s running state up to date with settings changed by a
+    reload.  Returns the read and send frequencies now in effect.
+    """
+    if sensors:
+        # Built now, so sensors it can't use fail the reload, not a read
+        get_sensor_array()
+    read_freq = changed.get('read_freq', read_freq)
+    send_freq = changed.get('send_freq', send_freq)
+    reader.policy = send_timer.policy = tick_policy
+    reader.set_period(read_freq)
+    send_timer.set_period(read_freq * send_freq)
+    policy.deadband = send_deadband
+    policy.heartbeat = send_heartbeat
+    if adaptive is not None:
+        # Start again from read_freq; it grows back if nothing's changing
+        adaptive.min_interval = adaptive.interval = read_freq
+        adaptive.max_interval = max(read_freq, adaptive_max_interval)
+        adaptive.slope_threshold = adaptive_slope
+        adaptive.noise_threshold = adaptive_noise
+    metrics.read_interval.set(read_freq)
+    return read_freq, send_freq
+
+
 def main(tstat, read_freq=1, send_freq=30, run_once=False):
     """
     Main daemon function.
 
     read_freq is how long the program should wait between reads, in seconds.
     send_freq is how many read cycles should occur before data is sent.
+    Both are kept to fixed deadlines, so the time a read or send takes
+    doesn't push the schedule back.
     run_once prevents the function from looping and is used in testing.
+    read_freq and send_freq in config_file override the arguments.
+    Returns the exit status: non-zero if the sampler process died.
     """
+    global trace
     from sys import argv
     logger.info("%s starting up!", argv[0])
+    if reloader is not None:
+        read_freq = reloader.settings.get('read_freq', read_freq)
+        send_freq = reloader.settings.get('send_freq', send_freq)
+    if trace.capacity != trace_capacity:
+        trace = thermo_trace.TraceRing(trace_capacity)
     remote_url = tstat._construct_url('tstat/remote_temp')
-    avgtemp = read_temp()
-    reads = 1
+    if metrics_port is not None:
+        metrics_server = thermo_metrics.serve(metrics, metrics_port,
+                                              metrics_address)
+    client = thermo_resilience.ResilientClient(
+        get_scheduler(),
+        thermo_resilience.CircuitBreaker(breaker_threshold, breaker_reset),
+        send_retries)
+    ring = None
+    if ring_file is not None:
+        ring = thermo_ring.RingBuffer(ring_file, ring_capacity)
+    policy = thermo_policy.SendPolicy(send_deadband, send_heartbeat)
+    on_result = record_sends(ring, policy)
+    outbox = None
+    if outbox_file is not None:
+        outbox = thermo_outbox.Outbox(outbox_file, outbox_max_bytes,
+                                      OUTBOX_SUPERSEDES)
+        # Older versions kept rem_temp there too; a fresh one will be along
+        # shortly
+        outbox.discard('rem_temp')
+    # rem_temp isn't journalled: it's stale after a restart, and syncing it
+    # every send would hold up the read loop
+    sender = thermo_sender.Sender(
+        client, remote_url, on_result=on_result,
+        post_kwargs={'priority': thermo_arbiter.TELEMETRY,
+                     'coalesce_key': 'rem_temp'},
+        outbox=outbox, durable=('rem_mode',))
+    sender.start()
+    # With a sampler, only it reads the ADC; the average starts from its
+    # first reading instead
+    avgtemp = None if sampler_process else read_temp()
+    exit_status = 0
+    start = monotonic()
+    reader = thermo_ticker.Ticker(read_freq, tick_policy, start)
+    send_timer = thermo_ticker.Ticker(read_freq * send_freq, tick_policy,
+                                      start)
+    consumer = None
+    if sampler_process:
+        sampler = start_sampler(read_freq)
+        configure_sampler(sampler, {'read_freq': read_freq})
+        consumer = thermo_shm.Consumer(sampler[0])
+    adaptive = None
+    if adaptive_sampling and consumer is None:
+        adaptive = thermo_adaptive.AdaptiveInterval(
+            read_freq, max(read_freq, adaptive_max_interval), adaptive_slope,
+            adaptive_noise)
+    last_read = start
+    metrics.read_interval.set(read_freq)
     # acquire() returns true on succesful acquisition, which is when we
     # want to exit - acquisition means signal was recieved.
-    while not exitLock.acquire(timeout=read_freq):
+    while not exitLock.acquire(timeout=reader.timeout()):
+        lateness = reader.tick()
+        metrics.tick_lateness.observe(lateness)
+        trace.record(thermo_trace.TICK, lateness)
+        # Reloads happen here, between ticks, so each tick runs on one
+        # consistent set of settings.
+        changed = reloader.poll() if reloader is not None else None
+        if changed:
+            try:
+                read_freq, send_freq = reconfigure(
+                    changed, read_freq, send_freq, reader, send_timer,
+                    policy, adaptive)
+            except Exception:
+                logger.exception("Unable to apply the settings from %s; "
+                                 "keeping the old ones", config_file)
+                read_freq, send_freq = reconfigure(
+                    reloader.revert(), read_freq, send_freq, reader,
+                    send_timer, policy, adaptive)
+            else:
+                sampled = thermo_config.SAMPLED.intersection(changed)
+                if consumer is not None and sampled:
+                    # The sampler has its own copy of the settings
+                    configure_sampler(sampler, dict(
+                        (name, changed[name]) for name in sampled))
         # Perform the read and facotr into the average
-        avgtemp = ((1 - decay_factor) * avgtemp) + \
-            (decay_factor * read_temp())
-        reads = (reads + 1) % send_freq
-        if reads == 0:
-            data = "{\"rem_temp\": %.2f }" % (avgtemp)
-            logger.debug("Payload to the server is: %s", data)
-            r = requests.post(remote_url, data=data)
-            logger.debug("Server responded with code %d: %s",
-                         r.status_code, r.text)
-            if r.status_code >= 400:  # HTTP errors
-                logger.warning("Server returned an HTTP error code (%d): %s",
-                               r.status_code, r.text)
-    data = "{\"rem_mode\": 0}"
+        read_start = monotonic()
+        if consumer is not None:
+            records = consumer.poll()
+            if len(records) == 0:
+                process = sampler[1]
+                if not process.is_alive():
+                    # It can't be forked again now that threads are running
+                    logger.critical("The sampler process died (exit code "
+                                    "%s); exiting", process.exitcode)
+                    exit_status = 1
+                    break
+                continue
+            if avgtemp is None:
+                avgtemp = float(records['temp'][0])
+            # Every reading counts towards the average; the newest is
+            # folded in below.
+            for earlier in records['temp'][:-1]:
+                avgtemp = update_average(avgtemp, float(earlier))
+            temp = float(records['temp'][-1])
+            metrics.adc_raw.set(float(records['raw'][-1]))
+        else:
+            temp = read_temp()
+        read_time = monotonic() - read_start
+        metrics.read_latency.observe(read_time)
+        factor = None
+        if adaptive is not None:
+            # Weighted for the time since the last read, which varies
+            elapsed, last_read = read_start - last_read, read_start
+            factor = thermo_adaptive.scaled_factor(decay_factor, elapsed,
+                                                   read_freq)
+        avgtemp, data = step(avgtemp, temp, send_timer, policy, factor)
+        metrics.avgtemp.set(avgtemp)
+        trace.record(thermo_trace.READ, temp, avgtemp, read_time)
+        if adaptive is not None:
+            reader.set_period(adaptive.observe(temp, avgtemp, elapsed,
+                                               factor))
+            metrics.read_interval.set(reader.period)
+        if ring is not None:
+            # read_temp() leaves the raw reading in the adc_raw gauge
+            ring.record_reading(metrics.adc_raw.value, avgtemp)
+        if data is not None:
+            # Posted from the sender's thread, so a slow thermostat can't
+            # delay the next read.
+            sender.submit(data)
+            trace.record(thermo_trace.SUBMIT, avgtemp)
+    data = REM_MODE_OFF_PAYLOAD
     logger.warning("Caught exit signal, exiting.")
+    logger.debug("Read schedule stats: %s", reader.stats())
+    if adaptive is not None:
+        logger.debug("Adaptive sampling stats: %s", adaptive.stats())
+    if consumer is not None:
+        stop_sampler(sampler, consumer)
+    if reloader is not None:
+        logger.debug("Reload stats: %s", reloader.stats())
+    # Stop the sender first: a rem_temp landing after this would turn
+    # remote mode straight back on.
+    sender.stop()
+    logger.debug("Send policy stats: %s", policy.stats())
+    logger.debug("Sender stats: %s", sender.stats())
     logger.debug("Deactivating remote temperature with payload %s", data)
-    requests.post(remote_url, data=data)
-    return
+    if outbox is not None:
+        outbox.put('rem_mode', data)
+    status = None
+    try:
+        # Sent even if the circuit is open: this one must get through.
+        status = client.post(remote_url, data=data, retries=shutdown_retries,
+                             force=True,
+                             priority=thermo_arbiter.CONTROL).status_code
+    except IOError as e:
+        logger.error("Unable to deactivate remote temperature: %s", e)
+    if outbox is not None:
+        if status is not None:
+            outbox.ack('rem_mode', data)
+        else:
+            logger.warning("The rem_mode release will be sent on the next "
+                           "start, from %s", outbox_file)
+        logger.debug("Outbox stats: %s", outbox.stats())
+        outbox.close()
+    trace.record(thermo_trace.SEND, status=-1 if status is None else status)
+    if ring is not None:
+        ring.record_send(float('nan'), -1 if status is None else status)
+        ring.close()
+    logger.debug("Circuit breaker stats: %s", client.stats())
+    logger.debug("Request scheduler stats: %s", get_scheduler().stats())
+    logger.debug("HTTP connection stats: %s", get_client().stats())
+    if metrics_port is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    return exit_status
 
 
 def handle_exit(signum, frame):
@@ -132,6 +719,63 @@ def handle_exit(signum, frame):
     exitLock.release()
 
 
-if __name__ == "__main__":  # pragma: no cover
+def handle_dump(signum, frame):
+    """Writes the trace ring to a file in trace_dir"""
+    path = os.path.join(trace_dir, "remote_thermo-trace-%s.txt" %
+                        strftime("%Y%m%d-%H%M%S"))
+    try:
+        count = trace.dump(path)
+    except (IOError, OSError) as e:
+        logger.error("Unable to write the trace to %s: %s", path, e)
+        return
+    logger.info("Wrote %d trace events to %s", count, path)
+
+
+def handle_profile(signum, frame):
+    """Starts profiling, or stops and writes the profile to trace_dir"""
+    global profiler
+    if profiler is None:
+        profiler = thermo_trace.Profiler(trace_dir)
+    profiler.directory = trace_dir
+    try:
+        profiler.toggle()
+    except (IOError, OSError) as e:
+        logger.error("Unable to write the profile: %s", e)
+
+
+def handle_reload(signum, frame):
+    """Has config_file reloaded before the next tick"""
+    if reloader is None:
+        logger.warning("Recieved signal %d, but there's no config_file to "
+                       "reload", signum)
+        return
+    logger.info("Recieved signal %d, reloading %s", signum, config_file)
+    reloader.request()
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', metavar='PATH',
+                        help="JSON file of settings, reloaded on SIGHUP")
+    parser.add_argument('--rediscover', action='store_true',
+                        help="Find the thermostat again, ignoring the "
+                        "discovery cache")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    """Sets the daemon up from the command line and runs it"""
+    global config_file, rediscover
+    args = parse_args(argv)
+    if args.config is not None:
+        config_file = args.config
+    rediscover = rediscover or args.rediscover
     tstat = setup()
-    main(tstat)
+    if tstat is None:
+        return 1
+    return main(tstat)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(run())
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+
+"""
+Cached thermostat discovery.
+
+radiotherm.get_thermostat() multicasts for the thermostat and then asks it
+for its model, which can take many seconds or fail outright.  The address
+and model found are kept on disk; on the next start they're checked with a
+single cheap request to /tstat/model, and full discovery only runs if that
+check fails, the entry is older than its TTL, or rediscovery is forced.
+"""
+
+import json
+import logging
+import os
+import time
+
+import radiotherm
+import requests
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = '/var/cache/remote_thermo/thermostat.json'
+DEFAULT_TTL = 7 * 24 * 60 * 60  # One week, in seconds
+VALIDATE_TIMEOUT = 2
+
+
+def load_cache(path):
+    """Returns the cached entry at path, or None if there's no usable one"""
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.debug("No usable discovery cache at %s: %s", path, e)
+        return None
+    if not all(k in entry for k in ('host', 'model', 'time')):
+        logger.debug("Discovery cache at %s is incomplete", path)
+        return None
+    return entry
+
+
+def save_cache(path, host, model):
+    """
+    Records host and model at path.  Written to a temporary file and renamed
+    so a crash can't leave a half-written cache behind.  Failures are
+    logged, not raised: the cache is only an optimisation.
+    """
+    entry = {'host': host, 'model': model, 'time': time.time()}
+    tmp = path + '.tmp'
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.warning("Unable to save discovery cache to %s: %s", path, e)
+
+
+def clear_cache(path):
+    """Removes the cache at path, forcing discovery on the next start"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def validate(host, model, client=None, timeout=VALIDATE_TIMEOUT):
+    """
+    Checks with one request that the thermostat at host is still the model
+    we cached, and one radiotherm knows.  Returns True if so.
+    """
+    get = client.get if client is not None else requests.get
+    url = 'http://%s/tstat/model' % host
+    try:
+        r = get(url, timeout=timeout)
+        found = r.json()['model']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.info("Cached thermostat at %s didn't answer: %s", host, e)
+        return False
+    expected = radiotherm.get_thermostat_class(model)
+    if expected is None:
+        # radiotherm.get_thermostat() would return None for it
+        logger.info("Cached thermostat at %s is an unknown model, %s",
+                    host, model)
+        return False
+    if radiotherm.get_thermostat_class(found) is not expected:
+        logger.info("Cached thermostat at %s is now a %s, not a %s",
+                    host, found, model)
+        return False
+    return True
+
+
+def get_thermostat(path=CACHE_FILE, ttl=DEFAULT_TTL, client=None,
+                   rediscover=False):
+    """
+    Returns a radiotherm thermostat, from the cache at path when it's fresh
+    and still valid, otherwise from full discovery (which refreshes the
+    cache).  rediscover skips the cache entirely.
+    """
+    entry = None if rediscover else load_cache(path)
+    if entry is not None:
+        age = time.time() - entry['time']
+        if age > ttl:
+            logger.info("Discovery cache is %d seconds old, rediscovering",
+                        age)
+        elif validate(entry['host'], entry['model'], client):
+            logger.debug("Using cached thermostat %s at %s",
+                         entry['model'], entry['host'])
+            # Passing both means radiotherm makes no requests at all
+            return radiotherm.get_thermostat(entry['host'], entry['model'])
+    tstat = radiotherm.get_thermostat()
+    if tstat is not None:
+        save_cache(path, tstat.host, type(tstat).MODEL)
+    return tstat
@@ -0,0 +1,454 @@
+#! /usr/bin/env python
+
+"""
+An emulator for Radio Thermostat CT-50s, for load testing offline.
+
+Each emulated thermostat listens on its own port and answers the parts of
+the radiotherm API the daemon and web interface use: /tstat,
+/tstat/model, /tstat/ttemp, /tstat/remote_temp and
+/tstat/program/heat|cool (whole week or per day).  Like the real device it
+serves one request at a time; anything else waits its turn.  Connections
+are kept alive if the client asks (HTTP/1.1 does by default).  Latency and
+errors can be injected, and a simple thermal model heats or cools the room
+depending on the temperature the thermostat sees -- its remote temperature
+when one has been posted.
+
+Everything runs on one asyncio loop, and the thermal model is only stepped
+when a thermostat is asked something, so thousands of thermostats fit on
+one machine.
+
+    ./thermo_emulator.py --count 1000 --base-port 9000 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import resource
+import sys
+from threading import Thread
+from time import monotonic, localtime
+
+from thermo_async import read_request
+
+logger = logging.getLogger(__name__)
+
+MODEL = "CT50 V1.94"
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+# A four period program: minute of the day, then temperature, four times
+DEFAULT_HEAT_PROGRAM = [360, 70, 480, 62, 1080, 70, 1320, 62]
+DEFAULT_COOL_PROGRAM = [360, 78, 480, 85, 1080, 78, 1320, 82]
+# Seconds a kept-alive connection may sit idle before it's closed
+KEEP_ALIVE_TIMEOUT = 5
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+
+
+class ThermalModel(object):
+    """
+    A room with a thermostat in it.
+
+    The room drifts toward outdoor at leak degrees per minute per degree of
+    difference, and the HVAC moves it hvac_rate degrees per minute while
+    running.  The thermostat controls on its remote temperature if one was
+    posted in the last rem_timeout seconds, otherwise on the room
+    temperature, with a hysteresis of swing degrees either side of the
+    target.  time_scale speeds the simulation up relative to clock.
+    """
+
+    def __init__(self, temp=68.0, outdoor=40.0, leak=0.01, hvac_rate=0.3,
+                 swing=0.5, rem_timeout=600, time_scale=1.0,
+                 clock=monotonic):
+        self.temp = temp
+        self.outdoor = outdoor
+        self.leak = leak
+        self.hvac_rate = hvac_rate
+        self.swing = swing
+        self.rem_timeout = rem_timeout
+        self.time_scale = time_scale
+        self.clock = clock
+        self.tmode = 1  # 0 off, 1 heat, 2 cool, 3 auto
+        self.fmode = 0  # 0 auto, 1 circulate, 2 on
+        self.t_heat = 70.0
+        self.t_cool = 78.0
+        self.hold = 0
+        self.override = 0
+        self.tstate = 0  # 0 off, 1 heating, 2 cooling
+        self.rem_mode = 0
+        self.rem_temp = None
+        self.programs = {
+            'heat': dict((str(i), list(DEFAULT_HEAT_PROGRAM))
+                         for i in range(7)),
+            'cool': dict((str(i), list(DEFAULT_COOL_PROGRAM))
+                         for i in range(7)),
+        }
+        self._now = clock()
+        self._rem_posted = None
+
+    def sensed_temp(self):
+        """The temperature the thermostat is controlling on"""
+        if self.rem_mode and self.rem_temp is not None:
+            return self.rem_temp
+        return self.temp
+
+    def set_remote(self, rem_temp=None, rem_mode=None):
+        """Applies a post to /tstat/remote_temp"""
+        self.step()
+        if rem_temp is not None:
+            self.rem_temp = float(rem_temp)
+            self.rem_mode = 1
+            self._rem_posted = self._now
+        if rem_mode is not None:
+            self.rem_mode = int(rem_mode)
+
+    def step(self):
+        """Advances the model to the clock's current time"""
+        now = self.clock()
+        minutes = (now - self._now) * self.time_scale / 60.0
+        self._now = now
+        if self.rem_mode and self._rem_posted is not None and \
+                (now - self._rem_posted) * self.time_scale > self.rem_timeout:
+            logger.debug("Remote temperature expired")
+            self.rem_mode = 0
+        if minutes <= 0:
+            return
+        # Integrate in steps of at most a minute, so long gaps between
+        # requests still let the controller switch on and off sensibly.
+        while minutes > 0:
+            dt = min(minutes, 1.0)
+            minutes -= dt
+            self._control()
+            self.temp += (self.outdoor - self.temp) * self.leak * dt
+            if self.tstate == 1:
+                self.temp += self.hvac_rate * dt
+            elif self.tstate == 2:
+                self.temp -= self.hvac_rate * dt
+
+    def _control(self):
+        """Switches the HVAC on or off based on the sensed temperature"""
+        sensed = self.sensed_temp()
+        heating = self.tmode in (1, 3)
+        cooling = self.tmode in (2, 3)
+        if self.tstate == 1:
+            if not heating or sensed > self.t_heat + self.swing:
+                self.tstate = 0
+        elif self.tstate == 2:
+            if not cooling or sensed < self.t_cool - self.swing:
+                self.tstate = 0
+        if self.tstate == 0:
+            if heating and sensed < self.t_heat - self.swing:
+                self.tstate = 1
+            elif cooling and sensed > self.t_cool + self.swing:
+                self.tstate = 2
+
+    def tstat(self):
+        """The body of GET /tstat"""
+        self.step()
+        now = localtime()
+        state = {
+            'temp': round(self.sensed_temp(), 2),
+            'tmode': self.tmode,
+            'fmode': self.fmode,
+            'override': self.override,
+            'hold': self.hold,
+            'tstate': self.tstate,
+            'fstate': 1 if self.tstate or self.fmode == 2 else 0,
+            'time': {'day': now.tm_wday, 'hour': now.tm_hour,
+                     'minute': now.tm_min},
+            't_type_post': 0,
+        }
+        if self.tmode in (1, 3):
+            state['t_heat'] = self.t_heat
+        if self.tmode in (2, 3):
+            state['t_cool'] = self.t_cool
+        return state
+
+    def update(self, values):
+        """Applies a post to /tstat"""
+        self.step()
+        for key in ('tmode', 'fmode', 'hold'):
+            if key in values:
+                setattr(self, key, int(values[key]))
+        for key in ('t_heat', 't_cool'):
+            for name in (key, 'i' + key, 'a_' + key[2:]):
+                if name in values:
+                    setattr(self, key, float(values[name]))
+
+
+class EmulatedThermostat(object):
+    """
+    One emulated thermostat: a ThermalModel plus the HTTP API in front of
+    it.  latency (plus up to jitter) seconds is spent on every request;
+    error_rate is the chance of a request failing with an HTTP 500.
+    """
+
+    def __init__(self, model=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                 rng=None):
+        if model is None:
+            model = ThermalModel()
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = rng or random.Random()
+        self.requests = 0
+        self.errors = 0
+        self.port = None
+        self.connections = set()
+        self._busy = None
+
+    @property
+    def busy(self):
+        """The lock serialising requests, created on the running loop"""
+        if self._busy is None:
+            self._busy = asyncio.Lock()
+        return self._busy
+
+    def handle(self, method, path, body):
+        """
+        Answers one request.  Returns (status code, JSON-able body).
+        Raises ValueError for bodies which aren't valid JSON.
+        """
+        parts = [p for p in path.split('?', 1)[0].split('/') if p]
+        values = json.loads(body) if body else {}
+        model = self.model
+        if parts == ['tstat']:
+            if method == 'POST':
+                model.update(values)
+                return 200, {'success': 0}
+            return 200, model.tstat()
+        if parts == ['tstat', 'model'] and method == 'GET':
+            return 200, {'model': MODEL}
+        if parts == ['tstat', 'ttemp'] and method == 'GET':
+            return 200, {'t_heat': model.t_heat, 't_cool': model.t_cool}
+        if parts == ['tstat', 'remote_temp']:
+            if method == 'POST':
+                model.set_remote(values.get('rem_temp'),
+                                 values.get('rem_mode'))
+                return 200, {'success': 0}
+            model.step()
+            return 200, {'rem_mode': model.rem_mode}
+        if len(parts) in (3, 4) and parts[:2] == ['tstat', 'program'] and \
+                parts[2] in model.programs:
+            return self._program(method, parts[2], parts[3:], values)
+        return 404, {'error': 'not found'}
+
+    def _program(self, method, mode, day, values):
+        """Answers /tstat/program/<mode>[/<day>]"""
+        programs = self.model.programs[mode]
+        if day:
+            if day[0] not in DAYS:
+                return 404, {'error': 'not found'}
+            key = str(DAYS.index(day[0]))
+            if method == 'POST':
+                # Either {"<day number>": [...]} or just the list
+                if isinstance(values, dict):
+                    values = values[key]
+                programs[key] = list(values)
+                return 200, {'success': 0}
+            return 200, {key: programs[key]}
+        if method == 'POST':
+            for key, program in values.items():
+                if key in programs:
+                    programs[key] = list(program)
+            return 200, {'success': 0}
+        return 200, dict(programs)
+
+    async def serve(self, reader, writer):
+        """
+        Serves one connection for as long as the client keeps it alive,
+        answering one request at a time across all connections
+        """
+        self.connections.add(writer)
+        try:
+            keep_alive = True
+            timeout = None
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(read_request(reader),
+                                                     timeout)
+                except ValueError:
+                    writer.write(format_response(
+                        400, {'error': 'bad request'}))
+                    await writer.drain()
+                    return
+                except asyncio.TimeoutError:
+                    return
+                if request is None:
+                    return
+                method, path, body, keep_alive = request
+                async with self.busy:
+                    code, result = await self.answer(method, path, body)
+                writer.write(format_response(code, result, keep_alive))
+                await writer.drain()
+                timeout = KEEP_ALIVE_TIMEOUT
+        except (IOError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def answer(self, method, path, body):
+        """
+        Answers one request after the injected latency, perhaps with an
+        injected error.  Returns (status code, JSON-able body).
+        """
+        self.requests += 1
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return 500, {'error': 'injected failure'}
+        try:
+            return self.handle(method, path, body)
+        except (ValueError, TypeError, AttributeError, KeyError):
+            return 400, {'error': 'bad request'}
+
+
+def format_response(code, result, keep_alive=False):
+    """Builds a complete HTTP response for a JSON result"""
+    body = json.dumps(result).encode('utf-8')
+    return ("HTTP/1.1 %d %s\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: %d\r\n"
+            "Connection: %s\r\n"
+            "\r\n" % (code, HTTP_REASONS.get(code, ""), len(body),
+                      'keep-alive' if keep_alive else 'close')
+            ).encode('ascii') + body
+
+
+class Emulator(object):
+    """
+    Hosts count emulated thermostats on consecutive ports from base_port
+    (0 picks free ports).  Keyword arguments are passed to every
+    EmulatedThermostat; model_args to every ThermalModel.
+    """
+
+    def __init__(self, count=1, base_port=0, host='127.0.0.1',
+                 model_args=None, seed=None, **kwargs):
+        self.host = host
+        self.base_port = base_port
+        rng = random.Random(seed)
+        self.thermostats = [
+            EmulatedThermostat(ThermalModel(**(model_args or {})),
+                               rng=random.Random(rng.random()), **kwargs)
+            for _ in range(count)]
+        self._servers = []
+        self._loop = None
+        self._thread = None
+
+    @property
+    def addresses(self):
+        """The host:port of every thermostat, as radiotherm expects them"""
+        return ["%s:%d" % (self.host, t.port) for t in self.thermostats]
+
+    async def start(self):
+        """Starts listening for every thermostat"""
+        raise_fd_limit(len(self.thermostats) * 2 + 64)
+        for i, tstat in enumerate(self.thermostats):
+            port = self.base_port + i if self.base_port else 0
+            # A tiny backlog, like the real thing
+            server = await asyncio.start_server(tstat.serve, self.host,
+                                                port, backlog=4)
+            tstat.port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        logger.info("Emulating %d thermostats", len(self.thermostats))
+
+    async def stop(self):
+        """Stops listening and closes any kept-alive connections"""
+        for server in self._servers:
+            server.close()
+        for tstat in self.thermostats:
+            for writer in list(tstat.connections):
+                writer.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+
+    def start_in_thread(self):
+        """
+        Runs the emulator on its own loop in a daemon thread, returning once
+        every thermostat is listening.  For use from blocking code.
+        """
+        self._loop = asyncio.new_event_loop()
+        started = asyncio.run_coroutine_threadsafe(self.start(), self._loop)
+        self._thread = Thread(target=self._loop.run_forever,
+                              name="thermo-emulator")
+        self._thread.daemon = True
+        self._thread.start()
+        started.result()
+        return self
+
+    def stop_thread(self):
+        """Stops an emulator started with start_in_thread()"""
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def raise_fd_limit(wanted):
+    """Raises the open file limit towards wanted, as far as allowed"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError) as e:  # pragma: no cover
+        logger.warning("Unable to raise the open file limit: %s", e)
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description="Emulates CT-50s")
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds spent on every request")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="Up to this many extra seconds per request")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with HTTP 500")
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help="How much faster than real time rooms change")
+    parser.add_argument('--addresses', metavar='FILE',
+                        help="Write the thermostats' addresses here as JSON")
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs the emulator until interrupted"""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    emulator = Emulator(args.count, args.base_port, args.host,
+                        model_args={'time_scale': args.time_scale},
+                        seed=args.seed, latency=args.latency,
+                        jitter=args.jitter, error_rate=args.error_rate)
+
+    async def run():
+        await emulator.start()
+        if args.addresses:
+            with open(args.addresses, 'w') as f:
+                json.dump(emulator.addresses, f)
+        await asyncio.Event().wait()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
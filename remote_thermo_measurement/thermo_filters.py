@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+
+"""
+Oversampling and filtering of raw ADC readings.
+
+A single ADC read per tick is noisy enough that the daemon has to sample
+often to get a usable average.  A BurstSampler instead takes several reads
+per tick into a preallocated NumPy array and reduces them with a pluggable
+FilterChain: a vectorized reducer (median, trimmed mean, ...) turning the
+burst into one value, optionally followed by smoothing stages (Kalman, EMA)
+carrying state from tick to tick.
+
+Filters work on raw readings.  The TMP36 conversion is linear, so filtering
+before or after it gives the same temperature.
+"""
+
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+def mean(samples):
+    """Reduces a burst to its mean"""
+    return float(samples.mean())
+
+
+def median(samples):
+    """
+    Reduces a burst to its median.  Sorts samples in place, which avoids an
+    allocation; bursts are scratch space.
+    """
+    samples.sort()
+    n = samples.shape[0]
+    mid = n // 2
+    if n % 2:
+        return float(samples[mid])
+    return float(samples[mid - 1:mid + 1].mean())
+
+
+class TrimmedMean(object):
+    """
+    Reduces a burst to the mean of what's left after dropping proportion of
+    the samples from each end.  Sorts samples in place.
+    """
+
+    def __init__(self, proportion=0.2):
+        if not 0 <= proportion < 0.5:
+            raise ValueError("Can only trim between 0 and half the samples")
+        self.proportion = proportion
+
+    def __call__(self, samples):
+        samples.sort()
+        n = samples.shape[0]
+        cut = int(n * self.proportion)
+        return float(samples[cut:n - cut].mean())
+
+
+class Ema(object):
+    """An exponential moving average stage.  factor weighs the new value."""
+
+    def __init__(self, factor=.1):
+        self.factor = factor
+        self.value = None
+
+    def __call__(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.factor * (value - self.value)
+        return self.value
+
+
+class Kalman(object):
+    """
+    A scalar Kalman filter stage for a slowly varying value.
+
+    process_var is how much the true value is expected to wander between
+    ticks, measurement_var how noisy each (already reduced) value is.
+    """
+
+    def __init__(self, process_var=1e-6, measurement_var=1e-4):
+        self.process_var = process_var
+        self.measurement_var = measurement_var
+        self.value = None
+        self.error_var = None
+
+    def __call__(self, value):
+        if self.value is None:
+            self.value = value
+            self.error_var = self.measurement_var
+            return value
+        self.error_var += self.process_var
+        gain = self.error_var / (self.error_var + self.measurement_var)
+        self.value += gain * (value - self.value)
+        self.error_var *= (1 - gain)
+        return self.value
+
+
+class FilterChain(object):
+    """
+    A reducer taking a burst array to a single value, followed by any number
+    of stages each taking and returning a single value.  Any callables with
+    those signatures can be plugged in.
+    """
+
+    def __init__(self, reducer=median, stages=()):
+        self.reducer = reducer
+        self.stages = list(stages)
+
+    def __call__(self, samples):
+        value = self.reducer(samples)
+        for stage in self.stages:
+            value = stage(value)
+        return value
+
+
+class BurstSampler(object):
+    """
+    Takes samples reads per call from read into a preallocated array and
+    returns the filtered result.
+    """
+
+    def __init__(self, read, samples=8, chain=None):
+        if samples < 1:
+            raise ValueError("Need at least one sample per burst")
+        self.read = read
+        self.buffer = numpy.empty(samples, dtype=numpy.float64)
+        if chain is None:
+            chain = FilterChain()
+        self.chain = chain
+
+    @property
+    def samples(self):
+        """Number of reads per burst"""
+        return self.buffer.shape[0]
+
+    def __call__(self):
+        buf = self.buffer
+        read = self.read
+        for i in range(buf.shape[0]):
+            buf[i] = read()
+        return self.chain(buf)
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+
+"""
+A pooled, keep-alive HTTP client for talking to thermostats.
+
+The CT-50's embedded web server is slow to accept new connections, so
+opening one per post (as a bare requests.post does) costs far more than the
+request itself.  PooledClient keeps connections open between requests and
+counts how often a connection was reused versus freshly opened.
+"""
+
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Number of distinct thermostats to keep connection pools for
+DEFAULT_POOL_SIZE = 4
+# Connections per thermostat.  The thermostats serve one request at a time,
+# so more than one connection only queues up on the device.
+DEFAULT_PER_HOST = 1
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+
+
+class UrlopenResponse(object):
+    """
+    Wraps a requests response so it looks like the file-like object
+    urllib's urlopen returns, which is what radiotherm expects.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.code = response.status_code
+        self.msg = response.reason
+        self._body = response.content
+        self._read = False
+
+    def getcode(self):
+        """Returns the HTTP status code"""
+        return self.code
+
+    def read(self):
+        """Returns the response body.  Like a file, only once."""
+        if self._read:
+            return b""
+        self._read = True
+        return self._body
+
+
+def attach(client, tstat):
+    """
+    Routes a radiotherm thermostat's own get/post calls through client,
+    anything with a requests-style get() and post().
+    """
+    def get(relative_url):
+        return UrlopenResponse(
+            client.get(tstat._construct_url(relative_url)))
+
+    def post(relative_url, value):
+        return UrlopenResponse(client.post(
+            tstat._construct_url(relative_url), data=value,
+            headers=tstat.JSON_HEADER))
+    tstat.get = get
+    tstat.post = post
+    return tstat
+
+
+class PooledClient(object):
+    """
+    A connection pooling HTTP client.
+
+    pool_size is how many thermostats to keep pools for, per_host is how
+    many connections each pool may hold.  If block is set, callers wait for
+    a free connection rather than exceeding per_host.  Timeouts are in
+    seconds and apply to every request.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, per_host=DEFAULT_PER_HOST,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, block=True):
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(pool_connections=pool_size,
+                                   pool_maxsize=per_host, pool_block=block)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        # Counts from pools evicted because there were more thermostats
+        # than pool_size.
+        self._retired_connections = 0
+        self._retired_requests = 0
+        pools = self.adapter.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def _retire(pool):
+            self._retired_connections += pool.num_connections
+            self._retired_requests += pool.num_requests
+            if dispose is not None:
+                dispose(pool)
+        pools.dispose_func = _retire
+
+    def request(self, method, url, **kwargs):
+        """Performs a request through the pool.  Returns a requests
+        response."""
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """GETs url through the pool"""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        """POSTs data to url through the pool"""
+        return self.request('POST', url, data=data, **kwargs)
+
+    def attach(self, tstat):
+        """
+        Routes a radiotherm thermostat's own get/post calls through this
+        pool, so its fields share connections with everything else.
+        """
+        return attach(self, tstat)
+
+    def stats(self):
+        """
+        Returns a dict of connection counters: requests made, connections
+        opened and requests which reused an already-open connection.
+        """
+        connections = self._retired_connections
+        reqs = self._retired_requests
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            reqs += pool.num_requests
+        return {
+            'requests': reqs,
+            'new_connections': connections,
+            'reused_connections': max(0, reqs - connections),
+        }
+
+    def close(self):
+        """Closes all pooled connections"""
+        self.session.close()
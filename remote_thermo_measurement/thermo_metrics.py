@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+
+"""
+Lightweight metrics for the daemon's hot path, served in the Prometheus
+text format.
+
+Recording is a bisect and a couple of additions per observation; nothing is
+formatted until someone actually scrapes /metrics.  The HTTP endpoint is
+only started if asked for, on its own daemon thread.
+"""
+
+import logging
+from bisect import bisect_left
+from threading import Thread
+from time import monotonic
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds.  ADC reads are sub-millisecond; posts to the
+# thermostat take anywhere from tens of milliseconds to the read timeout.
+READ_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .1)
+POST_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+LATENESS_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1)
+
+
+def _format_value(value):
+    """Formats a sample value the way Prometheus expects"""
+    if isinstance(value, int):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    """A fixed-bucket histogram of observed values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets):
+        self.name = name
+        self.doc = doc
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Records one value"""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        """Yields (name, labels, value) tuples for rendering"""
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            yield (self.name + '_bucket', {'le': _format_value(bound)},
+                   cumulative)
+        yield self.name + '_sum', {}, self.sum
+        yield self.name + '_count', {}, self.count
+
+
+class Counter(object):
+    """A set of monotonically increasing counts, keyed by one label"""
+
+    kind = 'counter'
+
+    def __init__(self, name, doc, label):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.values = {}
+
+    def inc(self, key, amount=1):
+        """Increments the count for label value key"""
+        key = str(key)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """Yields (name, labels, value) tuples for rendering"""
+        for key in sorted(self.values):
+            yield self.name, {self.label: key}, self.values[key]
+
+
+class Gauge(object):
+    """
+    A single value which can go up and down.  If func is given, it's called
+    at scrape time instead of holding a value.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, func=None):
+        self.name = name
+        self.doc = doc
+        self.func = func
+        self.value = float('nan')
+
+    def set(self, value):
+        """Sets the current value"""
+        self.value = value
+
+    def samples(self):
+        """Yields (name, labels, value) tuples for rendering"""
+        value = self.func() if self.func is not None else self.value
+        yield self.name, {}, value
+
+
+class Registry(object):
+    """An ordered collection of metrics which renders them for scraping"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """Registers metric.  Returns it, for convenience."""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.doc))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += "{%s}" % ",".join(
+                        '%s="%s"' % item for item in sorted(labels.items()))
+                lines.append("%s %s" % (name, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class DaemonMetrics(Registry):
+    """The metrics thermo_daemon records"""
+
+    def __init__(self, clock=monotonic):
+        Registry.__init__(self)
+        started = clock()
+        self.read_latency = self.add(Histogram(
+            'thermo_read_seconds', "Time taken by read_temp()",
+            READ_BUCKETS))
+        self.post_latency = self.add(Histogram(
+            'thermo_post_seconds', "Round trip time of thermostat requests",
+            POST_BUCKETS))
+        self.post_status = self.add(Counter(
+            'thermo_post_responses_total',
+            "Thermostat responses by HTTP status code", 'code'))
+        self.queue_wait = self.add(Histogram(
+            'thermo_request_queue_seconds',
+            "Time thermostat requests waited for their turn", POST_BUCKETS))
+        self.tick_lateness = self.add(Histogram(
+            'thermo_tick_lateness_seconds',
+            "How late each read tick fired", LATENESS_BUCKETS))
+        self.avgtemp = self.add(Gauge(
+            'thermo_average_temperature_fahrenheit',
+            "The current averaged temperature"))
+        self.read_interval = self.add(Gauge(
+            'thermo_read_interval_seconds',
+            "Seconds between reads, which varies with adaptive sampling"))
+        self.adc_raw = self.add(Gauge(
+            'thermo_adc_raw_ratio', "The last raw ADC reading, 0-1"))
+        self.uptime = self.add(Gauge(
+            'thermo_uptime_seconds', "Seconds since the daemon started",
+            lambda: clock() - started))
+
+
+class InstrumentedClient(object):
+    """
+    Wraps an HTTP client, timing each request and counting status codes
+    into a DaemonMetrics.  Requests which fail outright count as 'error'.
+    """
+
+    def __init__(self, client, metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def _timed(self, method, url, **kwargs):
+        """Performs one request through the wrapped client"""
+        start = monotonic()
+        try:
+            r = getattr(self.client, method)(url, **kwargs)
+        except IOError:
+            self.metrics.post_status.inc('error')
+            raise
+        finally:
+            self.metrics.post_latency.observe(monotonic() - start)
+        self.metrics.post_status.inc(r.status_code)
+        return r
+
+    def get(self, url, **kwargs):
+        """GETs url through the wrapped client"""
+        return self._timed('get', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        """POSTs data to url through the wrapped client"""
+        return self._timed('post', url, data=data, **kwargs)
+
+    def stats(self):
+        """Returns the wrapped client's stats"""
+        return self.client.stats()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the server's registry at /metrics"""
+
+    def do_GET(self):
+        """Renders the registry, only at /metrics"""
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Sends access logs to debug rather than stderr"""
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+
+def serve(registry, port, address=''):
+    """
+    Serves registry at http://address:port/metrics from a daemon thread.
+    Returns the server; call shutdown() on it to stop.
+    """
+    server = HTTPServer((address, port), MetricsHandler)
+    server.registry = registry
+    thread = Thread(target=server.serve_forever, name="thermo-metrics")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on port %d", server.server_port)
+    return server
@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+
+"""
+A durable store-and-forward outbox for thermostat writes.
+
+A post which can't reach the thermostat is otherwise lost, and losing the
+shutdown {"rem_mode": 0} leaves the thermostat controlling on a remote
+temperature nobody updates any more.  Writes are recorded in an Outbox
+before they're sent and acknowledged once the thermostat has them; anything
+unacknowledged is still there after a restart, to be sent again.
+
+The outbox keeps only the latest value for each key (e.g. "rem_temp"), and
+a key can supersede others: a fresh rem_temp makes an old rem_mode release
+pointless, and the release makes any pending rem_temp wrong.  On disk it's
+an append-only log of JSON lines, one per put, ack or drop.  Once the log
+grows past max_bytes it's compacted, rewritten with just the pending
+entries, so it never takes much more than max_bytes.  A line torn by a
+crash mid-write is ignored when the log is read back.
+"""
+
+import json
+import logging
+import os
+from threading import RLock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 64 * 1024
+
+PUT = 'put'
+ACK = 'ack'
+DROP = 'drop'
+
+
+class Outbox(object):
+    """
+    Pending writes, by key, logged to path.
+
+    supersedes maps a key to the keys a put of it removes.  With fsync,
+    every entry is on disk before put() returns.  Safe to share between
+    threads.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, supersedes=None,
+                 fsync=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.supersedes = supersedes or {}
+        self.fsync = fsync
+        self.pending = {}
+        self.compactions = 0
+        self._order = 0
+        self._log = None
+        self._lock = RLock()
+        self._load()
+        self.compact()
+
+    def _load(self):
+        """Replays the log into pending"""
+        try:
+            f = open(self.path)
+        except (IOError, OSError):
+            return
+        with f:
+            for number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                    self._apply(entry['op'], entry['key'], entry.get('data'))
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Ignoring damaged outbox entry at %s:%d",
+                                   self.path, number)
+
+    def _apply(self, op, key, data):
+        """Applies one log entry to pending"""
+        if op == PUT:
+            for other in self.supersedes.get(key, ()):
+                self.pending.pop(other, None)
+            self._order += 1
+            self.pending[key] = (self._order, data)
+        elif op == ACK:
+            if key in self.pending and self.pending[key][1] == data:
+                del self.pending[key]
+        elif op == DROP:
+            self.pending.pop(key, None)
+        else:
+            raise ValueError("Unknown outbox operation %r" % op)
+
+    def _append(self, op, key, data=None):
+        """Applies an entry and logs it, compacting the log if it's full"""
+        self._apply(op, key, data)
+        entry = {'op': op, 'key': key}
+        if data is not None:
+            entry['data'] = data
+        self._log.write(json.dumps(entry, sort_keys=True) + "\n")
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        if self._log.tell() > self.max_bytes:
+            self._compact()
+
+    def put(self, key, data):
+        """Records data as the latest value to send for key"""
+        with self._lock:
+            self._append(PUT, key, data)
+
+    def ack(self, key, data):
+        """
+        Records that data was delivered for key.  Does nothing if a newer
+        value has been put since.
+        """
+        with self._lock:
+            if key in self.pending and self.pending[key][1] == data:
+                self._append(ACK, key, data)
+
+    def discard(self, key):
+        """Forgets any pending value for key"""
+        with self._lock:
+            if key in self.pending:
+                self._append(DROP, key)
+
+    def entries(self):
+        """Returns the pending (key, data) pairs, oldest first"""
+        with self._lock:
+            return [(key, data) for key, (_, data) in sorted(
+                self.pending.items(), key=lambda item: item[1][0])]
+
+    def compact(self):
+        """
+        Rewrites the log with only the pending entries.  Written to a
+        temporary file and renamed, so a crash leaves either log intact.
+        """
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        """compact(), with the lock held"""
+        if self._log is not None:
+            self._log.close()
+        tmp = self.path + '.tmp'
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp, 'w') as f:
+            for key, data in self.entries():
+                f.write(json.dumps({'op': PUT, 'key': key, 'data': data},
+                                   sort_keys=True) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.compactions += 1
+        self._log = open(self.path, 'a')
+
+    def size(self):
+        """Returns the log's size in bytes"""
+        return self._log.tell()
+
+    def close(self):
+        """Closes the log"""
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def stats(self):
+        """Returns the pending keys, log size and compaction count"""
+        return {
+            'pending': sorted(self.pending),
+            'bytes': self.size() if self._log is not None else 0,
+            'compactions': self.compactions,
+        }
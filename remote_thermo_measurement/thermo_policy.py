@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+
+"""
+Send suppression for remote temperature posts.
+
+Posting the same averaged temperature every send period is pure load on the
+thermostat and the Wi-Fi.  A SendPolicy only lets a value through when it
+has moved by more than a deadband since the last post, or when the last
+post is older than a heartbeat interval, so the thermostat never goes long
+enough without an update to fall back to its internal sensor.  Only posts
+the thermostat accepted count: callers report them with sent().
+"""
+
+import logging
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class SendPolicy(object):
+    """
+    Decides whether a temperature is worth posting.
+
+    deadband is in degrees; a value is sent when it differs from the last
+    sent value by more than this.  None disables suppression entirely, so
+    every value is sent.  heartbeat is the most seconds allowed between
+    sends regardless of change; None means no heartbeat.
+    """
+
+    def __init__(self, deadband=None, heartbeat=None, clock=monotonic):
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.last_value = None
+        self.last_sent = None
+        self.sends = 0
+        self.heartbeats = 0
+        self.suppressed = 0
+
+    def should_send(self, value):
+        """
+        Returns whether value should be posted.  Nothing is recorded until
+        sent() is called, so a value which doesn't get through is offered
+        again next time rather than suppressed as already sent.
+        """
+        now = self.clock()
+        if self.deadband is None or self.last_value is None:
+            return True
+        if abs(value - self.last_value) > self.deadband:
+            return True
+        if self.heartbeat is not None and \
+                now - self.last_sent >= self.heartbeat:
+            self.heartbeats += 1
+            logger.debug("Heartbeat due, sending unchanged %.2f", value)
+            return True
+        self.suppressed += 1
+        logger.debug("Suppressing %.2f, within %.2f of last sent %.2f",
+                     value, self.deadband, self.last_value)
+        return False
+
+    def sent(self, value):
+        """
+        Records that value reached the thermostat.  May be called from
+        another thread, e.g. a sender's.
+        """
+        # last_sent first: should_send() only reads it once last_value is set
+        self.last_sent = self.clock()
+        self.last_value = value
+        self.sends += 1
+
+    def stats(self):
+        """Returns a dict of send/suppression counters"""
+        return {
+            'sent': self.sends,
+            'heartbeats': self.heartbeats,
+            'suppressed': self.suppressed,
+        }
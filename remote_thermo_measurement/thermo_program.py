@@ -0,0 +1,320 @@
+#! /usr/bin/env python
+
+"""
+Syncs heat and cool programs (weekly schedules) to thermostats.
+
+Writing a whole week to /tstat/program/heat is slow on a CT-50, and most
+changes only touch a day or two.  ProgramSync keeps each thermostat's
+programs in a local cache, works out which days differ from the desired
+schedule and writes only those, one /tstat/program/<mode>/<day> post each.
+The cache is refreshed from the thermostat once it's older than its TTL,
+and dropped for a mode whenever a write fails, since the device's state is
+then unknown.  sync_all() does this for many thermostats at once.
+
+Programs are dicts from day number ("0" is Monday) to the thermostat's
+list of minute of the day, temperature pairs.  Schedule files are JSON:
+
+    {"heat": {"mon": [360, 70, 480, 62, 1080, 70, 1320, 62], ...},
+     "cool": {...}}
+
+Days may be named or numbered; days left out are left alone.
+
+    ./thermo_program.py schedule.json 10.0.0.21 10.0.0.22 --dry-run
+
+Where a thermo_proxy is in front of a thermostat, give its address instead,
+so the writes wait their turn with the web interface's requests.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import radiotherm
+
+import thermo_http
+
+logger = logging.getLogger(__name__)
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MODES = ('heat', 'cool')
+CACHE_FILE = '/var/cache/remote_thermo/programs.json'
+DEFAULT_TTL = 24 * 60 * 60  # One day, in seconds
+# Thermostats synced at once by sync_all().  Each is still sent one request
+# at a time.
+DEFAULT_WORKERS = 8
+
+
+def day_key(day):
+    """Returns the thermostat's key ("0"-"6") for a day name or number"""
+    day = str(day).lower()
+    if day in DAYS:
+        return str(DAYS.index(day))
+    if day.isdigit() and int(day) < len(DAYS):
+        return str(int(day))
+    raise ValueError("Not a day: %r" % day)
+
+
+def normalize(program):
+    """
+    Returns program with day keys as the thermostat uses them and every
+    value as a list of numbers.
+    """
+    normalized = {}
+    for day, periods in program.items():
+        periods = list(periods)
+        if len(periods) % 2:
+            raise ValueError("Program for %s isn't time, temperature pairs"
+                             % day)
+        normalized[day_key(day)] = [int(p) if float(p).is_integer()
+                                    else float(p) for p in periods]
+    return normalized
+
+
+def diff_program(current, desired):
+    """
+    Returns the days of desired which differ from current, as a program.
+    Both are normalized first; days missing from desired aren't compared.
+    """
+    current = normalize(current)
+    return dict((day, periods)
+                for day, periods in normalize(desired).items()
+                if current.get(day) != periods)
+
+
+class ProgramCache(object):
+    """
+    The last known programs of each thermostat, by host and mode, kept in
+    the JSON file at path (or only in memory, if path is None).  Entries
+    older than ttl seconds are ignored.
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=DEFAULT_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        if path is not None:
+            self.load()
+
+    def load(self):
+        """Reads the cache file, if there's a usable one"""
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug("No usable program cache at %s: %s", self.path, e)
+            return
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    def save(self):
+        """
+        Writes the cache file.  Written to a temporary file and renamed so a
+        crash can't leave a half-written cache; failures are only logged.
+        """
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("Unable to save program cache to %s: %s",
+                           self.path, e)
+
+    def get(self, host, mode):
+        """Returns the cached program for host and mode, or None"""
+        entry = self.entries.get(host, {}).get(mode)
+        if entry is None or self.clock() - entry['time'] > self.ttl:
+            return None
+        return entry['program']
+
+    def put(self, host, mode, program):
+        """Records the program host now has for mode"""
+        self.entries.setdefault(host, {})[mode] = {
+            'program': normalize(program), 'time': self.clock()}
+
+    def update(self, host, mode, days):
+        """Records days written to an already cached program"""
+        entry = self.entries.get(host, {}).get(mode)
+        if entry is not None:
+            entry['program'].update(normalize(days))
+
+    def invalidate(self, host, mode=None):
+        """Forgets host's program for mode, or every mode"""
+        if mode is None:
+            self.entries.pop(host, None)
+        else:
+            self.entries.get(host, {}).pop(mode, None)
+
+
+class ProgramSync(object):
+    """
+    Reads and writes one thermostat's programs through tstat, a radiotherm
+    thermostat (normally from thermo_daemon.connect()), using cache.
+    """
+
+    def __init__(self, tstat, cache=None):
+        self.tstat = tstat
+        self.cache = cache if cache is not None else ProgramCache(None)
+        self.host = tstat.host
+        self.reads = 0
+        self.writes = 0
+
+    def current(self, mode, refresh=False):
+        """Returns the program for mode, from the cache unless refresh"""
+        if mode not in MODES:
+            raise ValueError("Not a program mode: %r" % mode)
+        program = None if refresh else self.cache.get(self.host, mode)
+        if program is None:
+            self.reads += 1
+            program = getattr(self.tstat, 'program_' + mode)['raw']
+            self.cache.put(self.host, mode, program)
+            program = self.cache.get(self.host, mode)
+        return program
+
+    def _write_day(self, mode, name, program):
+        """
+        Posts one day's program, as radiotherm's set_day_program() does but
+        checking the response.
+        """
+        response = self.tstat.post('/tstat/program/%s/%s' % (mode, name),
+                                   json.dumps(program).encode('utf-8'))
+        if response.getcode() >= 400:
+            raise IOError("HTTP %d writing the %s %s program" % (
+                response.getcode(), name, mode))
+
+    def sync(self, mode, desired, refresh=False, dry_run=False):
+        """
+        Writes the days of desired which differ from what the thermostat
+        has.  Returns the names of the days written (or which would be).
+        """
+        changes = diff_program(self.current(mode, refresh), desired)
+        written = []
+        for day in sorted(changes):
+            name = DAYS[int(day)]
+            if not dry_run:
+                try:
+                    self._write_day(mode, name, {day: changes[day]})
+                except Exception:
+                    # It may or may not have taken; read it afresh next time
+                    self.cache.invalidate(self.host, mode)
+                    raise
+                self.writes += 1
+                self.cache.update(self.host, mode, {day: changes[day]})
+            written.append(name)
+        if written:
+            logger.info("%s %s program for %s on %s",
+                        "Would update" if dry_run else "Updated", mode,
+                        ', '.join(written), self.host)
+        return written
+
+    def sync_schedule(self, schedule, refresh=False, dry_run=False):
+        """
+        Syncs every mode in schedule ({mode: program}).  Returns
+        {mode: days written}.
+        """
+        return dict((mode, self.sync(mode, program, refresh, dry_run))
+                    for mode, program in schedule.items())
+
+
+def sync_all(thermostats, schedule, cache=None, workers=DEFAULT_WORKERS,
+             refresh=False, dry_run=False):
+    """
+    Syncs schedule to every thermostat at once, workers at a time.  Returns
+    {host: {mode: days written}}, or the exception for a thermostat which
+    failed.  The cache is saved afterwards.
+    """
+    if cache is None:
+        cache = ProgramCache(None)
+    results = {}
+
+    def sync(tstat):
+        try:
+            results[tstat.host] = ProgramSync(tstat, cache).sync_schedule(
+                schedule, refresh, dry_run)
+        except (IOError, ValueError, KeyError) as e:
+            logger.warning("Unable to sync programs to %s: %s",
+                           tstat.host, e)
+            results[tstat.host] = e
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        list(pool.map(sync, thermostats))
+    cache.save()
+    return results
+
+
+def load_schedule(path):
+    """Loads a schedule file: {mode: program}, normalized"""
+    with open(path) as f:
+        schedule = json.load(f)
+    for mode in schedule:
+        if mode not in MODES:
+            raise ValueError("Not a program mode: %r" % mode)
+    return dict((mode, normalize(program))
+                for mode, program in schedule.items())
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('schedule', help="JSON schedule file")
+    parser.add_argument('thermostats', nargs='+',
+                        help="Thermostat host[:port]s, or their "
+                        "thermo_proxy's")
+    parser.add_argument('--cache', default=CACHE_FILE,
+                        help="Program cache file")
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL,
+                        help="Seconds to trust cached programs for")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Read every program from the thermostats")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only report what would be written")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Thermostats to sync at once")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Syncs a schedule file to thermostats, printing what changed"""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    schedule = load_schedule(args.schedule)
+    client = thermo_http.PooledClient(pool_size=len(args.thermostats))
+    thermostats = []
+    for host in args.thermostats:
+        try:
+            model = radiotherm.CommonThermostat(host).model.get('raw')
+            tstat = radiotherm.get_thermostat(host, model)
+        except (IOError, ValueError) as e:
+            logger.error("Unable to connect to %s: %s", host, e)
+            continue
+        if tstat is None:
+            logger.error("Unrecognised thermostat model at %s: %s",
+                         host, model)
+            continue
+        thermostats.append(client.attach(tstat))
+    results = sync_all(thermostats, schedule,
+                       ProgramCache(args.cache, args.ttl), args.workers,
+                       args.refresh, args.dry_run)
+    client.close()
+    failed = len(args.thermostats) - len(thermostats)
+    for host in sorted(results):
+        result = results[host]
+        if isinstance(result, Exception):
+            failed += 1
+            result = {'error': str(result)}
+        json.dump({host: result}, sys.stdout, sort_keys=True)
+        sys.stdout.write("\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,292 @@
+#! /usr/bin/env python
+
+"""
+A caching, request-coalescing proxy in front of a thermostat's API.
+
+The web interface fetches /tstat/model and /tstat on every refresh, from
+every open tab, and the thermostat serves one request at a time.  This
+proxy sits in between (in the role of the CORSProxy subproject):
+
+- /tstat/model never changes, so it's fetched once and kept.
+- /tstat is kept for a short TTL (state_ttl seconds).
+- Identical GETs arriving while one is already on its way upstream wait
+  for its answer rather than sending another.
+- Requests go upstream one at a time and at least min_gap seconds apart,
+  writes ahead of reads (see thermo_arbiter).
+- Anything other than a GET is passed through, and clears cached state
+  (but not the model) so the next read sees the change.
+- Every response carries CORS headers, and preflight requests are answered
+  here without bothering the thermostat.
+
+So N clients polling cost the thermostat one request per TTL.
+
+    ./thermo_proxy.py 10.0.0.21 --port 8080 --state-ttl 5 --stream
+
+The proxy's queue should be the only way to the thermostat.  With --stream
+it also serves thermo_stream's /tstat/stream, polling through the same
+queue and cache, and thermo_program can be given the proxy's address in
+place of the thermostat's.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from time import monotonic
+
+import thermo_arbiter
+import thermo_async
+import thermo_stream
+from thermo_async import read_request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8080
+DEFAULT_STATE_TTL = 5
+# How long GET responses may be reused, in seconds, by path.  None is
+# forever; paths not listed aren't cached but are still coalesced.
+FOREVER = None
+MODEL_PATH = '/tstat/model'
+STATE_PATH = '/tstat'
+
+REASONS = {
+    200: "OK",
+    204: "No Content",
+    400: "Bad Request",
+    404: "Not Found",
+    502: "Bad Gateway",
+}
+
+
+class Proxy(object):
+    """
+    Proxies requests to the thermostat at address.
+
+    ttls maps request paths to how long their GET responses are cached;
+    by default the model forever and the state for state_ttl seconds.
+    origin is sent as Access-Control-Allow-Origin.  min_gap is the least
+    time between upstream requests, in seconds.  If streamer (a
+    thermo_stream.StateStreamer, normally with this as its upstream) is set,
+    /tstat/stream is handed to it.
+    """
+
+    def __init__(self, address, state_ttl=DEFAULT_STATE_TTL, ttls=None,
+                 origin='*', timeout=thermo_async.DEFAULT_TIMEOUT,
+                 clock=monotonic, min_gap=thermo_arbiter.DEFAULT_MIN_GAP):
+        self.address = address
+        if ttls is None:
+            ttls = {MODEL_PATH: FOREVER, STATE_PATH: state_ttl}
+        self.ttls = ttls
+        self.origin = origin
+        self.timeout = timeout
+        self.clock = clock
+        self.cache = {}
+        self.inflight = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.upstream = 0
+        self.errors = 0
+        # Serialises upstream requests, writes first
+        self.gate = thermo_arbiter.AsyncGate(min_gap)
+        self.streamer = None
+
+    async def _fetch(self, method, path, body=None):
+        """Sends one request upstream.  Returns (status, body)."""
+        priority = thermo_arbiter.READ if method in ('GET', 'HEAD') \
+            else thermo_arbiter.CONTROL
+        async with self.gate.turn(priority):
+            self.upstream += 1
+            return await thermo_async.request(self.address, method, path,
+                                              body, self.timeout)
+
+    def _cached(self, path):
+        """Returns a still valid cached (status, body) for path, or None"""
+        entry = self.cache.get(path)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires is not None and self.clock() >= expires:
+            del self.cache[path]
+            return None
+        return response
+
+    async def get(self, path):
+        """
+        Answers a GET from the cache, from a request already in flight, or
+        by asking the thermostat.  Returns (status, body).
+        """
+        response = self._cached(path)
+        if response is not None:
+            self.hits += 1
+            return response
+        pending = self.inflight.get(path)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+        pending = asyncio.get_running_loop().create_future()
+        self.inflight[path] = pending
+        try:
+            response = await self._fetch('GET', path)
+        except asyncio.CancelledError:
+            # The clients waiting on this request weren't cancelled
+            pending.set_result((502, json.dumps(
+                {'error': 'upstream request cancelled'})))
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # Retrieved here so an unawaited failure isn't logged
+            pending.exception()
+            raise
+        finally:
+            del self.inflight[path]
+        if response[0] == 200 and path in self.ttls:
+            ttl = self.ttls[path]
+            expires = None if ttl is FOREVER else self.clock() + ttl
+            self.cache[path] = (expires, response)
+        pending.set_result(response)
+        return response
+
+    async def forward(self, method, path, body):
+        """Passes a non-GET request through, invalidating cached state"""
+        response = await self._fetch(method, path, body)
+        for cached in list(self.cache):
+            if self.ttls.get(cached, 0) is not FOREVER:
+                del self.cache[cached]
+        return response
+
+    async def handle(self, method, path, body):
+        """Answers one client request.  Returns (status, body)."""
+        if method == 'OPTIONS':
+            return 204, ""
+        try:
+            if method in ('GET', 'HEAD'):
+                return await self.get(path)
+            return await self.forward(method, path, body)
+        except (IOError, asyncio.TimeoutError) as e:
+            self.errors += 1
+            logger.warning("Unable to reach the thermostat for %s %s: %r",
+                           method, path, e)
+            return 502, json.dumps({'error': 'thermostat unreachable'})
+
+    def format_response(self, status, body, method='GET'):
+        """Builds a complete HTTP response with CORS headers"""
+        payload = body.encode('utf-8')
+        head = ("HTTP/1.1 %d %s\r\n"
+                "Access-Control-Allow-Origin: %s\r\n"
+                "Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+                "Access-Control-Allow-Headers: Content-Type\r\n"
+                "Access-Control-Max-Age: 86400\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: %d\r\n"
+                "Connection: close\r\n"
+                "\r\n" % (status, REASONS.get(status, ""), self.origin,
+                          len(payload)))
+        if method == 'HEAD':
+            payload = b""
+        return head.encode('ascii') + payload
+
+    async def serve(self, reader, writer):
+        """Serves one client connection"""
+        try:
+            try:
+                request = await read_request(reader)
+            except ValueError:
+                writer.write(self.format_response(
+                    400, json.dumps({'error': 'bad request'})))
+                await writer.drain()
+                return
+            if request is None:
+                return
+            method, path, body, _ = request
+            if self.streamer is not None and method == 'GET' and \
+                    path.split('?', 1)[0] == thermo_stream.STREAM_PATH:
+                await self.streamer.respond(method, path, writer)
+                return
+            status, text = await self.handle(method, path, body or None)
+            writer.write(self.format_response(status, text, method))
+            await writer.drain()
+        except (IOError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def stats(self):
+        """Returns cache and upstream counters"""
+        return {
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'upstream': self.upstream,
+            'errors': self.errors,
+            'cached': len(self.cache),
+            'queue': self.gate.stats(),
+        }
+
+
+async def run(proxy, host='', port=DEFAULT_PORT, stop=None, started=None):
+    """
+    Serves proxy until stop (an asyncio.Event) is set.  If given, started is
+    called with the bound port once listening.
+    """
+    if stop is None:
+        stop = asyncio.Event()
+    poller = None
+    if proxy.streamer is not None:
+        poller = asyncio.get_running_loop().create_task(
+            proxy.streamer.poll())
+    server = await asyncio.start_server(proxy.serve, host, port)
+    port = server.sockets[0].getsockname()[1]
+    logger.info("Proxying %s on port %d", proxy.address, port)
+    if started is not None:
+        started(port)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        if poller is not None:
+            proxy.streamer.close()
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        await server.wait_closed()
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('thermostat', help="Thermostat host[:port]")
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--state-ttl', type=float, default=DEFAULT_STATE_TTL,
+                        help="Seconds to reuse /tstat responses for")
+    parser.add_argument('--origin', default='*',
+                        help="Access-Control-Allow-Origin to send")
+    parser.add_argument('--stream', action='store_true',
+                        help="Also stream state at %s" %
+                        thermo_stream.STREAM_PATH)
+    parser.add_argument('--stream-interval', type=float,
+                        default=thermo_stream.DEFAULT_INTERVAL,
+                        help="Seconds between state polls for the stream")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs the proxy until interrupted"""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    proxy = Proxy(args.thermostat, args.state_ttl, origin=args.origin)
+    if args.stream:
+        proxy.streamer = thermo_stream.StateStreamer(
+            args.thermostat, args.stream_interval, origin=args.origin,
+            upstream=proxy)
+    try:
+        asyncio.run(run(proxy, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    logger.info("Proxy stats: %s", proxy.stats())
+    if proxy.streamer is not None:
+        logger.info("Streamer stats: %s", proxy.streamer.stats())
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
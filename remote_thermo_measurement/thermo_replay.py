@@ -0,0 +1,287 @@
+#! /usr/bin/env python
+
+"""
+Replays a recorded trace through the daemon's filtering and send logic.
+
+Tuning decay_factor, read_freq and send_freq on a live daemon means waiting
+hours to see the effect.  This runs thermo_daemon.step() - the same code
+main() uses to average readings and decide what to post - over a recorded
+trace of ADC readings, on a virtual clock with no sleeping and no network,
+and reports what would have been posted and how well it tracked the
+temperature.  Lists of values sweep every combination:
+
+    ./thermo_replay.py trace.ring --decay-factor .05 .1 .2 --send-freq 30 60
+
+Traces are either a thermo_ring file or text with one reading per line,
+optionally preceded by its time in seconds ("time reading" or
+"time,reading").  Without times, readings are taken to be read_freq apart.
+With them, the trace is resampled to one read every read_freq seconds, each
+taking the latest reading at that time, so read_freq can be swept on a
+recorded trace too.
+
+Conversion to degrees and the statistics are vectorized; the averaging
+itself is stepped tick by tick so it's exactly what the daemon does.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import sys
+
+import numpy
+
+import thermo_daemon
+import thermo_policy
+import thermo_ring
+import thermo_ticker
+
+logger = logging.getLogger(__name__)
+
+# Width of the centered moving average used as the "true" temperature, in
+# seconds
+DEFAULT_REFERENCE_WINDOW = 300
+# Longest lag searched for, in seconds
+DEFAULT_MAX_LAG = 900
+
+
+class VirtualClock(object):
+    """A clock which reads whatever time it was last set to"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def load_trace(path):
+    """
+    Loads a trace.  Returns (times, readings) as arrays; times is None if
+    the trace doesn't have them.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(thermo_ring.MAGIC))
+    if magic == thermo_ring.MAGIC:
+        ring = thermo_ring.open_ring(path)
+        records = ring.snapshot()
+        ring.close()
+        records = records[records['kind'] == thermo_ring.READING]
+        return (records['time'].astype(numpy.float64),
+                records['raw'].astype(numpy.float64))
+    with open(path) as f:
+        rows = [line.replace(',', ' ').split() for line in f
+                if line.strip() and not line.startswith('#')]
+    if not rows:
+        raise ValueError("No readings in %s" % path)
+    data = numpy.array(rows, dtype=numpy.float64)
+    if data.shape[1] == 1:
+        return None, data[:, 0]
+    return data[:, 0], data[:, 1]
+
+
+def resample(times, readings, read_freq):
+    """
+    Returns (times, readings) read every read_freq seconds from a timed
+    trace: each read gets the latest reading at or before it, so readings
+    are dropped or repeated as needed.
+    """
+    count = int((times[-1] - times[0]) // read_freq) + 1
+    grid = times[0] + numpy.arange(count) * float(read_freq)
+    latest = numpy.searchsorted(times, grid, side='right') - 1
+    return grid, readings[latest]
+
+
+def moving_average(values, window):
+    """
+    Returns the centered moving average of values over window samples.
+    Samples without a full window either side are NaN.
+    """
+    window = max(1, int(window) | 1)  # Odd, so it centers
+    result = numpy.full(values.shape, numpy.nan)
+    if window > values.shape[0]:
+        return result
+    sums = numpy.cumsum(numpy.concatenate(([0.0], values)))
+    half = window // 2
+    result[half:values.shape[0] - half] = \
+        (sums[window:] - sums[:-window]) / window
+    return result
+
+
+def error_stats(values, reference):
+    """Returns mean absolute, RMS and max absolute error where both exist"""
+    valid = numpy.isfinite(values) & numpy.isfinite(reference)
+    if not valid.any():
+        return {'mean_abs': None, 'rms': None, 'max_abs': None}
+    error = values[valid] - reference[valid]
+    return {
+        'mean_abs': float(numpy.abs(error).mean()),
+        'rms': float(numpy.sqrt((error ** 2).mean())),
+        'max_abs': float(numpy.abs(error).max()),
+    }
+
+
+def estimate_lag(values, reference, max_shift):
+    """
+    Returns how many samples values trails reference by: the shift (up to
+    max_shift) which minimizes their RMS difference.  values must be all
+    finite; reference may have NaNs at either end, as moving_average()
+    leaves.  Uses an FFT cross-correlation, so every shift is tried at once.
+    """
+    finite = numpy.flatnonzero(numpy.isfinite(reference))
+    if finite.shape[0] == 0:
+        return 0
+    first, stop = finite[0], finite[-1] + 1
+    ref = reference[first:stop]
+    vals = values[first:]
+    shifts = min(max_shift, vals.shape[0] - 1) + 1
+    # Pairs compared at each shift: ref[j] against vals[j + shift]
+    pairs = numpy.minimum(ref.shape[0], vals.shape[0] - numpy.arange(shifts))
+    size = 1 << int(ref.shape[0] + vals.shape[0] - 1).bit_length()
+    cross = numpy.fft.irfft(numpy.conj(numpy.fft.rfft(ref, size)) *
+                            numpy.fft.rfft(vals, size), size)[:shifts]
+    ref_sq = numpy.concatenate(([0.0], numpy.cumsum(ref ** 2)))[pairs]
+    vals_sq = numpy.concatenate(([0.0], numpy.cumsum(vals ** 2)))
+    vals_sq = vals_sq[numpy.arange(shifts) + pairs] - \
+        vals_sq[numpy.arange(shifts)]
+    mse = (ref_sq + vals_sq - 2 * cross) / pairs
+    # The shortest of any (near) ties, allowing for FFT rounding
+    return int(numpy.flatnonzero(mse <= mse.min() + 1e-9)[0])
+
+
+def replay(readings, times=None, read_freq=1, send_freq=30,
+           decay_factor=None, calibration=None, send_deadband=None,
+           send_heartbeat=None, reference_window=DEFAULT_REFERENCE_WINDOW,
+           max_lag=DEFAULT_MAX_LAG):
+    """
+    Runs readings (raw, 0-1) through thermo_daemon.step() as main() would,
+    resampling them to read_freq if they have times.  Parameters left as
+    None take thermo_daemon's settings.  Returns a dict of the posts made,
+    as [time, temperature] pairs, and statistics.
+    """
+    if decay_factor is None:
+        decay_factor = thermo_daemon.decay_factor
+    if send_heartbeat is None:
+        send_heartbeat = thermo_daemon.send_heartbeat
+    readings = numpy.asarray(readings, dtype=numpy.float64)
+    if readings.shape[0] == 0:
+        raise ValueError("Nothing to replay")
+    if times is None:
+        times = numpy.arange(readings.shape[0]) * float(read_freq)
+    else:
+        times, readings = resample(numpy.asarray(times, dtype=numpy.float64),
+                                   readings, read_freq)
+    count = readings.shape[0]
+    temps = thermo_daemon.reading_to_temp(readings, calibration)
+    averages = numpy.empty(count)
+    posted = numpy.full(count, numpy.nan)
+
+    clock = VirtualClock(times[0])
+    policy = thermo_policy.SendPolicy(send_deadband, send_heartbeat, clock)
+    send_timer = thermo_ticker.Ticker(read_freq * send_freq,
+                                      thermo_daemon.tick_policy, times[0],
+                                      clock)
+    step = thermo_daemon.step
+    avgtemp = averages[0] = temps[0]
+    for i in range(1, count):
+        clock.now = times[i]
+        avgtemp, data = step(avgtemp, temps[i], send_timer, policy,
+                             decay_factor)
+        averages[i] = avgtemp
+        if data is not None:
+            # What was actually sent, rounding and all
+            posted[i] = json.loads(data)['rem_temp']
+            policy.sent(posted[i])
+
+    # What the thermostat believes: the last posted value, held until the
+    # next post.
+    sent = numpy.isfinite(posted)
+    last = numpy.maximum.accumulate(
+        numpy.where(sent, numpy.arange(count), -1))
+    held = numpy.where(last >= 0, posted[numpy.maximum(last, 0)],
+                       numpy.nan)
+    reference = moving_average(temps, reference_window / float(read_freq))
+    return {
+        'posts': [[float(times[i]), float(posted[i])]
+                  for i in numpy.flatnonzero(sent)],
+        'stats': {
+            'readings': count,
+            'duration': float(times[-1] - times[0]),
+            'sends': policy.stats(),
+            'average_error': error_stats(averages, reference),
+            'thermostat_error': error_stats(held, reference),
+            'lag': estimate_lag(averages, reference,
+                                int(max_lag / float(read_freq))) *
+            float(read_freq),
+        },
+    }
+
+
+def _optional_float(value):
+    """Parses a float, or 'none' for None"""
+    if value.lower() == 'none':
+        return None
+    return float(value)
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('trace', help="Trace file to replay")
+    parser.add_argument('--read-freq', type=float, nargs='+', default=[1],
+                        help="Seconds between readings")
+    parser.add_argument('--send-freq', type=int, nargs='+', default=[30],
+                        help="Readings between sends")
+    parser.add_argument('--decay-factor', type=float, nargs='+',
+                        default=[thermo_daemon.decay_factor],
+                        help="Weight of each new reading in the average")
+    parser.add_argument('--deadband', type=_optional_float, nargs='+',
+                        default=[thermo_daemon.send_deadband],
+                        help="Send deadband in degrees, or none")
+    parser.add_argument('--heartbeat', type=float,
+                        default=thermo_daemon.send_heartbeat,
+                        help="Most seconds between sends with a deadband")
+    parser.add_argument('--calibration', type=float,
+                        default=thermo_daemon.calibration,
+                        help="Degrees added to every reading")
+    parser.add_argument('--reference-window', type=float,
+                        default=DEFAULT_REFERENCE_WINDOW,
+                        help="Seconds of readings averaged as the truth")
+    parser.add_argument('--posts', action='store_true',
+                        help="Include every post in the output")
+    return parser.parse_args(argv)
+
+
+def sweep(args, times, readings):
+    """Yields a result for every combination of swept parameters"""
+    grid = itertools.product(args.read_freq, args.send_freq,
+                             args.decay_factor, args.deadband)
+    for read_freq, send_freq, decay_factor, deadband in grid:
+        params = {
+            'read_freq': read_freq,
+            'send_freq': send_freq,
+            'decay_factor': decay_factor,
+            'deadband': deadband,
+        }
+        result = replay(readings, times, read_freq, send_freq, decay_factor,
+                        args.calibration, deadband, args.heartbeat,
+                        args.reference_window)
+        result['params'] = params
+        if not args.posts:
+            del result['posts']
+        yield result
+
+
+def main(argv=None):
+    """Replays a trace, printing one JSON object per parameter set"""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    times, readings = load_trace(args.trace)
+    for result in sweep(args, times, readings):
+        json.dump(result, sys.stdout, sort_keys=True)
+        sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
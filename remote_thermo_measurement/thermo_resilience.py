@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+
+"""
+Retries, backoff and a circuit breaker for thermostat I/O.
+
+While a thermostat reboots (or is simply overwhelmed) there's no point
+sending it a request every period.  retry() makes a bounded number of
+attempts with jittered exponential backoff between them.  CircuitBreaker
+stops requests altogether after repeated failures, then lets a single probe
+through every reset_timeout seconds until one succeeds.  ResilientClient
+puts both in front of a thermo_http.PooledClient.
+"""
+
+import logging
+import random
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of sending a request while the circuit is open"""
+    pass
+
+
+class ServerError(IOError):
+    """Raised for HTTP 5xx responses, which mean the device is in trouble"""
+
+    def __init__(self, response):
+        IOError.__init__(self, "HTTP %d: %s" % (response.status_code,
+                                                response.text))
+        self.response = response
+
+
+def backoff_delay(attempt, base=DEFAULT_BASE_DELAY, cap=DEFAULT_MAX_DELAY):
+    """
+    Returns how long to wait before retry number attempt (starting at 0):
+    a uniformly random time up to base * 2 ** attempt, capped at cap.  The
+    jitter keeps a fleet of daemons from retrying in lockstep.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry(func, retries=3, base=DEFAULT_BASE_DELAY, cap=DEFAULT_MAX_DELAY,
+          retry_on=(IOError,), give_up_on=(CircuitOpenError,)):
+    """
+    Calls func, retrying up to retries more times if it raises one of
+    retry_on.  give_up_on exceptions are never retried.  Returns func's
+    result or re-raises its last exception.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except give_up_on:
+            raise
+        except retry_on as e:
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            attempt += 1
+            logger.warning("Attempt %d failed (%s), retrying in %.1fs",
+                           attempt, e, delay)
+            sleep(delay)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of one thermostat.
+
+    After failure_threshold consecutive failures the circuit opens and
+    allow() refuses requests.  Once reset_timeout seconds have passed one
+    probe request is allowed (half open); its success closes the circuit,
+    its failure opens it for another reset_timeout.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30,
+                 clock=monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self.transitions = {}
+        self._probing = False
+
+    def _transition(self, state):
+        """Moves to state, counting and logging the transition"""
+        key = "%s->%s" % (self.state, state)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        if state == OPEN:
+            logger.warning("Thermostat circuit %s after %d failures",
+                           key, self.failures)
+            self.opened_at = self.clock()
+        else:
+            logger.info("Thermostat circuit %s", key)
+        self.state = state
+
+    def allow(self):
+        """Returns whether a request may be sent now"""
+        if self.state == OPEN and \
+                self.clock() - self.opened_at >= self.reset_timeout:
+            self._transition(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        """Records a successful request"""
+        self._probing = False
+        self.failures = 0
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def failure(self):
+        """Records a failed request"""
+        self._probing = False
+        self.failures += 1
+        if self.state == HALF_OPEN or (
+                self.state == CLOSED and
+                self.failures >= self.failure_threshold):
+            self._transition(OPEN)
+
+    def stats(self):
+        """Returns a dict of the breaker's state and counters"""
+        stats = {
+            'state': self.state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+        }
+        stats.update(self.transitions)
+        return stats
+
+
+class ResilientClient(object):
+    """
+    Wraps a PooledClient (or anything with get/post) with retries and a
+    circuit breaker.
+
+    Connection errors and HTTP 5xx responses count as failures; 4xx
+    responses are returned as-is.  retries is the default number of retries
+    per request; pass retries to get/post to override it.  force sends even
+    while the circuit is open, for requests which must not be skipped.
+    """
+
+    def __init__(self, client, breaker=None, retries=1,
+                 base=DEFAULT_BASE_DELAY, cap=DEFAULT_MAX_DELAY):
+        self.client = client
+        if breaker is None:
+            breaker = CircuitBreaker()
+        self.breaker = breaker
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def _request(self, send, retries, force):
+        """Runs send() under the breaker, retrying as configured"""
+        breaker = self.breaker
+
+        def attempt():
+            if not force and not breaker.allow():
+                raise CircuitOpenError("Thermostat circuit is open")
+            try:
+                r = send()
+                if r.status_code >= 500:
+                    raise ServerError(r)
+            except IOError:
+                breaker.failure()
+                raise
+            breaker.success()
+            return r
+        if retries is None:
+            retries = self.retries
+        return retry(attempt, retries, self.base, self.cap)
+
+    def get(self, url, retries=None, force=False, **kwargs):
+        """GETs url.  Raises IOError if every attempt fails."""
+        return self._request(lambda: self.client.get(url, **kwargs),
+                             retries, force)
+
+    def post(self, url, data=None, retries=None, force=False, **kwargs):
+        """POSTs data to url.  Raises IOError if every attempt fails."""
+        return self._request(
+            lambda: self.client.post(url, data=data, **kwargs),
+            retries, force)
+
+    def stats(self):
+        """Returns the breaker's stats"""
+        return self.breaker.stats()
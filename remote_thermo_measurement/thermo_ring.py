@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+
+"""
+A fixed-size, memory-mapped ring buffer of readings and sends.
+
+Every tick's raw ADC value and filtered temperature, and the outcome of
+every post to the thermostat, are written as fixed-size records into a file
+mapped into memory.  The file is allocated in full when created, so it
+never grows, and it is never synced on the hot path: a write is a store
+into the page cache, which the kernel flushes to the (slow) eMMC in its own
+time.  The header keeps a running count, so the buffer picks up where it
+left off after a restart.
+
+Other tools can map the same file read-only with open_ring() and get NumPy
+views of the records without copying them.
+"""
+
+import logging
+import os
+from threading import Lock
+from time import time
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'THRMRING'
+VERSION = 1
+DEFAULT_CAPACITY = 7 * 24 * 60 * 60  # A week of one second ticks
+
+HEADER_DTYPE = numpy.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('record_size', '<u4'),
+    ('capacity', '<u8'),
+    ('count', '<u8'),
+    ('reserved', 'V32'),
+])
+HEADER_SIZE = HEADER_DTYPE.itemsize  # 64 bytes
+
+RECORD_DTYPE = numpy.dtype([
+    ('time', '<f8'),    # Unix time
+    ('raw', '<f4'),     # Raw ADC reading, 0-1; NaN for sends
+    ('temp', '<f4'),    # Filtered temperature, or the temperature sent
+    ('status', '<i4'),  # HTTP status of a send, -1 if it failed outright
+    ('kind', '<i4'),    # READING or SEND
+])
+
+READING = 1
+SEND = 2
+
+
+class RingBuffer(object):
+    """
+    A ring of RECORD_DTYPE records in a memory-mapped file at path.
+
+    An existing file with the same capacity is reopened and appended to;
+    otherwise a new one is created (replacing any incompatible file).  With
+    readonly set the file must exist and its own capacity is used.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = Lock()
+        if readonly:
+            self._map = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+            self._check_header()
+        else:
+            self._open_for_writing(capacity)
+        self.header = self._map[:HEADER_SIZE].view(HEADER_DTYPE)[0:1]
+        self.capacity = int(self.header['capacity'][0])
+        self.records = self._map[HEADER_SIZE:].view(RECORD_DTYPE)
+
+    def _open_for_writing(self, capacity):
+        """Maps path read/write, creating or recreating it if needed"""
+        size = HEADER_SIZE + capacity * RECORD_DTYPE.itemsize
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            self._map = numpy.memmap(self.path, dtype=numpy.uint8, mode='r+')
+            try:
+                self._check_header(capacity)
+                return
+            except ValueError as e:
+                logger.warning("Recreating ring buffer %s: %s", self.path, e)
+                del self._map
+        elif os.path.exists(self.path):
+            logger.warning("Recreating ring buffer %s for %d records",
+                           self.path, capacity)
+        self._create(size, capacity)
+
+    def _create(self, size, capacity):
+        """Allocates a fresh file of size bytes and writes its header"""
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Allocate every block now, so the hot path never has to.
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:  # pragma: no cover
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.path)
+        self._map = numpy.memmap(self.path, dtype=numpy.uint8, mode='r+')
+        header = self._map[:HEADER_SIZE].view(HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['record_size'] = RECORD_DTYPE.itemsize
+        header['capacity'] = capacity
+        header['count'] = 0
+        self._map.flush()
+
+    def _check_header(self, capacity=None):
+        """Raises ValueError unless the mapped header is one we understand"""
+        if self._map.shape[0] < HEADER_SIZE:
+            raise ValueError("%s is too small to be a ring buffer" %
+                             self.path)
+        header = self._map[:HEADER_SIZE].view(HEADER_DTYPE)[0]
+        if header['magic'] != MAGIC or header['version'] != VERSION or \
+                header['record_size'] != RECORD_DTYPE.itemsize:
+            raise ValueError("%s is not a version %d ring buffer" %
+                             (self.path, VERSION))
+        if capacity is not None and header['capacity'] != capacity:
+            raise ValueError("%s holds %d records, not %d" %
+                             (self.path, header['capacity'], capacity))
+
+    @property
+    def count(self):
+        """How many records have ever been written"""
+        return int(self.header['count'][0])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, kind, raw, temp, status=0, when=None):
+        """
+        Writes one record, overwriting the oldest once full.  The count is
+        bumped only after the record is written, so a reader never sees it
+        before its contents.
+        """
+        if when is None:
+            when = time()
+        with self._lock:
+            count = int(self.header['count'][0])
+            self.records[count % self.capacity] = (when, raw, temp, status,
+                                                   kind)
+            self.header['count'] = count + 1
+
+    def record_reading(self, raw, temp, when=None):
+        """Records one tick's raw reading and filtered temperature"""
+        self.append(READING, raw, temp, 0, when)
+
+    def record_send(self, temp, status, when=None):
+        """Records a post of temp which got status (-1 for no answer)"""
+        self.append(SEND, numpy.nan, temp, status, when)
+
+    def views(self):
+        """
+        Returns the records in chronological order as a tuple of (at most
+        two) NumPy views into the mapped file.  Nothing is copied, so the
+        newest records may change under a reader of a live buffer.
+        """
+        count = self.count
+        if count <= self.capacity:
+            return (self.records[:count],)
+        head = count % self.capacity
+        return (self.records[head:], self.records[:head])
+
+    def snapshot(self):
+        """Returns a chronological copy of every record"""
+        return numpy.concatenate(self.views())
+
+    def flush(self):
+        """Writes dirty pages to disk.  Not needed for correctness."""
+        if not self.readonly:
+            self._map.flush()
+
+    def close(self):
+        """Flushes and unmaps the file"""
+        self.flush()
+        del self.records
+        del self.header
+        del self._map
+
+
+def open_ring(path):
+    """Maps an existing ring buffer read-only, for analysis"""
+    return RingBuffer(path, readonly=True)
@@ -0,0 +1,216 @@
+#! /usr/bin/env python
+
+"""
+A background sender, so a slow or hung thermostat can't stall sampling.
+
+The read loop hands payloads to a Sender, which posts them from its own
+thread.  The queue between them is bounded and keeps only the latest value
+for each key: if the thermostat falls behind, stale remote temperatures are
+coalesced away rather than piling up.
+"""
+
+import logging
+from collections import OrderedDict
+from threading import Condition, Thread
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 4
+
+
+class LatestValueQueue(object):
+    """
+    A bounded FIFO of (key, value) pairs holding at most one value per key.
+
+    Putting a key which is already pending replaces its value in place
+    (counted in coalesced).  Putting a new key into a full queue drops the
+    oldest pending entry (counted in dropped).
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.coalesced = 0
+        self.dropped = 0
+        self._items = OrderedDict()
+        self._cond = Condition()
+        self._closed = False
+
+    def put(self, key, value):
+        """Queues value under key, replacing any pending value for it"""
+        with self._cond:
+            if key in self._items:
+                self.coalesced += 1
+            elif len(self._items) >= self.maxsize:
+                old_key, _ = self._items.popitem(last=False)
+                self.dropped += 1
+                logger.debug("Send queue full, dropped pending %s", old_key)
+            self._items[key] = value
+            self._cond.notify()
+
+    def offer(self, key, value):
+        """
+        Queues value under key unless a value for key is already pending.
+        Returns whether it was queued.
+        """
+        with self._cond:
+            if key in self._items:
+                return False
+            self.put(key, value)
+            return True
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest (key, value) pair, waiting up to timeout seconds.
+        Returns None on timeout or once the queue is closed.
+        """
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if self._closed or not self._items:
+                return None
+            return self._items.popitem(last=False)
+
+    def clear(self):
+        """Discards everything pending.  Returns how many were discarded."""
+        with self._cond:
+            count = len(self._items)
+            self._items.clear()
+            return count
+
+    def close(self):
+        """Wakes any waiting get() and makes future ones return None"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def qsize(self):
+        """Returns the number of pending entries"""
+        with self._cond:
+            return len(self._items)
+
+
+class Sender(object):
+    """
+    Posts payloads to a single thermostat URL from a worker thread.
+
+    client is anything with a requests-style post(url, data=...), normally
+    a thermo_http.PooledClient.  If given, on_result is called from the
+    worker with (key, data, status) after each post; status is None if the
+    thermostat couldn't be reached.  post_kwargs are passed to every post,
+    e.g. a thermo_arbiter priority.
+
+    With an outbox (a thermo_outbox.Outbox), payloads for the keys in
+    durable (every key, if it's None) are recorded there before they're
+    queued and acknowledged once the thermostat answers.  Other keys only
+    drop whatever they supersede from the outbox, so frequent payloads
+    which a restart would throw away anyway cost no disk writes.  Whatever
+    the outbox holds is sent when the sender starts, and again after each
+    successful post, so it goes out once the thermostat is back.
+    """
+
+    def __init__(self, client, url, maxsize=DEFAULT_QUEUE_SIZE,
+                 on_result=None, post_kwargs=None, outbox=None,
+                 durable=None):
+        self.client = client
+        self.url = url
+        self.on_result = on_result
+        self.post_kwargs = post_kwargs or {}
+        self.outbox = outbox
+        self.durable = durable
+        self.queue = LatestValueQueue(maxsize)
+        self.sent = 0
+        self.errors = 0
+        self._thread = None
+
+    def start(self):
+        """Starts the worker thread"""
+        self._drain()
+        self._thread = Thread(target=self._run, name="thermo-sender")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, data, key='rem_temp'):
+        """Queues data to be posted.  Never blocks on the network."""
+        if self.outbox is not None:
+            if self.durable is None or key in self.durable:
+                self.outbox.put(key, data)
+            else:
+                for superseded in self.outbox.supersedes.get(key, ()):
+                    self.outbox.discard(superseded)
+        self.queue.put(key, data)
+
+    def _drain(self):
+        """
+        Queues whatever is waiting in the outbox and not already queued,
+        i.e. what couldn't be delivered before
+        """
+        if self.outbox is None:
+            return
+        for key, data in self.outbox.entries():
+            self.queue.offer(key, data)
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker.  Anything still queued is discarded; a post
+        already in flight is waited for (up to timeout seconds), so nothing
+        from this sender can land after stop() returns.
+        """
+        discarded = self.queue.clear()
+        if discarded:
+            logger.debug("Discarding %d unsent payloads", discarded)
+        self.queue.close()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Returns a dict of queue depth and send counters"""
+        return {
+            'depth': self.queue.qsize(),
+            'sent': self.sent,
+            'errors': self.errors,
+            'coalesced': self.queue.coalesced,
+            'dropped': self.queue.dropped,
+        }
+
+    def _run(self):
+        """Worker loop: posts each queued payload in turn"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._deliver(*item)
+            except Exception:
+                # If this thread died, nothing would be posted again while
+                # the read loop carried on regardless.
+                self.errors += 1
+                logger.exception("Unexpected error sending %s", item[0])
+
+    def _deliver(self, key, data):
+        """Posts one queued payload and reports the outcome"""
+        status = self._send(data)
+        # Any answer counts: one the thermostat rejected won't do better
+        # a second time, and ResilientClient retries busy responses.
+        if self.outbox is not None and status is not None:
+            self.outbox.ack(key, data)
+            self._drain()
+        if self.on_result is not None:
+            self.on_result(key, data, status)
+
+    def _send(self, data):
+        """
+        Posts a single payload, logging any failure.  Returns the HTTP
+        status, or None if the thermostat couldn't be reached.
+        """
+        try:
+            r = self.client.post(self.url, data=data, **self.post_kwargs)
+        except IOError as e:
+            self.errors += 1
+            logger.warning("Unable to reach the thermostat: %s", e)
+            return None
+        self.sent += 1
+        if r.status_code >= 400:  # HTTP errors
+            self.errors += 1
+            logger.warning("Server returned an HTTP error code (%d): %s",
+                           r.status_code, r.text)
+        return r.status_code
@@ -0,0 +1,197 @@
+#! /usr/bin/env python
+
+"""
+Pluggable sensor backends behind read_temp().
+
+Every backend returns raw readings scaled to 0.0-1.0 of the ADC's range,
+the same as Adafruit_BBIO's ADC.read(), so the TMP36 conversion doesn't
+care where a reading came from.
+
+- bbio: Adafruit_BBIO, which needs the old 3.8.13 kernel.
+- iio: the Linux IIO sysfs interface found on current kernels.  Each
+  channel's in_voltageN_raw file is opened once and re-read in place with
+  pread.
+- replay: readings from a file or list, for tests and offline runs.
+"""
+
+import logging
+import os
+
+try:
+    import Adafruit_BBIO.ADC as ADC
+except ImportError:  # pragma: no cover
+    ADC = None
+
+logger = logging.getLogger(__name__)
+
+IIO_DEVICE = '/sys/bus/iio/devices/iio:device0'
+IIO_MAX = 4095  # The BBB's ADC is 12 bits
+
+# Header pins of the BeagleBone Black's analog inputs, by IIO channel
+PIN_CHANNELS = {
+    'P9_39': 0,
+    'P9_40': 1,
+    'P9_37': 2,
+    'P9_38': 3,
+    'P9_33': 4,
+    'P9_36': 5,
+    'P9_35': 6,
+}
+
+
+class SensorBackend(object):
+    """
+    The interface every backend implements.  channel is whatever the
+    backend uses to name an input; for the ADC backends that's a header pin
+    such as 'P9_40'.
+    """
+
+    name = None
+
+    def setup(self):
+        """Prepares the hardware.  Raises RuntimeError on failure."""
+        pass
+
+    def read(self, channel):
+        """Returns a raw reading, 0.0-1.0, from channel"""
+        raise NotImplementedError
+
+    def read_many(self, channels, out):
+        """
+        Reads each of channels into the matching element of out, an array
+        (or list) of the same length.  Returns out.
+        """
+        read = self.read
+        for i, channel in enumerate(channels):
+            out[i] = read(channel)
+        return out
+
+    def close(self):
+        """Releases anything held open"""
+        pass
+
+
+class BBIOBackend(SensorBackend):
+    """Reads through Adafruit_BBIO"""
+
+    name = 'bbio'
+
+    def setup(self):
+        if ADC is None:
+            raise RuntimeError("Adafruit_BBIO is not installed")
+        ADC.setup()
+
+    def read(self, channel):
+        return ADC.read(channel)
+
+
+def iio_channel(channel):
+    """
+    Converts a header pin ('P9_40'), AIN name ('AIN1') or number to an IIO
+    channel number.
+    """
+    if isinstance(channel, int):
+        return channel
+    if channel in PIN_CHANNELS:
+        return PIN_CHANNELS[channel]
+    if channel.upper().startswith('AIN'):
+        return int(channel[3:])
+    raise ValueError("Unknown analog input %r" % (channel,))
+
+
+class IIOBackend(SensorBackend):
+    """
+    Reads the IIO sysfs interface directly.
+
+    Files are opened on first use and kept open; each read is a single
+    pread into a buffer allocated up front, parsed where it lies, so
+    there's no reopening and nothing to allocate per sample.
+    """
+
+    name = 'iio'
+
+    def __init__(self, device=IIO_DEVICE, max_value=IIO_MAX):
+        self.device = device
+        self.max_value = float(max_value)
+        self._fds = {}
+        self._buf = bytearray(16)
+        # preadv() takes a list of buffers; this one is reused too
+        self._bufs = [self._buf]
+
+    def setup(self):
+        if not os.path.isdir(self.device):
+            raise RuntimeError("No IIO device at %s" % self.device)
+
+    def _fd(self, channel):
+        """Returns the open descriptor for a channel, opening it if needed"""
+        fd = self._fds.get(channel)
+        if fd is None:
+            path = os.path.join(self.device,
+                                'in_voltage%d_raw' % iio_channel(channel))
+            fd = os.open(path, os.O_RDONLY)
+            self._fds[channel] = fd
+        return fd
+
+    def read(self, channel):
+        fd = self._fd(channel)
+        n = os.preadv(fd, self._bufs, 0)
+        # Parsed in place: int() would need a copy of the buffer
+        buf = self._buf
+        value = 0
+        i = 0
+        while i < n and 48 <= buf[i] <= 57:  # b'0' to b'9'
+            value = value * 10 + buf[i] - 48
+            i += 1
+        if i == 0 or (i < n and buf[i] != 10):  # b'\n'
+            raise ValueError("Bad IIO reading %r from %s" % (
+                bytes(buf[:n]), channel))
+        return value / self.max_value
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+
+class ReplayBackend(SensorBackend):
+    """
+    Plays back recorded readings.
+
+    readings is either a list of values or the path of a file with one
+    reading per line.  Every channel reads from the same sequence.  With
+    loop set the readings repeat forever, otherwise reading past the end
+    raises EOFError.
+    """
+
+    name = 'replay'
+
+    def __init__(self, readings, loop=False):
+        if isinstance(readings, str):
+            with open(readings) as f:
+                readings = [float(line) for line in f if line.strip()]
+        self.readings = list(readings)
+        self.loop = loop
+        self.position = 0
+
+    def read(self, channel):
+        if self.position >= len(self.readings):
+            if not self.loop or not self.readings:
+                raise EOFError("Replay exhausted after %d readings" %
+                               self.position)
+            self.position = 0
+        reading = self.readings[self.position]
+        self.position += 1
+        return reading
+
+
+BACKENDS = dict((b.name, b) for b in (BBIOBackend, IIOBackend, ReplayBackend))
+
+
+def get_backend(name, **kwargs):
+    """Builds the backend called name, passing it kwargs"""
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown sensor backend %r (known: %s)" %
+                         (name, ", ".join(sorted(BACKENDS))))
+    return backend(**kwargs)
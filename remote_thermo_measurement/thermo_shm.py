@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+
+"""
+Readings shared between processes, so consumers can't disturb sampling.
+
+In one interpreter, a slow post or a log write on slow storage can hold the
+GIL or the loop long enough to delay the next ADC read.  With the daemon's
+sampler_process set, a sampler process owns the ADC and publishes each
+reading into a SampleBuffer, a ring of records in shared memory; the daemon
+(and anything else on the machine: a metrics exporter, a local display)
+reads them from there without taking any lock the sampler could wait on.
+
+Writes are ordered by a seqlock: the writer makes the sequence number odd,
+writes the record and the count, then makes it even again.  A reader copies
+what it wants and retries if the sequence number was odd or changed
+meanwhile.  The sequence number is 32 bits, so it's read in one go even on
+the BeagleBone's 32-bit ARM.  There's only ever one writer.
+
+Segments are named after the process which made them, so two daemons never
+share one; the daemon logs the name at startup.
+
+    ./thermo_shm.py remote_thermo_samples-1234    # print readings as they come
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from signal import SIGINT, SIGTERM, SIG_IGN, signal
+from time import monotonic, sleep
+
+import numpy
+
+import thermo_ticker
+
+logger = logging.getLogger(__name__)
+
+NAME_PREFIX = 'remote_thermo_samples'
+# A day of one second reads is about 2MB
+DEFAULT_CAPACITY = 86400
+MAGIC = b'THRMSHM1'
+
+HEADER_DTYPE = numpy.dtype([
+    ('magic', 'S8'),
+    ('capacity', '<u4'),
+    ('seq', '<u4'),
+    ('count', '<u8'),
+])
+RECORD_DTYPE = numpy.dtype([
+    ('time', '<f8'),
+    ('raw', '<f8'),
+    ('temp', '<f8'),
+])
+
+# Segments created by this process, which it's right to clean up
+_created = set()
+
+
+def default_name():
+    """Returns the segment name for this process's buffer"""
+    return '%s-%d' % (NAME_PREFIX, os.getpid())
+
+
+class SampleBuffer(object):
+    """
+    A ring of readings in the shared memory segment called name (by
+    default, default_name()).  With create, the segment is made (replacing
+    any left by a crash) and holds capacity records; otherwise an existing
+    one is attached to.
+    """
+
+    def __init__(self, name=None, capacity=DEFAULT_CAPACITY, create=False):
+        if name is None:
+            name = default_name()
+        self.name = name
+        self.owner = create
+        if create:
+            size = HEADER_DTYPE.itemsize + capacity * RECORD_DTYPE.itemsize
+            try:
+                self.shm = shared_memory.SharedMemory(name, True, size)
+            except FileExistsError:
+                logger.warning("Replacing stale shared memory %s", name)
+                shared_memory.SharedMemory(name).unlink()
+                self.shm = shared_memory.SharedMemory(name, True, size)
+            _created.add(name)
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+            if name not in _created:
+                # Attaching registers the segment to be unlinked when this
+                # process exits, which would pull it from under the owner.
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.header = numpy.ndarray((), HEADER_DTYPE, self.shm.buf)
+        if create:
+            self.header['magic'] = MAGIC
+            self.header['capacity'] = capacity
+        elif self.header['magic'] != MAGIC:
+            self.close()
+            raise ValueError("%s isn't a sample buffer" % name)
+        self.capacity = int(self.header['capacity'])
+        self.records = numpy.ndarray((self.capacity,), RECORD_DTYPE,
+                                     self.shm.buf, HEADER_DTYPE.itemsize)
+
+    def publish(self, when, raw, temp):
+        """Appends a reading.  Only one process may publish."""
+        header = self.header
+        count = int(header['count'])
+        header['seq'] += 1  # Odd: a write is under way
+        self.records[count % self.capacity] = (when, raw, temp)
+        header['count'] = count + 1
+        header['seq'] += 1
+
+    def read_since(self, seen):
+        """
+        Returns (count, records, lost): the total published so far, a copy
+        of those published since seen were, and how many of them were
+        already overwritten.
+        """
+        header = self.header
+        while True:
+            seq = int(header['seq'])
+            if seq & 1:
+                sleep(0)
+                continue
+            count = int(header['count'])
+            start = max(seen, count - self.capacity)
+            records = self.records[
+                numpy.arange(start, count) % self.capacity]
+            if int(header['seq']) == seq:
+                return count, records, start - seen
+
+    def latest(self):
+        """Returns the newest record, or None if there isn't one"""
+        count, records, _ = self.read_since(0)
+        if count == 0:
+            return None
+        return records[-1]
+
+    def close(self):
+        """Detaches, and removes the segment if this process made it"""
+        self.header = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            _created.discard(self.name)
+
+
+class Consumer(object):
+    """Hands out each reading in a SampleBuffer once"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.seen = 0
+        self.lost = 0
+
+    def poll(self):
+        """Returns the readings published since the last poll"""
+        self.seen, records, lost = self.buffer.read_since(self.seen)
+        if lost:
+            self.lost += lost
+            logger.warning("Fell behind the sampler, lost %d readings", lost)
+        return records
+
+
+def run_sampler(buffer, read, read_freq, stop, policy=thermo_ticker.SKIP,
+                control=None, configure=None):
+    """
+    Sampler process body: publishes read(), a (raw, temperature) pair, to
+    buffer every read_freq seconds until stop (an Event) is set.  Signals
+    are left to the parent, which sets stop.
+
+    Settings can be changed without restarting the sampler, so readers
+    keep the same buffer: dicts of settings sent through control (one end
+    of a Pipe) are passed to configure before the next read, and their
+    read_freq and tick_policy, if any, apply to the schedule.
+    """
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, SIG_IGN)
+    ticker = thermo_ticker.Ticker(read_freq, policy)
+    while not stop.wait(ticker.timeout()):
+        while control is not None and control.poll():
+            settings = control.recv()
+            if configure is not None:
+                configure(settings)
+            if 'read_freq' in settings:
+                ticker.set_period(settings['read_freq'])
+            ticker.policy = settings.get('tick_policy', ticker.policy)
+        ticker.tick()
+        when = monotonic()
+        raw, temp = read()
+        buffer.publish(when, raw, temp)
+    logger.debug("Sampler stats: %s", ticker.stats())
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('name', help="Shared memory segment to read, as "
+                        "logged by the daemon")
+    parser.add_argument('--interval', type=float, default=1,
+                        help="Seconds between checks for new readings")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Prints readings from a running sampler as JSON lines"""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    consumer = Consumer(SampleBuffer(args.name))
+    try:
+        while True:
+            for record in consumer.poll():
+                json.dump(dict((field, float(record[field]))
+                               for field in RECORD_DTYPE.names),
+                          sys.stdout, sort_keys=True)
+                sys.stdout.write("\n")
+            sys.stdout.flush()
+            sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.buffer.close()
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,379 @@
+#! /usr/bin/env python
+
+"""
+Streams a thermostat's state to web clients with Server-Sent Events.
+
+Rather than every dashboard polling /tstat itself, browsers subscribe to
+/tstat/stream here.  One poller asks the thermostat for /tstat every
+interval seconds (and only while someone is subscribed) and pushes what
+changed to every subscriber, so the thermostat's load doesn't depend on how
+many clients there are.
+
+Each subscriber first gets a "state" event with the whole /tstat object,
+then "diff" events holding only the keys which changed; a key which
+disappeared is sent as null.  A subscriber which can't keep up has its
+diffs merged rather than queued, so memory per client stays bounded.
+Comments are sent every keepalive seconds so dead connections are noticed.
+ThermoComms.subscribeState() is the matching client.  It looks the model up
+first, so /tstat/model is answered here too, from the thermostat's answer
+to the first such request.
+
+    ./thermo_stream.py 10.0.0.21 --port 8081 --interval 5
+
+The thermostat should only be asked through one queue, so rather than
+running this on its own, thermo_proxy can stream from its port (--stream),
+its polls taking their turn in the proxy's queue; see StateStreamer's
+upstream.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+import thermo_async
+from thermo_async import read_request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8081
+DEFAULT_INTERVAL = 5
+DEFAULT_KEEPALIVE = 15
+STREAM_PATH = '/tstat/stream'
+STATE_PATH = '/tstat'
+MODEL_PATH = '/tstat/model'
+# How long browsers should wait before reconnecting, in milliseconds
+RETRY_MS = 3000
+
+
+def diff_state(old, new):
+    """
+    Returns the keys of new which differ from old, plus any keys of old
+    missing from new, set to None.
+    """
+    changes = dict((key, value) for key, value in new.items()
+                   if key not in old or old[key] != value)
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    return changes
+
+
+def format_event(event, data):
+    """Formats one Server-Sent Event carrying data as JSON"""
+    return ("event: %s\ndata: %s\n\n" % (
+        event, json.dumps(data, sort_keys=True, separators=(',', ':')))
+    ).encode('utf-8')
+
+
+def cors_headers(origin):
+    """Returns the CORS response headers, as a string"""
+    return ("Access-Control-Allow-Origin: %s\r\n"
+            "Access-Control-Allow-Methods: GET, OPTIONS\r\n"
+            "Access-Control-Allow-Headers: Content-Type\r\n" % origin)
+
+
+class Subscriber(object):
+    """
+    One connected client's pending updates: either a whole state to send,
+    or the changes since it was last written to.
+    """
+
+    def __init__(self):
+        self.full = None
+        self.pending = {}
+        self.closed = False
+        self.wake = asyncio.Event()
+
+    def send_state(self, state):
+        """Queues a whole state, superseding anything pending"""
+        self.full = dict(state)
+        self.pending = {}
+        self.wake.set()
+
+    def send_changes(self, changes):
+        """Merges changes into whatever is pending"""
+        if self.full is not None:
+            self.full.update(changes)
+            for key, value in changes.items():
+                if value is None:
+                    del self.full[key]
+        else:
+            self.pending.update(changes)
+        self.wake.set()
+
+    def close(self):
+        """Ends the subscription"""
+        self.closed = True
+        self.wake.set()
+
+    def take(self):
+        """Returns the next (event, data) to send, or None if nothing is"""
+        self.wake.clear()
+        if self.full is not None:
+            full, self.full = self.full, None
+            return 'state', full
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            return 'diff', pending
+        return None
+
+
+class StateStreamer(object):
+    """
+    Polls the thermostat at address while anyone is subscribed and streams
+    its state to them.
+
+    If upstream is given, paths are asked of it rather than the thermostat:
+    it needs a get(path) coroutine returning (status, body), such as a
+    thermo_proxy.Proxy's.
+    """
+
+    def __init__(self, address, interval=DEFAULT_INTERVAL,
+                 keepalive=DEFAULT_KEEPALIVE, origin='*',
+                 timeout=thermo_async.DEFAULT_TIMEOUT, upstream=None):
+        self.address = address
+        self.upstream = upstream
+        self.interval = interval
+        self.keepalive = keepalive
+        self.origin = origin
+        self.timeout = timeout
+        self.state = None
+        self.model = None
+        self.subscribers = set()
+        self.polls = 0
+        self.errors = 0
+        self.diffs = 0
+        self._subscribed = None
+
+    @property
+    def subscribed(self):
+        """Set while anyone is subscribed; created on the running loop"""
+        if self._subscribed is None:
+            self._subscribed = asyncio.Event()
+        return self._subscribed
+
+    async def get(self, path):
+        """GETs path from upstream or the thermostat: (status, body)"""
+        if self.upstream is not None:
+            return await self.upstream.get(path)
+        return await thermo_async.request(self.address, 'GET', path,
+                                          timeout=self.timeout)
+
+    async def poll_once(self):
+        """Fetches /tstat once and tells every subscriber what changed"""
+        self.polls += 1
+        status, body = await self.get(STATE_PATH)
+        if status != 200:
+            raise IOError("HTTP %d: %s" % (status, body))
+        state = json.loads(body)
+        if not self.subscribers:
+            # Everyone left while waiting; it'd only be stale when they return
+            return
+        if self.state is None:
+            for subscriber in self.subscribers:
+                subscriber.send_state(state)
+        else:
+            changes = diff_state(self.state, state)
+            if changes:
+                self.diffs += 1
+                for subscriber in self.subscribers:
+                    subscriber.send_changes(changes)
+        self.state = state
+
+    async def fetch_model(self):
+        """
+        Returns the thermostat's /tstat/model answer, as JSON text.  It
+        doesn't change, so it's only asked for until it's known.
+        """
+        if self.model is None:
+            status, body = await self.get(MODEL_PATH)
+            if status != 200:
+                raise IOError("HTTP %d: %s" % (status, body))
+            json.loads(body)
+            self.model = body
+        return self.model
+
+    async def poll(self):
+        """Polls every interval seconds, while anyone is subscribed"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.subscribed.wait()
+            deadline = loop.time()
+            while self.subscribers:
+                try:
+                    await self.poll_once()
+                except (IOError, ValueError, asyncio.TimeoutError) as e:
+                    self.errors += 1
+                    logger.warning("Unable to poll the thermostat: %r", e)
+                deadline += self.interval
+                await asyncio.sleep(max(0, deadline - loop.time()))
+
+    def subscribe(self):
+        """Adds a subscriber, sending it the current state if there is one"""
+        subscriber = Subscriber()
+        if self.state is not None:
+            subscriber.send_state(self.state)
+        self.subscribers.add(subscriber)
+        self.subscribed.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Removes a subscriber; with none left, polling stops"""
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            self.subscribed.clear()
+            # Stale by the time anyone subscribes again
+            self.state = None
+
+    async def stream(self, subscriber, writer):
+        """Writes subscriber's updates to writer until either goes away"""
+        while not subscriber.closed:
+            try:
+                await asyncio.wait_for(subscriber.wake.wait(),
+                                       self.keepalive)
+            except asyncio.TimeoutError:
+                writer.write(b": keepalive\n\n")
+                await writer.drain()
+                continue
+            update = subscriber.take()
+            if update is not None:
+                writer.write(format_event(*update))
+                await writer.drain()
+
+    async def serve(self, reader, writer):
+        """Serves one client connection"""
+        try:
+            try:
+                request = await read_request(reader)
+            except ValueError:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\n"
+                             b"Content-Length: 0\r\n\r\n")
+                await writer.drain()
+                return
+            if request is None:
+                return
+            method, path, _, _ = request
+            await self.respond(method, path, writer)
+        except (IOError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, path, writer):
+        """
+        Answers a request already read from writer's connection, streaming
+        to it if it's a subscription.
+        """
+        if method == 'OPTIONS':
+            writer.write(("HTTP/1.1 204 No Content\r\n%s"
+                          "Content-Length: 0\r\n\r\n" %
+                          cors_headers(self.origin)).encode('ascii'))
+            await writer.drain()
+            return
+        path = path.split('?', 1)[0]
+        if method == 'GET' and path == MODEL_PATH:
+            try:
+                body = (await self.fetch_model()).encode('utf-8')
+                status = "200 OK"
+            except (IOError, ValueError, asyncio.TimeoutError) as e:
+                self.errors += 1
+                logger.warning("Unable to get the model: %r", e)
+                body = b""
+                status = "502 Bad Gateway"
+            writer.write(("HTTP/1.1 %s\r\n%s"
+                          "Content-Type: application/json\r\n"
+                          "Content-Length: %d\r\n"
+                          "Connection: close\r\n\r\n" %
+                          (status, cors_headers(self.origin), len(body))
+                          ).encode('ascii') + body)
+            await writer.drain()
+            return
+        if method != 'GET' or path != STREAM_PATH:
+            writer.write(b"HTTP/1.1 404 Not Found\r\n"
+                         b"Content-Length: 0\r\n\r\n")
+            await writer.drain()
+            return
+        writer.write(("HTTP/1.1 200 OK\r\n%s"
+                      "Content-Type: text/event-stream\r\n"
+                      "Cache-Control: no-cache\r\n"
+                      "Connection: keep-alive\r\n"
+                      "\r\nretry: %d\n\n" %
+                      (cors_headers(self.origin), RETRY_MS)
+                      ).encode('ascii'))
+        await writer.drain()
+        subscriber = self.subscribe()
+        try:
+            await self.stream(subscriber, writer)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def close(self):
+        """Ends every subscription"""
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+
+    def stats(self):
+        """Returns poll counters and the number of subscribers"""
+        return {
+            'subscribers': len(self.subscribers),
+            'polls': self.polls,
+            'errors': self.errors,
+            'diffs': self.diffs,
+        }
+
+
+async def run(streamer, host='', port=DEFAULT_PORT, stop=None, started=None):
+    """
+    Serves streamer until stop (an asyncio.Event) is set.  If given,
+    started is called with the bound port once listening.
+    """
+    if stop is None:
+        stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    poller = loop.create_task(streamer.poll())
+    server = await asyncio.start_server(streamer.serve, host, port)
+    port = server.sockets[0].getsockname()[1]
+    logger.info("Streaming %s on port %d", streamer.address, port)
+    if started is not None:
+        started(port)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        streamer.close()
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+        await server.wait_closed()
+
+
+def parse_args(argv=None):
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('thermostat', help="Thermostat host[:port]")
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help="Seconds between polls of the thermostat")
+    parser.add_argument('--origin', default='*',
+                        help="Access-Control-Allow-Origin to send")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs the streamer until interrupted"""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    streamer = StateStreamer(args.thermostat, args.interval,
+                             origin=args.origin)
+    try:
+        asyncio.run(run(streamer, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    logger.info("Streamer stats: %s", streamer.stats())
+    return 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
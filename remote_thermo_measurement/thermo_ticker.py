@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+
+"""
+A drift-free, deadline based scheduler for the read loop.
+
+Waiting read_freq seconds after each read makes every period read_freq
+plus however long the read (and any send) took, so the schedule slowly
+drifts.  A Ticker instead fires at fixed absolute times on the monotonic
+clock, start + n * period, and keeps statistics on how late each tick was.
+"""
+
+import logging
+from math import floor, sqrt
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# What to do when one or more whole periods were missed:
+# SKIP drops the missed ticks and resumes on the next future deadline,
+# CATCH_UP fires each missed tick immediately, one after another.
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+POLICIES = (SKIP, CATCH_UP)
+
+
+class Ticker(object):
+    """
+    Fires every period seconds at fixed absolute deadlines.
+
+    Use timeout() as the time to wait before the next tick, then call tick()
+    once woken.  clock must be monotonic; it's a parameter for testing.
+    """
+
+    def __init__(self, period, policy=SKIP, start=None, clock=monotonic):
+        if policy not in POLICIES:
+            raise ValueError("Unknown tick policy %r" % (policy,))
+        if period <= 0:
+            raise ValueError("Tick period must be positive")
+        self.period = period
+        self.policy = policy
+        self.clock = clock
+        if start is None:
+            start = clock()
+        self.deadline = start + period
+        self.ticks = 0
+        self.missed = 0
+        self.max_lateness = 0.0
+        self._mean_lateness = 0.0
+        self._m2_lateness = 0.0
+
+    def timeout(self):
+        """Returns the seconds until the next deadline (never negative)"""
+        return max(0.0, self.deadline - self.clock())
+
+    def due(self):
+        """Returns whether the next deadline has passed"""
+        return self.clock() >= self.deadline
+
+    def tick(self):
+        """
+        Records a tick for the current deadline and advances to the next
+        one according to the policy.  Returns how late this tick was, in
+        seconds.
+        """
+        now = self.clock()
+        lateness = max(0.0, now - self.deadline)
+        self._record(lateness)
+        self.deadline += self.period
+        if self.policy == SKIP and now >= self.deadline:
+            skipped = int(floor((now - self.deadline) / self.period)) + 1
+            self.missed += skipped
+            self.deadline += skipped * self.period
+            logger.debug("Running late, skipped %d ticks", skipped)
+        return lateness
+
+    def set_period(self, period):
+        """
+        Changes the period.  The next deadline moves to the last tick's
+        deadline plus the new period, so a shorter period can make it due
+        at once.
+        """
+        if period <= 0:
+            raise ValueError("Tick period must be positive")
+        self.deadline += period - self.period
+        self.period = period
+
+    def _record(self, lateness):
+        """Folds one lateness sample into the running statistics"""
+        self.ticks += 1
+        delta = lateness - self._mean_lateness
+        self._mean_lateness += delta / self.ticks
+        self._m2_lateness += delta * (lateness - self._mean_lateness)
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+    def stats(self):
+        """
+        Returns a dict of tick statistics.  jitter is the standard deviation
+        of lateness; all times are in seconds.
+        """
+        jitter = 0.0
+        if self.ticks > 1:
+            jitter = sqrt(self._m2_lateness / (self.ticks - 1))
+        return {
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'mean_lateness': self._mean_lateness,
+            'max_lateness': self.max_lateness,
+            'jitter': jitter,
+        }
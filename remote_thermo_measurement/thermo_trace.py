@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+
+"""
+Always-on tracing of the daemon's hot path, and profiling on demand.
+
+Debug logging every tick costs real CPU on a BeagleBone, so production runs
+without it, and then there's nothing to look at when something goes wrong.
+A TraceRing instead records each tick's events (how late the tick was, the
+reading and how long it took, what was submitted and how each send went)
+as a few numbers in a preallocated ring, overwriting the oldest.  Nothing
+is formatted until the ring is dumped, which the daemon does on SIGUSR1.
+
+Profiler toggles cProfile for the thread that calls it (the daemon's read
+loop, via SIGUSR2), writing a pstats file each time it's switched off.
+"""
+
+import cProfile
+import logging
+import os
+import time
+from threading import Lock
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 4096
+
+# Event kinds.  Which fields each uses:
+TICK = 1      # value: how late the tick was, in seconds
+READ = 2      # value: temperature, extra: the average, duration: read time
+SUBMIT = 3    # value: the average handed to the sender
+SEND = 4      # value: temperature posted (NaN if none), status: HTTP status
+KIND_NAMES = {TICK: 'tick', READ: 'read', SUBMIT: 'submit', SEND: 'send'}
+
+RECORD_DTYPE = numpy.dtype([
+    ('time', '<f8'),
+    ('kind', '<i4'),
+    ('status', '<i4'),
+    ('value', '<f8'),
+    ('extra', '<f8'),
+    ('duration', '<f8'),
+])
+
+NAN = float('nan')
+
+
+class TraceRing(object):
+    """
+    The last capacity events, in memory.  record() may be called from any
+    thread.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, clock=time.monotonic):
+        self.capacity = capacity
+        self.clock = clock
+        self.records = numpy.zeros(capacity, RECORD_DTYPE)
+        self.count = 0
+        # Taken around each write, so threads can't lose each other's events
+        self._lock = Lock()
+
+    def record(self, kind, value=NAN, extra=NAN, duration=NAN, status=0):
+        """Records an event, overwriting the oldest if the ring is full"""
+        with self._lock:
+            self.records[self.count % self.capacity] = (
+                self.clock(), kind, status, value, extra, duration)
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the events held, oldest first.  It doesn't take
+        the lock, as it's called from a signal handler, which could
+        interrupt record() in the same thread.
+        """
+        count = self.count
+        if count <= self.capacity:
+            return self.records[:count].copy()
+        start = count % self.capacity
+        return numpy.concatenate((self.records[start:],
+                                  self.records[:start]))
+
+    def dump(self, path):
+        """
+        Writes the events held to path as text, one per line.  Times are
+        monotonic; the header gives the wall clock time they correspond to.
+        """
+        records = self.snapshot()
+        with open(path, 'w') as f:
+            f.write("# %d events, %d dropped; monotonic %.6f is %s\n" % (
+                len(records), max(0, self.count - self.capacity),
+                self.clock(), time.strftime("%Y-%m-%d %H:%M:%S %Z")))
+            f.write("# time kind status value extra duration\n")
+            for record in records:
+                f.write("%.6f %s %d %.4f %.4f %.6f\n" % (
+                    record['time'], KIND_NAMES.get(int(record['kind']),
+                                                   record['kind']),
+                    record['status'], record['value'], record['extra'],
+                    record['duration']))
+        return len(records)
+
+
+class Profiler(object):
+    """
+    cProfile, switched on and off.  Each profile is written to a new pstats
+    file in directory when it's switched off.
+    """
+
+    def __init__(self, directory, prefix='remote_thermo'):
+        self.directory = directory
+        self.prefix = prefix
+        self.profile = None
+
+    def toggle(self):
+        """
+        Starts profiling, or stops and writes the profile.  Returns the
+        file written, or None if profiling just started.
+        """
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            logger.info("Profiling started")
+            return None
+        profile, self.profile = self.profile, None
+        profile.disable()
+        path = os.path.join(self.directory, "%s-%s.prof" % (
+            self.prefix, time.strftime("%Y%m%d-%H%M%S")))
+        profile.dump_stats(path)
+        logger.info("Profile written to %s", path)
+        return path
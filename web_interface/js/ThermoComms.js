@@ -23,6 +23,7 @@ var ThermoComms = function(address, protocol) {
 	this.thermoModel = "/tstat/model";
 	this.thermoProgramHeat = "/tstat/program/heat";
 	this.thermoProgramCool = "/tstat/program/cool";
+	this.thermoStream = "/tstat/stream";
 	
 	// Alas, we need to keep track of the model.
 	this.model = undefined;
@@ -54,7 +55,8 @@ ThermoComms.ajaxAlways = function(xhr, status) {
  */
 ThermoComms.prototype.getModelVersion = function(success_cb, fail_cb) {
 	if (this.model && this.version) {
-		success_cb(this.model, this.verison);
+		success_cb(this.model, this.version);
+		return;
 	}
 	
 	var tcommObject = this;
@@ -87,6 +89,25 @@ ThermoComms.prototype.getModelVersion = function(success_cb, fail_cb) {
 	});
 };
 
+/**
+ * Converts a raw /tstat response into the structure getState() gives its
+ * callback (see below).  Requires the model to be known.
+ */
+ThermoComms.prototype.parseState = function(json) {
+	var result = {};
+
+	result.temp = json.temp;
+	result.hvac_state = json.ttarget;
+	if (this.model === "CT30") {
+		result.fan_state = json.fstate;
+	} else {
+		result.fan_state = ( json.fmode >=1 ) ? 1 : 0;
+	}
+	result.time = json.time;
+
+	return result;
+};
+
 /**
  * Fetches/updates the (volatile) state of the thermostat
  * Returns nothing
@@ -117,18 +138,7 @@ ThermoComms.prototype.getState = function(success_cb, fail_cb) {
 		.done(function (json) {
 			console.log("Recieved result of", json);
 		
-			var result = {};
-		
-			result.temp = json.temp;
-			result.hvac_state = json.ttarget;
-			if (context.model === "CT30") {
-				result.fan_state = json.fstate;
-			} else {
-				result.fan_state = ( json.fmode >=1 ) ? 1 : 0;
-			}
-			result.time = json.time;
-		
-			success_cb(result);
+			success_cb(context.parseState(json));
 		})
 		.fail(function (xhr, status, errorThrown) {
 			/* istanbul ignore else */
@@ -217,3 +227,70 @@ ThermoComms.prototype.getTarget = function(success_cb, fail_cb) {
 		});
 	}, fail_cb);
 };
+
+/**
+ * Subscribes to the thermostat's state as streamed by thermo_stream.py,
+ * rather than polling getState().  The server sends the whole state once,
+ * then only what changed; success_cb is called with the full, updated
+ * state (the same structure getState() gives) every time.
+ * Returns a subscription; call its close() to unsubscribe.
+ * Callback prototypes:
+ *   success_cb(structure):
+ *     See getState().
+ *   fail_cb(error)
+ *     The EventSource error event, or for failures fetching the model, see
+ *     jQuery's ajax.fail().  The browser reconnects by itself after errors
+ *     on the stream.
+ */
+ThermoComms.prototype.subscribeState = function(success_cb, fail_cb) {
+	var context = this;
+	var subscription = {
+		source: undefined,
+		closed: false,
+	};
+	subscription.close = function() {
+		subscription.closed = true;
+		if (subscription.source) {
+			subscription.source.close();
+		}
+	};
+
+	// We need to know what model, wrap the whole call as the CB to getting that
+	this.getModelVersion(function() {
+		if (subscription.closed) {
+			return;
+		}
+		var state = {};
+		var source = new EventSource(
+			context.protocol + "://" + context.address + context.thermoStream);
+		subscription.source = source;
+
+		source.addEventListener("state", function(event) {
+			state = JSON.parse(event.data);
+			success_cb(context.parseState(state));
+		});
+		source.addEventListener("diff", function(event) {
+			var changes = JSON.parse(event.data);
+			for (var key in changes) {
+				/* istanbul ignore else */
+				if (changes.hasOwnProperty(key)) {
+					if (changes[key] === null) {
+						delete state[key];
+					} else {
+						state[key] = changes[key];
+					}
+				}
+			}
+			success_cb(context.parseState(state));
+		});
+		source.onerror = function(event) {
+			if (typeof fail_cb !== "undefined") {
+				fail_cb(event);
+			} else {
+				console.log("State stream error", event);
+			}
+		};
+	}, fail_cb);
+
+	return subscription;
+};
@@ -52,6 +52,20 @@ QUnit.module("Thermostat Communication (ThermoComms)", function(hooks) {
 				'{"model":"CT80 V2.14T"}');
 		});
 
+		QUnit.test("Cached model", function(test) {
+			this.tcomms = new ThermoComms("localhost");
+			this.tcomms.model = "CT80";
+			this.tcomms.version = "V2.14T";
+			var results = [];
+
+			this.tcomms.getModelVersion(function(name, version) {
+				results.push([name, version]);
+			});
+			test.deepEqual(results, [["CT80", "V2.14T"]],
+				"Called back once, with the cached model");
+			test.equal(this.server.requests.length, 0, "Nothing requested");
+		});
+
 		QUnit.test("Test AJAX failure code",function(test) {
 			var done = test.async();
 			this.tcomms = new ThermoComms("localhost");
@@ -422,4 +436,110 @@ QUnit.module("Thermostat Communication (ThermoComms)", function(hooks) {
 
 		});
 	});
+	
+	QUnit.module("ThermoComms.subscribeState", function(hooks) {
+		hooks.beforeEach( function() {
+			console.log("Running beforeEach in subscribeState");
+			var sources = this.sources = [];
+			this.realEventSource = window.EventSource;
+			// A stand-in for the browser's EventSource
+			window.EventSource = function(url) {
+				this.url = url;
+				this.listeners = {};
+				this.closed = false;
+				sources.push(this);
+			};
+			window.EventSource.prototype.addEventListener = function(name, cb) {
+				this.listeners[name] = cb;
+			};
+			window.EventSource.prototype.emit = function(name, data) {
+				this.listeners[name]({ data: JSON.stringify(data) });
+			};
+			window.EventSource.prototype.close = function() {
+				this.closed = true;
+			};
+			this.tcomms = new ThermoComms("localhost");
+			this.tcomms.model="CT80";
+			this.tcomms.version="3.15";
+			// Answers the model lookup whenever respond() is called
+			this.server.respondWith("GET", "http://localhost/tstat/model",
+				[200, { "Content-Type": "text/plain" },
+					'{"model":"CT80 V2.14T"}']);
+		});
+		
+		hooks.afterEach( function() {
+			window.EventSource = this.realEventSource;
+		});
+		
+		QUnit.test("State then diffs", function(test) {
+			var results = [];
+			var subscription = this.tcomms.subscribeState(function(json) {
+				results.push(json);
+			});
+			this.server.respond();
+			
+			test.equal(this.server.requests.length, 0,
+				"The cached model is used");
+			test.equal(this.sources.length, 1, "One stream opened");
+			test.equal(this.sources[0].url, "http://localhost/tstat/stream",
+				"Stream URL is correct");
+			this.sources[0].emit("state", {
+				"temp": 45.6, "ttarget": 0, "fmode": 0,
+				"time": {"day": 0, "hour": 1, "minutes": 2} });
+			this.sources[0].emit("diff", {"temp": 46.1, "fmode": 2});
+			this.sources[0].emit("diff", {"time": null});
+			
+			test.deepEqual(results, [
+				{ temp: 45.6, hvac_state: 0, fan_state: 0,
+					time: {"day": 0, "hour": 1, "minutes": 2} },
+				{ temp: 46.1, hvac_state: 0, fan_state: 1,
+					time: {"day": 0, "hour": 1, "minutes": 2} },
+				{ temp: 46.1, hvac_state: 0, fan_state: 1, time: undefined },
+			], "Every update gives the whole state");
+			
+			subscription.close();
+			test.ok(this.sources[0].closed, "close() closes the stream");
+		});
+		
+		QUnit.test("Model looked up first", function(test) {
+			this.tcomms.model=undefined;
+			this.tcomms.version=undefined;
+			
+			this.tcomms.subscribeState(function() {});
+			test.equal(this.sources.length, 0, "No stream before the model");
+			this.server.respond();
+			
+			test.equal(this.server.requests.length, 1, "One model lookup");
+			test.equal(this.tcomms.model, "CT80", "Model is set");
+			test.equal(this.sources.length, 1, "One stream opened");
+		});
+		
+		QUnit.test("Close before the model is known", function(test) {
+			this.tcomms.model=undefined;
+			this.tcomms.version=undefined;
+			
+			var subscription = this.tcomms.subscribeState(function() {
+				test.ok(false, "No state expected");
+			});
+			subscription.close();
+			this.server.respond();
+			
+			test.equal(this.server.requests.length, 1, "Model was looked up");
+			test.equal(this.sources.length, 0, "No stream opened");
+		});
+		
+		QUnit.test("Stream errors", function(test) {
+			var errors = [];
+			this.tcomms.subscribeState(function() {}, function(event) {
+				errors.push(event);
+			});
+			this.tcomms.subscribeState(function() {});
+			this.server.respond();
+			
+			test.equal(this.sources.length, 2, "One stream each");
+			this.sources[0].onerror("lost");
+			this.sources[1].onerror("lost");
+			test.deepEqual(errors, ["lost"], "Errors go to fail_cb if given");
+		});
+	});
 });